@@ -0,0 +1,197 @@
+"""Benchmark the evaluation backends against the mock API.
+
+Every backend is run on a synthetic CSV of every requested size, each run in a
+fresh process so its peak memory is its own. Reports rows/s, per-call and
+per-row latency percentiles and peak memory; --output appends the same
+figures as JSON lines, so runs can be compared across changes:
+
+    python benchmark.py --rows 10 1000 --latency 0.3 --concurrency 64
+    python benchmark.py --rows 500 --latency-distribution lognormal --rate-limit-rate 0.05 --output bench.jsonl
+
+The mock server options (latency distribution, error injection, canned
+responses) are the same as mock_anthropic.py's.
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from mock_anthropic import add_mock_arguments, mock_options, start_mock_server
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "st-qc-frqs.py")
+PERCENTILES = (50, 95, 99)
+ROW_BACKEND = "process_row"
+WORDS = (
+    "trade", "empire", "reform", "migration", "industry", "treaty", "revolution", "labor", "religion", "climate",
+    "technology", "colony", "market", "law", "war", "culture", "science", "agriculture", "protest", "state",
+    "energy", "population", "city", "river", "credit", "printing", "railroad", "famine", "alliance", "suffrage",
+)
+
+def load_app():
+    # The app's file name is not importable with a plain import statement
+    spec = importlib.util.spec_from_file_location("st_qc_frqs", APP_PATH)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+def synthetic_frame(rows, seed=0):
+    # Distinct questions, so neither the response cache nor duplicate detection can shortcut the run
+    rng = np.random.default_rng(seed)
+    words = np.array(WORDS)[rng.integers(0, len(WORDS), (rows, 4))]
+    return pd.DataFrame({
+        "QUESTION": [f"Explain how {a} and {b} shaped {c} between periods {i % 7 + 1} and {i % 7 + 2}, "
+                     f"and evaluate the role of {d} (case {i})." for i, (a, b, c, d) in enumerate(words)],
+        "LESSON_PLAN": [f"Unit {i % 9 + 1}: causation and continuity in {c}." for i, (_, _, c, _) in enumerate(words)],
+    })
+
+def synthetic_csv(rows, directory, seed=0):
+    path = os.path.join(directory, f"synthetic-{rows}.csv")
+    if not os.path.exists(path):
+        synthetic_frame(rows, seed).to_csv(path, index=False)
+    return path
+
+def peak_memory_mb():
+    # Peak resident set size of this process; the Python heap peak where getrusage is unavailable
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def percentiles(values):
+    if not values:
+        return {p: None for p in PERCENTILES}
+    return dict(zip(PERCENTILES, (float(v) for v in np.percentile(values, PERCENTILES))))
+
+class NullProgress:
+    def progress(self, value):
+        pass
+
+def time_calls(app, latencies):
+    # Record the wall time of every call_claude_api / async_call_claude_api,
+    # including queueing for the concurrency controller, retries and re-asks
+    call, async_call = app.call_claude_api, app.async_call_claude_api
+
+    def timed_call(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    async def timed_async_call(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await async_call(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    app.call_claude_api, app.async_call_claude_api = timed_call, timed_async_call
+
+def time_rows(evaluate, latencies):
+    # Wrap an EVALUATION_BACKENDS entry to record each row's time from admission to being yielded
+    def timed_evaluate(rows, *args):
+        admitted = {}
+
+        def admit():
+            for index, row_data in rows:
+                admitted[index] = time.perf_counter()
+                yield index, row_data
+
+        for item in evaluate(admit(), *args):
+            latencies.append(time.perf_counter() - admitted.pop(item[0]))
+            yield item
+    return timed_evaluate
+
+def run_case(backend, csv_path, args):
+    # Runs in a fresh process: load the app, evaluate the CSV and return the measurements
+    if resource is None:
+        tracemalloc.start()
+    app = load_app()
+    app.get_response_cache().bypass = True
+    # Rate budgets are effectively unlimited and the adaptive limit starts
+    # at its ceiling, so only the pipeline itself is measured
+    app.configure_concurrency("mock-key", args.concurrency, rpm=10**9, tpm=10**12, initial=args.concurrency)
+    call_latencies, row_latencies = [], []
+    time_calls(app, call_latencies)
+    prompt_states, edited_prompts = app.default_prompts()
+
+    df = pd.read_csv(csv_path)
+    started = time.perf_counter()
+    if backend == ROW_BACKEND:
+        # One row at a time, as the text input path evaluates questions
+        for index, row in df.iterrows():
+            row_started = time.perf_counter()
+            app.store_row_result(df, index, app.process_row(row.tolist()[:2], "mock-key", prompt_states, edited_prompts), [])
+            row_latencies.append(time.perf_counter() - row_started)
+    else:
+        app.EVALUATION_BACKENDS[backend] = time_rows(app.EVALUATION_BACKENDS[backend], row_latencies)
+        app.process_csv(df, "mock-key", 0, len(df) - 1, NullProgress(), None, None, prompt_states, edited_prompts,
+                        args.concurrency, args.rows_in_flight, backend=backend)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "backend": backend,
+        "rows": len(df),
+        "seconds": elapsed,
+        "rows_per_second": len(df) / elapsed,
+        "calls": len(call_latencies),
+        "call_latency": percentiles(call_latencies),
+        "row_latency": percentiles(row_latencies),
+        "failed_rows": int((df["Final_Evaluation"] == "No response received").sum()),
+        "peak_memory_mb": peak_memory_mb(),
+    }
+
+def format_latency(latency):
+    return "/".join("-" if latency[p] is None else f"{latency[p] * 1000:.0f}" for p in PERCENTILES)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 200], help="synthetic CSV sizes to run")
+    parser.add_argument("--concurrency", type=int, default=64, help="maximum API calls in flight")
+    parser.add_argument("--rows-in-flight", type=int, default=64)
+    parser.add_argument("--backends", nargs="+", default=["thread", "async"],
+                        help=f"EVALUATION_BACKENDS entries, or {ROW_BACKEND} for one row at a time")
+    parser.add_argument("--output", help="append one JSON line per run to this file")
+    add_mock_arguments(parser, latency=0.2)
+    args = parser.parse_args()
+
+    server = start_mock_server(latency=args.latency, **mock_options(args))
+    os.environ["ANTHROPIC_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["FRQ_STATE_DIR"] = tempfile.mkdtemp(prefix="frq-bench-")
+
+    print(f"{'backend':>11} {'rows':>7} {'seconds':>8} {'rows/s':>8} {'calls':>7} "
+          f"{'call p50/95/99 ms':>18} {'row p50/95/99 ms':>18} {'429/529':>9} {'failed':>6} {'peak MB':>8}")
+    spawn = multiprocessing.get_context("spawn")
+    for rows in args.rows:
+        csv_path = synthetic_csv(rows, os.environ["FRQ_STATE_DIR"], args.seed or 0)
+        for backend in args.backends:
+            errors_before = dict(server.errors_injected)
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                result = executor.submit(run_case, backend, csv_path, args).result()
+            result["errors_injected"] = {status: count - errors_before[status] for status, count in server.errors_injected.items()}
+            print(f"{backend:>11} {rows:>7} {result['seconds']:>8.2f} {result['rows_per_second']:>8.1f} {result['calls']:>7} "
+                  f"{format_latency(result['call_latency']):>18} {format_latency(result['row_latency']):>18} "
+                  f"{result['errors_injected'][429]:>4}/{result['errors_injected'][529]:<4} "
+                  f"{result['failed_rows']:>6} {result['peak_memory_mb']:>8.1f}")
+            if args.output:
+                with open(args.output, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(dict(result, settings=vars(args))) + "\n")
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
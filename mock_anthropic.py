@@ -0,0 +1,320 @@
+"""Local stand-in for the Anthropic /v1/messages and Message Batches endpoints.
+
+Answers every request with a canned evaluation after a simulated delay, so the
+evaluation backends and batch mode can be exercised and benchmarked without
+spending real API credits. Requests with "stream": true get the reply as
+server-sent events, a few characters per delta. Latency can follow a
+distribution, a fraction of requests can be answered with 429 or 529 errors,
+and the canned replies and usage can be replaced from a JSON file:
+
+    python mock_anthropic.py --port 8080 --latency 0.5
+    python mock_anthropic.py --latency 0.5 --latency-distribution lognormal --rate-limit-rate 0.05 --overload-rate 0.02
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8080 streamlit run st-qc-frqs.py
+"""
+import argparse
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+STREAM_CHUNK_CHARS = 16
+
+STAGE_RESPONSE = {
+    "score": 1,
+    "rationale": "The question is clear and complete.\nIt states a single, well-defined task.",
+    "feedback": "No changes needed.\nConsider adding a stimulus for variety.",
+}
+DIFFICULTY_RESPONSE = {
+    "difficulty": "Moderate",
+    "question_type": "Explain",
+    "grade_level": "AP",
+    "rationale": "The task requires applying and analyzing concepts.\nThis matches AP-level cognitive demand.",
+}
+FINAL_RESPONSE = {
+    "sum_score": 2,
+    "final_score": 1,
+    "rationale": "Both scored evaluations passed.\nThe question meets AP standards.",
+    "feedback": "Ready for inclusion.\nKeep the task verb explicit.",
+    "key_strengths": ["Clear task verb", "Strong curriculum alignment"],
+    "key_weaknesses": ["Limited stimulus material", "Single skill assessed"],
+}
+
+CANNED_RESPONSES = {"stage": STAGE_RESPONSE, "difficulty": DIFFICULTY_RESPONSE, "final": FINAL_RESPONSE}
+
+# Each sampler takes (rng, latency, spread) and returns seconds; latency is the
+# fixed value, the midpoint (uniform), the mean (exponential) or the median (lognormal)
+LATENCY_DISTRIBUTIONS = {
+    "fixed": lambda rng, latency, spread: latency,
+    "uniform": lambda rng, latency, spread: rng.uniform(latency * max(0.0, 1 - spread), latency * (1 + spread)),
+    "exponential": lambda rng, latency, spread: rng.expovariate(1 / latency) if latency > 0 else 0.0,
+    "lognormal": lambda rng, latency, spread: latency * rng.lognormvariate(0, spread),
+}
+
+def response_kind(payload):
+    # Pick the response shape the prompt asks for
+    text = json.dumps(payload)
+    if "sum_score" in text:
+        return "final"
+    if "grade_level" in text:
+        return "difficulty"
+    return "stage"
+
+def load_responses(path):
+    """Read canned replies from a JSON file keyed by "stage", "difficulty" and "final".
+
+    Each value is either a JSON object (sent pretty-printed, like the defaults) or
+    a string sent verbatim, e.g. to exercise malformed replies. An optional
+    "usage" object overrides fields of the computed usage.
+    """
+    with open(path, encoding="utf-8") as f:
+        responses = json.load(f)
+    unknown = set(responses) - set(CANNED_RESPONSES) - {"usage"}
+    if unknown:
+        raise ValueError(f"unknown response keys: {', '.join(sorted(unknown))}")
+    return responses
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0, batch_latency=1.0, latency_distribution="fixed", latency_spread=0.5,
+                 rate_limit_rate=0.0, overload_rate=0.0, retry_after=1.0, responses=None, seed=None):
+        super().__init__(address, MockAnthropicHandler)
+        self.latency = latency
+        self.latency_distribution = LATENCY_DISTRIBUTIONS[latency_distribution]
+        self.latency_spread = latency_spread
+        self.rate_limit_rate = rate_limit_rate
+        self.overload_rate = overload_rate
+        self.retry_after = retry_after
+        self.responses = dict(CANNED_RESPONSES, **(responses or {}))
+        self.batch_latency = batch_latency
+        self.requests_served = 0
+        self.errors_injected = {429: 0, 529: 0}
+        self.batches = {}
+        self.cached_prefixes = set()
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading a stream early reset the connection; that is expected
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def next_id(self):
+        with self._lock:
+            self.requests_served += 1
+            return self.requests_served
+
+    def sample_latency(self):
+        with self._lock:
+            return self.latency_distribution(self._rng, self.latency, self.latency_spread)
+
+    def injected_error(self):
+        # Status code to fail this request with, or None to answer it
+        with self._lock:
+            draw = self._rng.random()
+            if draw < self.rate_limit_rate:
+                status = 429
+            elif draw < self.rate_limit_rate + self.overload_rate:
+                status = 529
+            else:
+                return None
+            self.errors_injected[status] += 1
+            return status
+
+    def usage(self, payload, text):
+        # Mimic prompt caching: the first request with a cache_control system
+        # block writes the prefix, later identical prefixes read it
+        prefix = "".join(block["text"] for block in payload.get("system") or [] if block.get("cache_control"))
+        prefix_tokens = len(prefix) // 4
+        with self._lock:
+            cached = prefix in self.cached_prefixes
+            self.cached_prefixes.add(prefix)
+        usage = {
+            "input_tokens": len(json.dumps(payload.get("messages"))) // 4,
+            "cache_creation_input_tokens": 0 if cached or not prefix else prefix_tokens,
+            "cache_read_input_tokens": prefix_tokens if cached and prefix else 0,
+            "output_tokens": len(text) // 4,
+        }
+        usage.update(self.responses.get("usage") or {})
+        return usage
+
+    def message(self, payload):
+        response = self.responses[response_kind(payload)]
+        text = response if isinstance(response, str) else json.dumps(response, indent=2)
+        return {
+            "id": f"msg_mock_{self.next_id()}",
+            "type": "message",
+            "role": "assistant",
+            "model": payload.get("model"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": self.usage(payload, text),
+        }
+
+class MockAnthropicHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this, Nagle's
+        # algorithm and delayed ACKs add ~40ms to every keep-alive response
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event_stream(self, message):
+        # Replay a complete message as the Messages API's event sequence, using chunked encoding
+        text = message["content"][0]["text"]
+        usage = message["usage"]
+        start = dict(message, content=[], stop_reason=None, usage=dict(usage, output_tokens=1))
+        events = [
+            ("message_start", {"type": "message_start", "message": start}),
+            ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+        ]
+        for i in range(0, len(text), STREAM_CHUNK_CHARS):
+            delta = {"type": "text_delta", "text": text[i:i + STREAM_CHUNK_CHARS]}
+            events.append(("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": delta}))
+        events += [
+            ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": usage["output_tokens"]}}),
+            ("message_stop", {"type": "message_stop"}),
+        ]
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        try:
+            for name, data in events:
+                chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early
+            self.close_connection = True
+
+    def send_injected_error(self, status):
+        # Errors shaped like the real API's; retry-after drives the client's backoff
+        error_type = "rate_limit_error" if status == 429 else "overloaded_error"
+        headers = {"retry-after": f"{self.server.retry_after:g}"} if status == 429 else {}
+        self.send_json(status, {"type": "error", "error": {"type": error_type, "message": "Injected by mock server"}}, headers)
+
+    def send_not_found(self):
+        self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    def batch_object(self, batch_id):
+        batch = self.server.batches[batch_id]
+        ended = time.time() - batch["created"] >= self.server.batch_latency
+        count = len(batch["requests"])
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else count, "succeeded": count if ended else 0,
+                               "errored": 0, "canceled": 0, "expired": 0},
+            "results_url": f"http://{self.headers['Host']}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/v1/messages":
+            status = self.server.injected_error()
+            if status is not None:
+                self.send_injected_error(status)
+                return
+            time.sleep(self.server.sample_latency())
+            if payload.get("stream"):
+                self.send_event_stream(self.server.message(payload))
+            else:
+                self.send_json(200, self.server.message(payload))
+        elif self.path == "/v1/messages/batches":
+            batch_id = f"msgbatch_mock_{self.server.next_id()}"
+            self.server.batches[batch_id] = {"created": time.time(), "requests": payload["requests"]}
+            self.send_json(200, self.batch_object(batch_id))
+        else:
+            self.send_not_found()
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) < 4 or parts[3] not in self.server.batches:
+            self.send_not_found()
+        elif len(parts) == 4:
+            self.send_json(200, self.batch_object(parts[3]))
+        elif parts[4:] == ["results"] and self.batch_object(parts[3])["processing_status"] == "ended":
+            lines = [
+                json.dumps({"custom_id": request["custom_id"],
+                            "result": {"type": "succeeded", "message": self.server.message(request["params"])}})
+                for request in self.server.batches[parts[3]]["requests"]
+            ]
+            data = "\n".join(lines).encode("utf-8")
+            self.send_response(200)
+            self.send_header("content-type", "application/binary")
+            self.send_header("content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_not_found()
+
+def start_mock_server(port=0, latency=0.0, host="127.0.0.1", batch_latency=1.0, **options):
+    # Serve in a background thread; port 0 picks a free port (see server.server_address).
+    # options are passed on to MockServer (latency distribution, error injection, responses).
+    server = MockServer((host, port), latency, batch_latency, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_mock_arguments(parser, latency=0.5):
+    # Server behaviour options, shared with benchmark.py
+    parser.add_argument("--latency", type=float, default=latency, help="seconds to wait before answering each request (see --latency-distribution)")
+    parser.add_argument("--latency-distribution", choices=sorted(LATENCY_DISTRIBUTIONS), default="fixed",
+                        help="fixed, uniform around --latency, exponential with mean --latency or lognormal with median --latency")
+    parser.add_argument("--latency-spread", type=float, default=0.5, help="relative width (uniform) or sigma (lognormal) of the latency distribution")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of message requests answered with 429")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="fraction of message requests answered with 529")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with injected 429s")
+    parser.add_argument("--responses", help="JSON file with canned replies and usage (see load_responses)")
+    parser.add_argument("--seed", type=int, help="seed for sampled latencies and injected errors")
+
+def mock_options(args):
+    return {
+        "latency_distribution": args.latency_distribution,
+        "latency_spread": args.latency_spread,
+        "rate_limit_rate": args.rate_limit_rate,
+        "overload_rate": args.overload_rate,
+        "retry_after": args.retry_after,
+        "responses": load_responses(args.responses) if args.responses else None,
+        "seed": args.seed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_mock_arguments(parser)
+    parser.add_argument("--batch-latency", type=float, default=10.0, help="seconds before a submitted message batch ends")
+    args = parser.parse_args()
+
+    server = MockServer((args.host, args.port), args.latency, args.batch_latency, **mock_options(args))
+    print(f"Mock Anthropic API listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,120 @@ import requests
 import json
 import time
 import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import Counter, deque
+import io
+import argparse
+import signal
+import sys
 from streamlit_lottie import st_lottie
 from streamlit_extras.add_vertical_space import add_vertical_space
 import threading
+import asyncio
+import queue
+import aiohttp
+import hashlib
+import os
+import sqlite3
+import re
+import random
+import functools
+import unicodedata
+import zlib
+import socket
+import uuid
+import multiprocessing
+import numpy as np
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
 
 # Constants
-API_URL = "https://api.anthropic.com/v1/messages"
+API_BASE_URL = os.environ.get("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+API_URL = API_BASE_URL + "/v1/messages"
+BATCHES_URL = API_BASE_URL + "/v1/messages/batches"
+MODEL = "claude-3-5-sonnet-20240620"
+FAST_MODEL = "claude-3-haiku-20240307"
+MODEL_CHOICES = (MODEL, FAST_MODEL)
+TEMPERATURE = 0.6
+MAX_TOKENS = 8192
+STREAM_RESPONSES = True
+LIVE_REFRESH_SECONDS = 0.2
+# Output budget per schema field type, plus braces, keys and whitespace
+FIELD_TOKEN_BUDGETS = {int: 8, str: 160, list: 240}
+SCHEMA_TOKEN_OVERHEAD = 64
+MAX_WORKERS = 7
+MAX_ROWS_IN_FLIGHT = 16
+# Finished rows held back until every row before them is done, so results come out in input order
+MAX_ROWS_BUFFERED = 1024
+CLI_CHUNK_ROWS = 1000
+CLI_FLUSH_ROWS = 50
+CLI_FLUSH_SECONDS = 5
+STATE_DIR = os.environ.get("FRQ_STATE_DIR", ".frq_state")
+CACHE_PATH = os.path.join(STATE_DIR, "response_cache.sqlite3")
+CACHE_MAX_ENTRIES = 50000
+CACHE_MAX_AGE_DAYS = 30
+REQUEST_TIMEOUT = (10, 600)
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+MAX_REASKS = 2
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+# Requests- and tokens-per-minute caps; None leaves the budget to the
+# organization's limits, learned from the anthropic-ratelimit-*-limit headers
+RPM_LIMIT = None
+TPM_LIMIT = None
+CHARS_PER_TOKEN = 4
+OUTPUT_TOKENS_ESTIMATE = 400
+LATENCY_TOLERANCE = 2.0
+# Weight of each new latency in the recent average, and in the slower-moving baseline it is compared to
+LATENCY_WEIGHT = 0.2
+BASELINE_WEIGHT = 0.02
+JOURNAL_DIR = os.path.join(STATE_DIR, "journals")
+EXPORT_DIR = os.path.join(STATE_DIR, "exports")
+EXPORT_REFRESH_SECONDS = 10
+EXPORT_REFRESH_ROWS = 200
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "JSONL": ("jsonl", "application/jsonl"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+BATCH_STATE_DIR = os.path.join(STATE_DIR, "batches")
+BATCH_MAX_REQUESTS = 100000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+BATCH_POLL_INTERVAL = 30
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 16
+SHINGLE_WORDS = 2
+NEAR_DUPLICATE_THRESHOLD = 0.7
+NEAR_DUPLICATE_LIMIT = 5
+METRICS_PATH = os.path.join(STATE_DIR, "metrics.prom")
+METRICS_REFRESH_SECONDS = 1
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+LATENCY_WINDOW = 1000
+# Usage block fields the API reports per response
+USAGE_FIELDS = ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens", "output_tokens")
+# USD per million tokens, (input, output); cache writes and reads are priced relative to input
+MODEL_PRICES = {
+    MODEL: (3.00, 15.00),
+    FAST_MODEL: (0.25, 1.25),
+}
+# Shortest system prefix each model will cache; shorter prefixes are billed as plain input
+MIN_CACHEABLE_TOKENS = {
+    MODEL: 1024,
+    FAST_MODEL: 2048,
+}
+CACHE_WRITE_PRICE_FACTOR = 1.25
+CACHE_READ_PRICE_FACTOR = 0.1
+BATCH_PRICE_FACTOR = 0.5
+JOB_POLL_SECONDS = 1
+JOB_MESSAGE_LIMIT = 50
+QUEUE_PATH = os.environ.get("FRQ_QUEUE_PATH", os.path.join(STATE_DIR, "work_queue.sqlite3"))
+LEASE_SECONDS = 300
+MAX_TASK_ATTEMPTS = 3
+QUEUE_POLL_SECONDS = 5
+QUEUE_CLAIM_ROWS = 8
 
 # Helper functions
 def load_lottie_url(url: str):
@@ -20,33 +126,943 @@ def load_lottie_url(url: str):
         return None
     return r.json()
 
-def call_claude_api(prompt, api_key):
+class ResponseCache:
+    """On-disk cache of API responses, keyed by a hash of the full request.
+
+    Entries older than max_age_days are dropped, and the least recently used
+    entries are evicted once the cache grows past max_entries. With bypass set,
+    lookups always miss but fresh responses are still stored; get() can be told
+    to bypass per call, so a run's choice does not depend on this shared flag.
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES, max_age_days=CACHE_MAX_AGE_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.bypass = False
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    @staticmethod
+    def make_key(model, temperature, max_tokens, prompt):
+        blob = json.dumps([model, temperature, max_tokens, prompt], ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key, bypass=None):
+        if self.bypass if bypass is None else bypass:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created >= ?",
+                (key, time.time() - self.max_age_days * 86400),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._evict()
+
+    def _evict(self):
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_days * 86400,))
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def evict(self):
+        with self._lock, self._conn:
+            self._evict()
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+# Process-wide objects are cached resources rather than module globals: Streamlit
+# re-executes this script on every rerun, and background jobs started by an
+# earlier run must keep sharing them with the sessions that monitor them
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(CACHE_PATH)
+
+_http_session = None
+_http_pool_size = 0
+_http_session_lock = threading.Lock()
+
+def get_http_session(pool_size=MAX_WORKERS):
+    # One keep-alive connection pool shared by every worker thread. Requests
+    # never touch session state (headers are passed per call), so sharing the
+    # session across threads is safe; it is rebuilt only to grow the pool.
+    global _http_session, _http_pool_size
+    with _http_session_lock:
+        if _http_session is None or pool_size > _http_pool_size:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session, _http_pool_size = session, pool_size
+        return _http_session
+
+def parse_reset_time(value):
+    # anthropic-ratelimit-*-reset headers are RFC 3339 timestamps
+    try:
+        reset = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    return max(0.0, (reset - datetime.now(timezone.utc)).total_seconds())
+
+def retry_delay(headers, attempt):
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+
+    # Wait for whichever exhausted rate limit resets last
+    delays = []
+    for limit in ("requests", "tokens", "input-tokens", "output-tokens"):
+        if headers.get(f"anthropic-ratelimit-{limit}-remaining") == "0":
+            delay = parse_reset_time(headers.get(f"anthropic-ratelimit-{limit}-reset"))
+            if delay is not None:
+                delays.append(delay)
+    if delays:
+        return min(max(delays) + random.uniform(0, RETRY_BASE_DELAY), RETRY_MAX_DELAY)
+
+    # Full-jitter exponential backoff
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute, holding at most one minute's budget.
+
+    A rate of None means no budget is known: nothing ever waits, and capacity,
+    tokens and used() are None until set_rate gives the bucket a rate.
+    """
+
+    def __init__(self, rate_per_minute=None):
+        self.capacity = None
+        self.tokens = None
+        self._rate = None
+        self._updated = time.monotonic()
+        self.set_rate(rate_per_minute)
+
+    def set_rate(self, rate_per_minute):
+        # Change the budget in place; tokens already taken stay taken, and a bucket that had no budget starts full
+        self._refill()
+        if rate_per_minute is None:
+            self.capacity = self.tokens = self._rate = None
+            return
+        used = 0.0 if self.capacity is None else self.capacity - self.tokens
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity - used
+        self._rate = self.capacity / 60.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def delay(self, amount):
+        # Seconds until amount can be taken; requests larger than the bucket wait for a full bucket
+        if self.capacity is None:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self._rate
+
+    def take(self, amount):
+        if self.capacity is None:
+            return
+        self._refill()
+        self.tokens -= amount
+
+    def drain(self, remaining):
+        # Never hold more than the server says is left
+        if self.capacity is not None:
+            self._refill()
+            self.tokens = min(self.tokens, float(remaining))
+
+    def used(self):
+        if self.capacity is None:
+            return None
+        self._refill()
+        return max(0.0, self.capacity - self.tokens)
+
+class ConcurrencyController:
+    """AIMD limit on in-flight API requests, plus requests- and tokens-per-minute budgets.
+
+    Every successful response raises the limit by 1/limit (about +1 per round
+    trip). A 429/529, or recent latency drifting past LATENCY_TOLERANCE times
+    its baseline, halves it, at most once per round trip. Latency is tracked
+    per stage and model, as a recent average and a slower-moving baseline, so
+    ordinary spread between calls and between stages is not mistaken for
+    drift, and the baseline follows lasting changes. The
+    anthropic-ratelimit-*-limit headers set the per-minute budgets, capped by
+    rpm and tpm when those are given; until a response carries them, only
+    the caps (if any) apply. The *-remaining headers cap the limit and drain
+    the local buckets so they never run ahead of the server's view.
+    """
+
+    def __init__(self, max_limit=MAX_CONCURRENCY, rpm=RPM_LIMIT, tpm=TPM_LIMIT, initial=MAX_WORKERS, min_limit=MIN_CONCURRENCY):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_flight = 0
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.caps = {"requests": rpm, "tokens": tpm}
+        self.server_limits = {"requests": None, "tokens": None}
+        self.latency = None
+        self.latencies = {}
+        self.throttled = 0
+        self.settings = (max_limit, rpm, tpm)
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self, tokens):
+        # Returns 0 once a slot and budget are reserved, otherwise seconds to wait
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return 0.05
+            delay = max(self.requests.delay(1), self.tokens.delay(tokens))
+            if delay > 0:
+                return delay
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            return 0.0
+
+    def acquire(self, tokens):
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay == 0:
+                return
+            with self._cond:
+                self._cond.wait(delay)
+
+    def release(self, status, latency, headers=None, tokens_reserved=0, tokens_used=None, latency_key=None):
+        # latency_key groups calls whose latencies are comparable, e.g. (stage, model)
+        headers = headers or {}
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if tokens_used is not None:
+                self.tokens.take(tokens_used - tokens_reserved)
+
+            if status in (429, 529):
+                self.throttled += 1
+                self._decrease(now)
+            elif status == 200:
+                self.latency = latency if self.latency is None else self.latency + LATENCY_WEIGHT * (latency - self.latency)
+                recent, baseline = self._track_latency(latency_key, latency)
+                if recent > LATENCY_TOLERANCE * baseline:
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+            server_limits = {
+                "requests": headers.get("anthropic-ratelimit-requests-limit"),
+                "tokens": headers.get("anthropic-ratelimit-tokens-limit") or headers.get("anthropic-ratelimit-input-tokens-limit"),
+            }
+            for kind, value in server_limits.items():
+                if value is not None and value.isdigit() and int(value) != self.server_limits[kind]:
+                    self.server_limits[kind] = int(value)
+                    self._apply_budget(kind)
+            remaining = headers.get("anthropic-ratelimit-requests-remaining")
+            if remaining is not None and remaining.isdigit():
+                self.limit = max(self.min_limit, min(self.limit, self.in_flight + int(remaining)))
+                self.requests.drain(remaining)
+            remaining = headers.get("anthropic-ratelimit-tokens-remaining") or headers.get("anthropic-ratelimit-input-tokens-remaining")
+            if remaining is not None and remaining.isdigit():
+                self.tokens.drain(remaining)
+            self._cond.notify_all()
+
+    def _apply_budget(self, kind):
+        # The tighter of the configured cap and the server's limit; None while neither is known
+        limits = [limit for limit in (self.caps[kind], self.server_limits[kind]) if limit is not None]
+        (self.requests if kind == "requests" else self.tokens).set_rate(min(limits) if limits else None)
+
+    def reconfigure(self, max_limit, rpm, tpm, initial=None):
+        # New ceiling and budgets for the live controller: requests in flight
+        # and the latency baselines are kept, and so is the learned limit unless initial is given
+        with self._cond:
+            self.max_limit = max_limit
+            self.limit = float(max(self.min_limit, min(self.limit if initial is None else initial, max_limit)))
+            self.settings = (max_limit, rpm, tpm)
+            self.caps = {"requests": rpm, "tokens": tpm}
+            self._apply_budget("requests")
+            self._apply_budget("tokens")
+            self._cond.notify_all()
+
+    def _track_latency(self, key, latency):
+        # Both averages start as plain means, so the first few calls do not set the baseline on their own
+        count, recent, baseline = self.latencies.get(key, (0, latency, latency))
+        count += 1
+        recent += max(LATENCY_WEIGHT, 1.0 / count) * (latency - recent)
+        baseline += max(BASELINE_WEIGHT, 1.0 / count) * (latency - baseline)
+        self.latencies[key] = (count, recent, baseline)
+        return recent, baseline
+
+    def _decrease(self, now):
+        window = self.latency or 1.0
+        if now - self._last_decrease >= window:
+            self.limit = max(self.min_limit, self.limit / 2)
+            self._last_decrease = now
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "max_limit": self.max_limit,
+                "in_flight": self.in_flight,
+                "throttled": self.throttled,
+                "latency": self.latency,
+                "rpm_used": self.requests.used(),
+                "rpm_limit": self.requests.capacity,
+                "tpm_used": self.tokens.used(),
+                "tpm_limit": self.tokens.capacity,
+            }
+
+@st.cache_resource
+def key_concurrency_controller(key_digest):
+    return ConcurrencyController()
+
+def get_concurrency_controller(api_key):
+    # One controller per API key, shared by every session and job using that key: the
+    # limits it learns belong to the key's organization, and one key being throttled
+    # must not slow down the others. The cache is keyed by a digest of the key, not the key.
+    return key_concurrency_controller(hashlib.sha256((api_key or "").encode("utf-8")).hexdigest())
+
+def configure_concurrency(api_key, max_limit=MAX_CONCURRENCY, rpm=RPM_LIMIT, tpm=TPM_LIMIT, initial=None):
+    # Reconfiguring the key's controller keeps the accounting of requests already
+    # in flight, so jobs running on it never overshoot the limit.
+    # initial, if given, restarts the adaptive limit there instead of keeping the learned one.
+    controller = get_concurrency_controller(api_key)
+    controller.reconfigure(max_limit, rpm, tpm, initial)
+    return controller
+
+def new_call_record(stage, model, batch=False):
+    # One API call as seen by its caller: post_with_retries adds each HTTP
+    # attempt's status and usage, the caller sets outcome, re-asks and latency
+    return {"stage": stage or "unstaged", "model": model, "batch": batch, "outcome": None, "statuses": [],
+            "reasks": 0, "latency": None, **dict.fromkeys(USAGE_FIELDS, 0)}
+
+def note_attempt(record, status, usage=None):
+    # status is the HTTP status, or a short label when there was none ("error" for connection failures)
+    if record is None:
+        return
+    record["statuses"].append(status)
+    for field in USAGE_FIELDS:
+        record[field] += (usage or {}).get(field) or 0
+
+def call_cost(record):
+    input_price, output_price = MODEL_PRICES.get(record["model"], MODEL_PRICES[MODEL])
+    cost = (
+        record["input_tokens"] * input_price
+        + record["cache_creation_input_tokens"] * input_price * CACHE_WRITE_PRICE_FACTOR
+        + record["cache_read_input_tokens"] * input_price * CACHE_READ_PRICE_FACTOR
+        + record["output_tokens"] * output_price
+    ) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if record["batch"] else cost
+
+def row_usage(records):
+    # A row's tokens and estimated cost, summed over the call records its calls collected
+    usage = {field: sum(record[field] for record in records) for field in USAGE_FIELDS}
+    usage["cost"] = sum(call_cost(record) for record in records)
+    return usage
+
+class LatencyHistogram:
+    """Cumulative histogram over LATENCY_BUCKETS, plus the most recent samples for percentiles."""
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+def latency_percentiles(histograms, percentiles=(50, 95)):
+    samples = [seconds for histogram in histograms for seconds in histogram.recent]
+    if not samples:
+        return [None] * len(percentiles)
+    return [float(value) for value in np.percentile(samples, percentiles)]
+
+def prometheus_labels(**labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+class CallMetrics:
+    """Thread-safe roll-up of every API call and evaluated row in the current run.
+
+    call_claude_api and its async counterpart record one call record per call
+    (see new_call_record); the backends record when each row starts and
+    finishes. Only totals per stage and model and bounded latency histograms
+    are kept, so memory stays flat however long the run. snapshot() feeds the
+    metrics panel and prometheus_text() the metrics file.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.calls = Counter()      # (stage, model, outcome) -> calls
+            self.attempts = Counter()   # (stage, status) -> HTTP attempts
+            self.reasks = Counter()     # stage -> re-asks
+            self.tokens = Counter()     # (stage, model, usage field) -> tokens
+            self.cost = 0.0
+            self.call_latency = {}      # stage -> LatencyHistogram
+            self.row_latency = LatencyHistogram()
+            self.rows_started = 0
+            self.rows = 0
+
+    def record_call(self, record):
+        with self._lock:
+            stage, model = record["stage"], record["model"]
+            self.calls[stage, model, record["outcome"]] += 1
+            for status in record["statuses"]:
+                self.attempts[stage, str(status)] += 1
+            self.reasks[stage] += record["reasks"]
+            for field in USAGE_FIELDS:
+                self.tokens[stage, model, field] += record[field]
+            self.cost += call_cost(record)
+            if record["latency"] is not None and record["outcome"] != "cached":
+                self.call_latency.setdefault(stage, LatencyHistogram()).observe(record["latency"])
+
+    def row_started(self):
+        with self._lock:
+            self.rows_started += 1
+
+    def row_finished(self, latency=None):
+        with self._lock:
+            self.rows += 1
+            if latency is not None:
+                self.row_latency.observe(latency)
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            calls = sum(self.calls.values())
+            attempts = sum(self.attempts.values())
+            failed_attempts = sum(count for (_, status), count in self.attempts.items() if status != "200")
+            return {
+                "elapsed": elapsed,
+                "rows": self.rows,
+                "rows_in_flight": max(0, self.rows_started - self.rows),
+                "rows_per_second": self.rows / elapsed,
+                "calls": calls,
+                "calls_per_minute": calls * 60 / elapsed,
+                "attempts": attempts,
+                "failed_attempts": failed_attempts,
+                "error_rate": failed_attempts / attempts if attempts else 0.0,
+                "failed_calls": sum(count for (_, _, outcome), count in self.calls.items() if outcome in ("failed", "malformed")),
+                "reasks": sum(self.reasks.values()),
+                "tokens": {field: sum(count for (_, _, name), count in self.tokens.items() if name == field) for field in USAGE_FIELDS},
+                "cost": self.cost,
+                "cost_per_row": self.cost / self.rows if self.rows else None,
+                "call_latency": latency_percentiles(self.call_latency.values()),
+                "row_latency": latency_percentiles([self.row_latency]),
+            }
+
+    def token_summary(self):
+        with self._lock:
+            totals = {field: sum(count for (_, _, name), count in self.tokens.items() if name == field) for field in USAGE_FIELDS}
+            responses = sum(count for (_, status), count in self.attempts.items() if status == "200")
+        prompt_tokens = totals["input_tokens"] + totals["cache_creation_input_tokens"] + totals["cache_read_input_tokens"]
+        cached_share = totals["cache_read_input_tokens"] / prompt_tokens if prompt_tokens else 0.0
+        return (
+            f"Tokens over {responses} API responses: {prompt_tokens:,} input "
+            f"({totals['cache_read_input_tokens']:,} read from the prompt cache, {cached_share:.0%}; "
+            f"{totals['cache_creation_input_tokens']:,} written to it), {totals['output_tokens']:,} output"
+        )
+
+    def prometheus_text(self, stats=None):
+        # Prometheus text exposition format; stats, if given, adds the concurrency controller's gauges
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+        def histogram(name, help_text, histograms):
+            metric(name, "histogram", help_text, [])
+            for labels, hist in histograms:
+                for bound, count in [*zip(LATENCY_BUCKETS, hist.counts), ("+Inf", hist.count)]:
+                    lines.append(f"{name}_bucket{prometheus_labels(**labels, le=bound)} {count}")
+                lines.append(f"{name}_sum{prometheus_labels(**labels)} {hist.sum}")
+                lines.append(f"{name}_count{prometheus_labels(**labels)} {hist.count}")
+
+        with self._lock:
+            metric("frq_api_calls_total", "counter", "API calls by stage, model and outcome (ok, cached, malformed, failed).",
+                   [(prometheus_labels(stage=stage, model=model, outcome=outcome), count) for (stage, model, outcome), count in sorted(self.calls.items())])
+            metric("frq_api_attempts_total", "counter", "HTTP attempts by stage and status; attempts beyond one per call are retries.",
+                   [(prometheus_labels(stage=stage, status=status), count) for (stage, status), count in sorted(self.attempts.items())])
+            metric("frq_api_reasks_total", "counter", "Re-asks of malformed replies by stage.",
+                   [(prometheus_labels(stage=stage), count) for stage, count in sorted(self.reasks.items())])
+            metric("frq_api_tokens_total", "counter", "Tokens by stage, model and usage field.",
+                   [(prometheus_labels(stage=stage, model=model, kind=field.removesuffix("_tokens")), count)
+                    for (stage, model, field), count in sorted(self.tokens.items())])
+            histogram("frq_api_call_duration_seconds", "Wall time of API calls by stage, including queueing, retries and re-asks.",
+                      [({"stage": stage}, hist) for stage, hist in sorted(self.call_latency.items())])
+            histogram("frq_row_duration_seconds", "Wall time of evaluated rows.", [({}, self.row_latency)])
+            metric("frq_rows_total", "counter", "Rows evaluated.", [("", self.rows)])
+            metric("frq_rows_in_flight", "gauge", "Rows being evaluated.", [("", max(0, self.rows_started - self.rows))])
+            metric("frq_estimated_cost_dollars_total", "counter", "Estimated API cost in USD, from MODEL_PRICES.", [("", round(self.cost, 6))])
+            metric("frq_run_start_time_seconds", "gauge", "Unix time the current run started.", [("", self.started)])
+        if stats is not None:
+            metric("frq_api_in_flight", "gauge", "API requests in flight.", [("", stats["in_flight"])])
+            metric("frq_api_concurrency_limit", "gauge", "Current adaptive concurrency limit.", [("", stats["limit"])])
+            metric("frq_api_throttled_total", "counter", "429 and 529 responses seen by the concurrency controller.", [("", stats["throttled"])])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=METRICS_PATH, stats=None):
+        # Written to a temporary file and renamed, so a scraper never reads a partial file
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text(stats))
+        os.replace(temp_path, path)
+
+@st.cache_resource
+def get_call_metrics():
+    return CallMetrics()
+
+def prefix_cacheable(template, model):
+    # Whether template's static prefix (see split_prompt_template) is long enough for model to cache
+    system, _ = split_prompt_template(template)
+    return len(system) // CHARS_PER_TOKEN >= MIN_CACHEABLE_TOKENS.get(model, 0)
+
+def prompt_parts(prompt):
+    # Prompts are (system prefix, user message) pairs; a bare string has no prefix
+    return prompt if isinstance(prompt, tuple) else ("", prompt)
+
+def estimate_tokens(prompt, max_tokens=MAX_TOKENS):
+    return sum(len(part) for part in prompt_parts(prompt)) // CHARS_PER_TOKEN + min(max_tokens, OUTPUT_TOKENS_ESTIMATE)
+
+def schema_max_tokens(schema):
+    # A reply that only has to hold schema's fields needs far less than MAX_TOKENS
+    if schema is None:
+        return MAX_TOKENS
+    return min(MAX_TOKENS, SCHEMA_TOKEN_OVERHEAD + sum(FIELD_TOKEN_BUDGETS[kind] for kind, _ in schema.values()))
+
+def build_api_request(prompt, api_key, correction=None, max_tokens=MAX_TOKENS, stream=False, model=MODEL, temperature=TEMPERATURE):
+    # correction, if given, is (previous_text, problem): the rejected reply is
+    # sent back as the assistant turn with a request to fix just the format
+    system, user = prompt_parts(prompt)
     headers = {
         "x-api-key": api_key,
         "anthropic-version": "2023-06-01",
         "content-type": "application/json"
     }
     payload = {
-        "model": "claude-3-5-sonnet-20240620",
-        "max_tokens": 8192,
-        "temperature": 0.6,
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
         "messages": [
-            {"role": "user", "content": prompt}
+            {"role": "user", "content": user}
         ]
     }
+    if stream:
+        payload["stream"] = True
+    if system:
+        # The static prefix is identical across rows, so mark it for prompt caching
+        payload["system"] = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+    if correction is not None:
+        previous_text, problem = correction
+        payload["messages"] += [
+            {"role": "assistant", "content": previous_text.strip() or "(empty)"},
+            {"role": "user", "content": f"Your reply could not be used: {problem}. Return ONLY the JSON object with the required structure and no other text."},
+        ]
+    return headers, payload
 
-    response = requests.post(API_URL, headers=headers, json=payload)
-    if response.status_code == 200:
-        return response.json()['content'][0]['text']
-    else:
-        st.error(f"API call failed with status code: {response.status_code}")
-        st.error(f"Response: {response.text}")
+def usage_tokens(usage):
+    if not usage:
         return None
+    return usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+
+# Expected reply structure per prompt: field -> (type, allowed values or None)
+RESULT_SCHEMAS = {
+    "prompt1": {"score": (int, (0, 1)), "rationale": (str, None), "feedback": (str, None)},
+    "prompt2": {"score": (int, (0, 1)), "rationale": (str, None), "feedback": (str, None)},
+    "prompt3": {
+        "difficulty": (str, ("Easy", "Moderate", "Difficult")),
+        "question_type": (str, None),
+        "grade_level": (str, None),
+        "rationale": (str, None),
+    },
+    "final_prompt": {
+        "sum_score": (int, None),  # 0..MAX_SUM_SCORE, set once STAGES is defined
+        "final_score": (int, (0, 1)),
+        "rationale": (str, None),
+        "feedback": (str, None),
+        "key_strengths": (list, None),
+        "key_weaknesses": (list, None),
+    },
+}
 
-def parallel_api_calls(prompts, api_key):
+def extract_json_object(text):
+    """Return the first balanced {...} in text that parses as a JSON object.
+
+    Preambles, trailing commentary and code fences around the object are
+    ignored. Braces inside JSON strings are skipped, so a single scan finds
+    where the object ends. Returns None if no object parses.
+    """
+    start = text.find("{")
+    while start != -1:
+        depth, in_string, escaped = 0, False, False
+        for end in range(start, len(text)):
+            char = text[end]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    try:
+                        value = json.loads(text[start:end + 1])
+                    except json.JSONDecodeError:
+                        break
+                    if isinstance(value, dict):
+                        return value
+                    break
+        start = text.find("{", start + 1)
+    return None
+
+def parse_response(text, schema):
+    # Returns (result, None) with values coerced to the schema's types, or (None, problem)
+    if not text:
+        return None, "empty response"
+    value = extract_json_object(text)
+    if value is None:
+        return None, "no JSON object found"
+    result = {}
+    for field, (kind, allowed) in schema.items():
+        if field not in value:
+            return None, f"missing field '{field}'"
+        item = value[field]
+        if kind is int:
+            try:
+                if isinstance(item, bool) or float(item) != int(float(item)):
+                    raise ValueError
+                item = int(float(item))
+            except (TypeError, ValueError):
+                return None, f"'{field}' is not an integer"
+        elif kind is str:
+            if not isinstance(item, str):
+                return None, f"'{field}' is not a string"
+            item = item.strip()
+        elif kind is list:
+            if not isinstance(item, list):
+                return None, f"'{field}' is not a list"
+            item = [str(entry) for entry in item]
+        if allowed is not None:
+            matches = [option for option in allowed if str(option).lower() == str(item).lower()]
+            if not matches:
+                return None, f"'{field}' must be one of {', '.join(map(str, allowed))}"
+            item = matches[0]
+        result[field] = item
+    return result, None
+
+def is_valid_response(text, schema):
+    return schema is None or parse_response(text, schema)[1] is None
+
+class MessageStream:
+    """Accumulates a streamed Messages reply from its server-sent events.
+
+    feed() takes the stream one line at a time and returns True when the
+    caller should stop reading: on an error event or, with stop_at_object, when
+    the model keeps writing after the first top-level JSON object has closed.
+    A reply that simply ends after the object is read to message_stop, which
+    follows within a few events and keeps the connection reusable. on_text,
+    if given, is called with the text so far after every delta.
+    """
+
+    def __init__(self, on_text=None, stop_at_object=False):
+        self.on_text = on_text
+        self.stop_at_object = stop_at_object
+        self.text = ""
+        self.usage = {}
+        self.error = None
+        self.object_closed = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, line):
+        if not line.startswith("data:"):
+            return False
+        event = json.loads(line[5:])
+        kind = event.get("type")
+        if kind == "message_start":
+            self.usage.update(event["message"].get("usage") or {})
+        elif kind == "content_block_delta" and event["delta"].get("type") == "text_delta":
+            chunk = event["delta"]["text"]
+            if self.stop_at_object and self.object_closed and chunk.strip():
+                # Trailing commentary: the final usage event will not be read, so estimate the output
+                self.usage["output_tokens"] = max(self.usage.get("output_tokens") or 0, len(self.text) // CHARS_PER_TOKEN)
+                return True
+            self.text += chunk
+            if self.on_text is not None:
+                self.on_text(self.text)
+            if self.stop_at_object and not self.object_closed:
+                self._scan(chunk)
+        elif kind == "message_delta":
+            self.usage.update(event.get("usage") or {})
+        elif kind == "error":
+            self.error = event.get("error") or {}
+            return True
+        return False
+
+    def _scan(self, chunk):
+        # Same string-aware brace counting as extract_json_object, fed incrementally
+        for char in chunk:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"' and self._depth > 0:
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.object_closed = True
+                    return
+
+    def failure(self):
+        # (status to report to the concurrency controller, error description) for an error event
+        status = 529 if self.error.get("type") == "overloaded_error" else None
+        return status, f"stream error: {self.error.get('type')}: {self.error.get('message', '')}"[:200]
+
+def settle_attempt(controller, record, started, reserved, status=None, headers=None, body=None, reply=None, error_text="", exc=None):
+    # The decision shared by post_with_retries and async_post_with_retries once an attempt is over:
+    # release it with the concurrency controller, note it in record and return
+    # (text, None, False) for a usable reply or (None, error, retryable).
+    # body is a non-streamed 200 reply, reply a MessageStream and exc the exception that
+    # ended the attempt: a connection error, or a reply that could not be decoded.
+    elapsed = time.monotonic() - started
+    latency_key = (record["stage"], record["model"]) if record is not None else None
+    if exc is not None:
+        controller.release(None, elapsed, tokens_reserved=reserved)
+        note_attempt(record, "error")
+        return None, f"{type(exc).__name__}: {exc}", True
+    if status == 200 and reply is None:
+        try:
+            text = body['content'][0]['text']
+        except (KeyError, IndexError, TypeError):
+            controller.release(None, elapsed, headers, reserved)
+            note_attempt(record, "malformed")
+            return None, "response body has no text content", True
+        controller.release(200, elapsed, headers, reserved, usage_tokens(body.get("usage")), latency_key)
+        note_attempt(record, 200, body.get("usage"))
+        return text, None, False
+    if status == 200 and reply.error is None:
+        controller.release(200, elapsed, headers, reserved, usage_tokens(reply.usage), latency_key)
+        note_attempt(record, 200, reply.usage)
+        return reply.text, None, False
+    if status == 200:
+        status, error = reply.failure()
+        controller.release(status, elapsed, headers, reserved)
+        note_attempt(record, status or "stream_error")
+        return None, error, True
+    controller.release(status, elapsed, headers, reserved)
+    note_attempt(record, status)
+    return None, f"HTTP {status}: {error_text[:200]}", status in RETRYABLE_STATUS_CODES
+
+def give_up(failures, attempt, error, retryable):
+    # Note a failed attempt in failures; True when it is not worth another one
+    if failures is not None:
+        failures.append(f"attempt {attempt + 1}: {error}")
+    return not retryable or attempt == MAX_RETRIES
+
+def post_with_retries(headers, payload, reserved, failures=None, on_text=None, stop_at_object=False, record=None):
+    # POST one Messages request with backoff; returns the reply text or None.
+    # Streamed requests are read with MessageStream (see there for on_text and stop_at_object).
+    # record, if given, is a call record (see new_call_record) that every attempt is noted in.
+    # A reply that cannot be decoded is a failed attempt like a dropped connection.
+    controller = get_concurrency_controller(headers["x-api-key"])
+    session = get_http_session(controller.max_limit)
+    stream = payload.get("stream", False)
+    for attempt in range(MAX_RETRIES + 1):
+        controller.acquire(reserved)
+        started = time.monotonic()
+        reply = body = None
+        try:
+            response = session.post(API_URL, headers=headers, json=payload, timeout=REQUEST_TIMEOUT, stream=stream)
+            if response.status_code == 200 and stream:
+                reply = MessageStream(on_text, stop_at_object)
+                with response:
+                    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                        if reply.feed(line):
+                            break
+            elif response.status_code == 200:
+                body = response.json()
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, ValueError) as exc:
+            text, error, retryable = settle_attempt(controller, record, started, reserved, exc=exc)
+            retry_headers = {}
+        except BaseException:
+            # Anything else ends the call, but the slot it holds goes back first
+            controller.release(None, time.monotonic() - started, tokens_reserved=reserved)
+            raise
+        else:
+            status = response.status_code
+            text, error, retryable = settle_attempt(controller, record, started, reserved, status, response.headers,
+                                                    body, reply, response.text if status != 200 else "")
+            retry_headers = response.headers
+
+        if error is None:
+            return text
+        if give_up(failures, attempt, error, retryable):
+            st.error(f"API call failed after {attempt + 1} attempt(s): {error}")
+            return None
+        time.sleep(retry_delay(retry_headers, attempt))
+
+def build_stage_request(prompt, api_key, stage=None, correction=None, stream=False, settings=None):
+    # build_api_request with a stage's model, temperature and max_tokens (see stage_config).
+    # Without an explicit max_tokens the budget is sized to the stage's result schema;
+    # the first reply may have run out of it, so re-asks get the full MAX_TOKENS.
+    config = stage_config(stage, settings)
+    if correction is not None:
+        max_tokens = MAX_TOKENS
+    else:
+        max_tokens = config.get("max_tokens") or schema_max_tokens(RESULT_SCHEMAS.get(stage))
+    return build_api_request(prompt, api_key, correction, max_tokens, stream,
+                             config.get("model", MODEL), config.get("temperature", TEMPERATURE))
+
+def reask_request(prompt, text, api_key, stage, failures=None, record=None, settings=None):
+    # The re-ask decision shared by repair_response and async_repair_response: None when text
+    # is final (valid, or no reply at all), else the (headers, payload) that re-asks for it,
+    # showing the model its own reply and what was wrong with it
+    if text is None:
+        return None
+    _, problem = parse_response(text, RESULT_SCHEMAS[stage])
+    if problem is None:
+        return None
+    if failures is not None:
+        failures.append(f"malformed response: {problem}")
+    if record is not None:
+        record["reasks"] += 1
+    return build_stage_request(prompt, api_key, stage, correction=(text, problem), stream=STREAM_RESPONSES, settings=settings)
+
+def repair_response(prompt, text, api_key, stage, failures=None, on_text=None, record=None, settings=None):
+    # Re-ask only when text fails validation, up to MAX_REASKS times
+    for _ in range(MAX_REASKS):
+        request = reask_request(prompt, text, api_key, stage, failures, record, settings)
+        if request is None:
+            break
+        headers, payload = request
+        text = post_with_retries(headers, payload, estimate_tokens(prompt), failures, on_text, stop_at_object=True, record=record)
+    return text
+
+def finish_call(record, text, schema, started, calls=None):
+    # Set the call's outcome and latency and add it to the run's metrics,
+    # and to calls, the list of call records of the row it belongs to
+    if text is None:
+        record["outcome"] = "failed"
+    elif record["outcome"] is None:
+        record["outcome"] = "ok" if is_valid_response(text, schema) else "malformed"
+    record["latency"] = time.monotonic() - started
+    get_call_metrics().record_call(record)
+    if calls is not None:
+        calls.append(record)
+
+def call_claude_api(prompt, api_key, failures=None, stage=None, on_text=None, settings=None, calls=None):
+    # failures, if given, collects a description of every failed attempt, and
+    # calls the call record with its tokens (see new_call_record).
+    # stage (a STAGES key or "final_prompt") picks the model settings; when the
+    # stage has a result schema, reading stops once the JSON object closes and
+    # malformed replies are re-asked and never cached.
+    # on_text, if given, is called with the partial reply as it streams in.
+    # settings, if given, is a run_settings snapshot used instead of the current defaults.
+    started = time.monotonic()
+    schema = RESULT_SCHEMAS.get(stage)
+    headers, payload = build_stage_request(prompt, api_key, stage, stream=STREAM_RESPONSES, settings=settings)
+    record = new_call_record(stage, payload["model"])
+
+    cache = get_response_cache()
+    cache_key = cache.make_key(payload["model"], payload["temperature"], payload["max_tokens"], prompt)
+    cached = cache.get(cache_key, bypass_cache(settings))
+    if cached is not None and is_valid_response(cached, schema):
+        record["outcome"] = "cached"
+        finish_call(record, cached, schema, started, calls)
+        return cached
+
+    text = post_with_retries(headers, payload, estimate_tokens(prompt, payload["max_tokens"]), failures, on_text, schema is not None, record)
+    if schema is not None:
+        text = repair_response(prompt, text, api_key, stage, failures, on_text, record, settings)
+    if text is not None and is_valid_response(text, schema):
+        cache.put(cache_key, text)
+    finish_call(record, text, schema, started, calls)
+    return text
+
+def parallel_api_calls(prompts, api_key, failures=None, stages=None, on_text=None, settings=None, calls=None):
+    # Disabled prompts are passed as None and keep their slot in the result.
+    # stages names each slot's stage; on_text, if given, is called as
+    # on_text(slot, partial_text) while replies stream in.
+    stages = stages or [None] * len(prompts)
     responses = [None] * len(prompts)
-    with ThreadPoolExecutor(max_workers=7) as executor:
-        future_to_index = {executor.submit(call_claude_api, prompt, api_key): i for i, prompt in enumerate(prompts)}
+    with ThreadPoolExecutor(max_workers=get_concurrency_controller(api_key).max_limit) as executor:
+        future_to_index = {
+            executor.submit(call_claude_api, prompt, api_key, failures, stages[i], on_text and functools.partial(on_text, i), settings, calls): i
+            for i, prompt in enumerate(prompts) if prompt is not None
+        }
 
         for future in concurrent.futures.as_completed(future_to_index):
             index = future_to_index[future]
@@ -57,12 +1073,86 @@ def parallel_api_calls(prompts, api_key):
                 responses[index] = f"Error: {exc}"
 
     for i, response in enumerate(responses):
-        if response is None:
+        if response is None and prompts[i] is not None:
             st.warning(f"Warning: No response received for prompt {i}")
             responses[i] = "No response received"
 
     return responses
     
+async def async_post_with_retries(session, headers, payload, reserved, semaphore, failures=None, stop_at_object=False, record=None):
+    # asyncio counterpart of post_with_retries. It does not call st.error: it runs off the script
+    # thread, and failures (or the row's Last_Error) carry the reason instead.
+    controller = get_concurrency_controller(headers["x-api-key"])
+    stream = payload.get("stream", False)
+    for attempt in range(MAX_RETRIES + 1):
+        async with semaphore:
+            while (delay := controller.try_acquire(reserved)) > 0:
+                await asyncio.sleep(delay)
+            started = time.monotonic()
+            reply = body = None
+            error_text = ""
+            try:
+                async with session.post(API_URL, headers=headers, json=payload) as response:
+                    status, retry_headers = response.status, response.headers
+                    if status == 200 and stream:
+                        reply = MessageStream(stop_at_object=stop_at_object)
+                        async for line in response.content:
+                            if reply.feed(line.decode("utf-8").rstrip("\r\n")):
+                                break
+                    elif status == 200:
+                        body = await response.json(content_type=None)
+                    else:
+                        error_text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+                text, error, retryable = settle_attempt(controller, record, started, reserved, exc=exc)
+                retry_headers = {}
+            except BaseException:
+                # Including cancellation: the slot goes back before the task ends
+                controller.release(None, time.monotonic() - started, tokens_reserved=reserved)
+                raise
+            else:
+                text, error, retryable = settle_attempt(controller, record, started, reserved, status, retry_headers, body, reply, error_text)
+
+        if error is None:
+            return text
+        if give_up(failures, attempt, error, retryable):
+            return None
+        await asyncio.sleep(retry_delay(retry_headers, attempt))
+
+async def async_repair_response(session, prompt, text, api_key, stage, semaphore, failures=None, record=None, settings=None):
+    # asyncio counterpart of repair_response
+    for _ in range(MAX_REASKS):
+        request = reask_request(prompt, text, api_key, stage, failures, record, settings)
+        if request is None:
+            break
+        headers, payload = request
+        text = await async_post_with_retries(session, headers, payload, estimate_tokens(prompt), semaphore, failures, True, record)
+    return text
+
+async def async_call_claude_api(session, prompt, api_key, semaphore, failures=None, stage=None, settings=None, calls=None):
+    # asyncio counterpart of call_claude_api, sharing its cache, backoff, re-asks, metrics and concurrency controller
+    started = time.monotonic()
+    schema = RESULT_SCHEMAS.get(stage)
+    headers, payload = build_stage_request(prompt, api_key, stage, stream=STREAM_RESPONSES, settings=settings)
+    record = new_call_record(stage, payload["model"])
+
+    cache = get_response_cache()
+    cache_key = cache.make_key(payload["model"], payload["temperature"], payload["max_tokens"], prompt)
+    cached = cache.get(cache_key, bypass_cache(settings))
+    if cached is not None and is_valid_response(cached, schema):
+        record["outcome"] = "cached"
+        finish_call(record, cached, schema, started, calls)
+        return cached
+
+    reserved = estimate_tokens(prompt, payload["max_tokens"])
+    text = await async_post_with_retries(session, headers, payload, reserved, semaphore, failures, schema is not None, record)
+    if schema is not None:
+        text = await async_repair_response(session, prompt, text, api_key, stage, semaphore, failures, record, settings)
+    if text is not None and is_valid_response(text, schema):
+        cache.put(cache_key, text)
+    finish_call(record, text, schema, started, calls)
+    return text
+
 MULTI_SHOT_EXAMPLES = """{
   "questions": [
     {
@@ -101,8 +1191,6 @@ def generate_prompt1(QUESTION):
     return f"""
 You are the world's leading expert in AP assessment design across all subjects, with 30 years of experience in crafting unambiguous, high-quality questions. Your task is to evaluate the clarity and structure of the given AP Free Response Question (FRQ).
 
-FRQ to evaluate: {QUESTION}
-
 Multi-shot examples for reference:
 {MULTI_SHOT_EXAMPLES}
 
@@ -137,15 +1225,14 @@ Instructions:
    }}
 
 Attention: Strict adherence to JSON format is required. Any deviation will result in severe penalties. Your evaluation must reflect the highest standards in AP assessment design across all subjects.
+
+FRQ to evaluate: {QUESTION}
 """
 
 def generate_prompt2(QUESTION, LESSON_PLAN):
     return f"""
 As the foremost authority on AP curriculum development across all subjects, with 30 years of experience in aligning assessments with educational standards, your task is to evaluate the relevance and alignment of the given Free Response Question (FRQ) to AP curricula.
 
-FRQ to evaluate: {QUESTION}
-AP Lesson Plan: {LESSON_PLAN}
-
 Multi-shot examples for reference:
 {MULTI_SHOT_EXAMPLES}
 
@@ -177,14 +1264,15 @@ Instructions:
    }}
 
 Attention: Strict adherence to JSON format is required. Any deviation will result in severe penalties. Your evaluation must reflect the highest standards in AP curriculum alignment across all subjects.
+
+FRQ to evaluate: {QUESTION}
+AP Lesson Plan: {LESSON_PLAN}
 """
 
 def generate_prompt3(QUESTION):
     return f"""
 As a world-renowned cognitive psychologist and educational assessment expert with 30 years of experience across all academic disciplines, your task is to determine the difficulty, question type, and appropriate grade level for the given AP question.
 
-Question to evaluate: {QUESTION}
-
 Multi-shot examples for reference:
 {MULTI_SHOT_EXAMPLES}
 
@@ -221,20 +1309,18 @@ Instructions:
    }}
 
 Attention: Strict adherence to JSON format is required. Any deviation will result in severe penalties. Your assessment must reflect a nuanced understanding of cognitive demands across all AP subjects.
+
+Question to evaluate: {QUESTION}
 """
 
-def generate_final_prompt(QUESTION, PROMPT_RESULTS):
+def generate_final_prompt(QUESTION, PROMPT_RESULTS, MAX_SUM=2):
+    # MAX_SUM is the number of scored stages, each worth one point
     return f"""
 As the world's preeminent expert in AP assessment with 30 years of experience revolutionizing standardized testing across all subjects, your task is to provide the definitive evaluation of an AP question's suitability for inclusion in AP exams.
 
-Question to evaluate: {QUESTION}
-
-Previous evaluation results:
-{PROMPT_RESULTS}
-
 Instructions:
 1. Score Calculation:
-   Sum the scores from the prompts (excluding the difficulty/grade level prompt). The maximum sum is 2.
+   Sum the scores from the prompts (excluding the difficulty/grade level prompt). The maximum sum is {MAX_SUM}.
 
 2. Conduct a holistic review, examining all aspects of the question, previous evaluations, and the calculated sum score.
 
@@ -246,14 +1332,14 @@ Instructions:
    a. Overall quality and alignment with AP standards across subjects
    b. Balance of strengths and weaknesses
    c. Potential impact on student assessment and learning
-   d. The calculated sum score (out of 2)
-   e. Uniqueness and non-duplication of content
+   d. The calculated sum score (out of {MAX_SUM})
+   e. Uniqueness and non-duplication of content (use the duplicate check results, when given, as evidence)
    f. Appropriateness of question type for the content being tested
    g. Consistency with AP-level depth and complexity
 
 6. Scoring:
    Assign a final score of 1 if and based on the following conditions:
-   - The sum score is 2 out of 2 OR The only missing points are related to the explanation
+   - The sum score is {MAX_SUM} out of {MAX_SUM} OR The only missing points are related to the explanation
    - The question demonstrates exceptional quality and strong alignment with AP standards
    - Any identified weaknesses are minor and do not significantly impact the question's effectiveness
    - The question is unique and not duplicative of other content
@@ -263,7 +1349,7 @@ Instructions:
 
 7. Return ONLY a JSON object with this structure:
    {{
-     "sum_score": calculated sum (0-2),
+     "sum_score": calculated sum (0-{MAX_SUM}),
      "final_score": 0 or 1,
      "rationale": "Two-line explanation for your final scoring decision",
      "feedback": "Two-line actionable feedback for improvement or commendation",
@@ -280,69 +1366,1545 @@ Instructions:
    }}
 
 Attention: Strict adherence to JSON format is required. Any deviation will result in severe penalties. Your evaluation must reflect the highest standards in AP assessment across all subjects and provide clear insights for validating or improving AP exam questions.
+
+Question to evaluate: {QUESTION}
+
+Previous evaluation results:
+{PROMPT_RESULTS}
 """
-def process_row(row_data, api_key, prompt_states, edited_prompts):
-    QUESTION, LESSON_PLAN = row_data
-
-    def format_prompt(prompt_template, **kwargs):
-        for key, value in kwargs.items():
-            prompt_template = prompt_template.replace(f"{{{{{key}}}}}", str(value))
-        return prompt_template
-
-    prompts = [
-        format_prompt(edited_prompts['prompt1'], QUESTION=QUESTION) if prompt_states["prompt1"] else None,
-        format_prompt(edited_prompts['prompt2'], QUESTION=QUESTION, LESSON_PLAN=LESSON_PLAN) if prompt_states["prompt2"] else None,
-        format_prompt(edited_prompts['prompt3'], QUESTION=QUESTION) if prompt_states["prompt3"] else None,
-    ]
 
-    # Filter out None values (disabled prompts)
-    prompts = [p for p in prompts if p is not None]
+# The evaluation graph: every enabled stage prompt runs in parallel, then the
+# final prompt reads their results. Stage order sets the Evaluation_N column
+# numbers, and a stage needs a RESULT_SCHEMAS entry for its reply to be
+# validated. "scored" stages return a 0/1 "score" that counts toward the
+# final sum_score. A max_tokens of None sizes the budget to the schema.
+# Every stage runs on MODEL unless a run picks another one. prompt3 can be
+# moved to FAST_MODEL (sidebar, or --stage-model prompt3=...) to cut its cost:
+# its ~1.2k-token prefix is below Haiku's 2048-token caching minimum, so it is
+# then never cached, but uncached Haiku input costs less than a Sonnet cache read.
+STAGES = {
+    "prompt1": {"template": generate_prompt1("{{QUESTION}}"), "model": MODEL, "temperature": TEMPERATURE, "max_tokens": None, "scored": True},
+    "prompt2": {"template": generate_prompt2("{{QUESTION}}", "{{LESSON_PLAN}}"), "model": MODEL, "temperature": TEMPERATURE, "max_tokens": None, "scored": True},
+    "prompt3": {"template": generate_prompt3("{{QUESTION}}"), "model": MODEL, "temperature": TEMPERATURE, "max_tokens": None, "scored": False},
+}
+# Each scored stage adds at most one point to the final sum_score
+MAX_SUM_SCORE = sum(stage.get("scored", False) for stage in STAGES.values())
+RESULT_SCHEMAS["final_prompt"]["sum_score"] = (int, tuple(range(MAX_SUM_SCORE + 1)))
+# short_circuit lets FINAL_SHORT_CIRCUIT_RULES answer for the final prompt when the stage results already decide it
+FINAL_STAGE = {"template": generate_final_prompt("{{QUESTION}}", "{{PROMPT_RESULTS}}", MAX_SUM_SCORE), "model": MODEL, "temperature": TEMPERATURE, "max_tokens": None, "short_circuit": True}
+_stage_overrides = {}
+
+def stage_config(stage, settings=None):
+    # Settings of a STAGES key or "final_prompt", with the overrides of a
+    # run_settings snapshot, or else the defaults set by configure_stages
+    if stage is None:
+        return {}
+    base = FINAL_STAGE if stage == "final_prompt" else STAGES[stage]
+    overrides = _stage_overrides if settings is None else settings["stages"]
+    return {**base, **overrides.get(stage, {})}
+
+def configure_stages(overrides):
+    # overrides maps a stage key to the settings to replace, e.g. {"prompt3": {"model": FAST_MODEL}}.
+    # These are the process-wide defaults, for the CLI and workers; the UI passes run_settings instead.
+    global _stage_overrides
+    _stage_overrides = {stage: dict(settings) for stage, settings in overrides.items()}
+
+def stage_settings(overrides=None):
+    # Every stage's effective model settings, in the form configure_stages accepts.
+    # overrides, if given, replaces the configure_stages defaults.
+    settings = None if overrides is None else {"stages": overrides}
+    return {stage: {key: value for key, value in stage_config(stage, settings).items() if key != "template"} for stage in [*STAGES, "final_prompt"]}
+
+def run_settings(overrides=None, bypass=None):
+    """Snapshot of the settings a run evaluates with, passed down to every call.
+
+    Jobs keep the snapshot they were started with, so later changes to the
+    defaults, or another session's sidebar, never reach rows already queued.
+    bypass defaults to the response cache's own flag.
+    """
+    return {"stages": stage_settings(overrides), "bypass_cache": get_response_cache().bypass if bypass is None else bypass}
+
+def bypass_cache(settings):
+    # None lets ResponseCache.get fall back to its own flag
+    return None if settings is None else settings["bypass_cache"]
+
+def all_scored_stages_failed(results):
+    # The final prompt only passes a question whose sum score is (nearly) full, so all zeros cannot pass
+    scored = [result for key, result in results.items() if STAGES[key].get("scored")]
+    if not scored or any(result is None or result["score"] != 0 for result in scored):
+        return None
+    return {
+        "sum_score": 0,
+        "final_score": 0,
+        "rationale": "Every scored evaluation returned 0, so the question cannot meet the final scoring conditions.\nDecided without calling the final prompt.",
+        "feedback": "\n".join(result["feedback"] for result in scored),
+        "key_strengths": [],
+        "key_weaknesses": [result["rationale"] for result in scored],
+    }
+
+FINAL_SHORT_CIRCUIT_RULES = [all_scored_stages_failed]
 
-    responses = parallel_api_calls(prompts, api_key)
+def decided_final(responses, settings=None):
+    """Return the final evaluation if the stage results already decide it, else None.
 
-    # Prepare PROMPT_RESULTS
+    responses holds one reply per stage in STAGES order, None for disabled
+    stages. Each rule in FINAL_SHORT_CIRCUIT_RULES gets the parsed results of
+    the enabled stages (None where a reply did not validate) and returns a
+    final result or None. The first decision is returned as JSON text, so it
+    stands in for the final prompt's reply.
+    """
+    if not stage_config("final_prompt", settings).get("short_circuit"):
+        return None
+    results = {
+        key: parse_response(response, RESULT_SCHEMAS[key])[0] if key in RESULT_SCHEMAS else None
+        for key, response in zip(STAGES, responses) if response is not None
+    }
+    for rule in FINAL_SHORT_CIRCUIT_RULES:
+        final = rule(results)
+        if final is not None:
+            return json.dumps(final, indent=2)
+    return None
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{[A-Z_]+\}\}")
+
+def split_prompt_template(prompt_template):
+    # Everything before the line holding the first {{PLACEHOLDER}} is the same
+    # for every row and becomes the cacheable system prefix
+    match = PLACEHOLDER_PATTERN.search(prompt_template)
+    if match is None:
+        return "", prompt_template
+    line_start = prompt_template.rfind("\n", 0, match.start()) + 1
+    return prompt_template[:line_start].strip(), prompt_template[line_start:]
+
+def format_prompt(prompt_template, **kwargs):
+    system, prompt = split_prompt_template(prompt_template)
+    for key, value in kwargs.items():
+        prompt = prompt.replace(f"{{{{{key}}}}}", str(value))
+    return (system, prompt) if system else prompt
+
+def build_stage_prompts(row_data, prompt_states, edited_prompts):
+    QUESTION, LESSON_PLAN = row_data[:2]
+
+    # One slot per stage, in STAGES order; disabled stages are None
+    return [
+        format_prompt(edited_prompts[key], QUESTION=QUESTION, LESSON_PLAN=LESSON_PLAN) if prompt_states.get(key) else None
+        for key in STAGES
+    ]
+
+def build_final_prompt(row_data, responses, edited_prompts):
+    # row_data may carry a third item: duplicate evidence from DuplicateIndex.evidence
+    QUESTION = row_data[0]
     PROMPT_RESULTS = "<evaluation_results>\n"
     for i, response in enumerate(responses):
-        PROMPT_RESULTS += f"<evaluation_{i+1}>\n{response}\n</evaluation_{i+1}>\n"
+        if response is not None:
+            PROMPT_RESULTS += f"<evaluation_{i+1}>\n{response}\n</evaluation_{i+1}>\n"
     PROMPT_RESULTS += "</evaluation_results>"
-
-    final_prompt = format_prompt(edited_prompts['final_prompt'], QUESTION=QUESTION, PROMPT_RESULTS=PROMPT_RESULTS)
-    final_response = call_claude_api(final_prompt, api_key)
+    if len(row_data) > 2 and row_data[2]:
+        PROMPT_RESULTS += f"\n<duplicate_check>\n{row_data[2]}\n</duplicate_check>"
+
+    return format_prompt(edited_prompts['final_prompt'], QUESTION=QUESTION, PROMPT_RESULTS=PROMPT_RESULTS)
+
+def process_row(row_data, api_key, prompt_states, edited_prompts, failures=None, on_text=None, settings=None, calls=None):
+    # on_text, if given, is called as on_text(slot, partial_text) while replies
+    # stream in; the final prompt's slot follows the stage prompts'
+    started = time.monotonic()
+    get_call_metrics().row_started()
+    try:
+        prompts = build_stage_prompts(row_data, prompt_states, edited_prompts)
+        responses = parallel_api_calls(prompts, api_key, failures, list(STAGES), on_text, settings, calls)
+
+        final_response = decided_final(responses, settings)
+        if final_response is None:
+            final_prompt = build_final_prompt(row_data, responses, edited_prompts)
+            final_response = call_claude_api(final_prompt, api_key, failures, "final_prompt", on_text and functools.partial(on_text, len(prompts)), settings, calls)
+    finally:
+        get_call_metrics().row_finished(time.monotonic() - started)
 
     return responses + [final_response]
 
-def get_csv_download_link(df, filename="processed_frqs.csv"):
-    csv = df.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()
-    href = f'<a href="data:file/csv;base64,{b64}" download="{filename}">Download Processed CSV</a>'
-    return href
+def evaluate_rows(rows, api_key, prompt_states, edited_prompts, stop_flag=None, max_workers=None, max_rows_in_flight=MAX_ROWS_IN_FLIGHT, settings=None):
+    """Evaluate (index, row_data) pairs on one shared worker pool.
+
+    Up to max_rows_in_flight unfinished rows are evaluated at a time. A row's
+    final prompt is submitted as soon as its own stage prompts have returned,
+    and a finished row frees its place at once, even while it waits behind a
+    slower earlier row; up to MAX_ROWS_BUFFERED rows wait that way, so slow
+    rows never hold up the pool. Yields (index, responses, error, failures, usage)
+    in input order, where failures lists the row's failed API attempts and
+    usage is its tokens and estimated cost (see row_usage).
+    When stop_flag is set no new rows are admitted, but rows already in flight
+    are finished and yielded. max_workers defaults to the concurrency
+    controller's ceiling; the controller decides how many calls actually run.
+    settings, if given, is the run_settings snapshot every call is made with.
+    """
+    rows = iter(rows)
+    order = deque()   # admitted row indices, in input order
+    states = {}       # index -> per-row state, until the row is yielded
+    futures = {}      # future -> (index, stage slot or None for the final prompt)
+    unfinished = 0    # admitted rows without a result yet
+    exhausted = False
+
+    def finish(index, result, error=None):
+        nonlocal unfinished
+        unfinished -= 1
+        states[index]["result"] = result
+        states[index]["error"] = error
+        get_call_metrics().row_finished(time.monotonic() - states[index]["started"])
+
+    def submit_final(executor, index):
+        state = states[index]
+        try:
+            decided = decided_final(state["responses"], settings)
+            if decided is not None:
+                finish(index, state["responses"] + [decided])
+                return
+            final_prompt = build_final_prompt(state["row_data"], state["responses"], edited_prompts)
+        except Exception as exc:
+            finish(index, ["NA"] * (len(STAGES) + 1), exc)
+            return
+        futures[executor.submit(call_claude_api, final_prompt, api_key, state["failures"], "final_prompt", None, settings, state["calls"])] = (index, None)
+
+    def admit(executor, index, row_data):
+        nonlocal unfinished
+        unfinished += 1
+        order.append(index)
+        states[index] = {"result": None, "error": None, "failures": [], "calls": [], "started": time.monotonic()}
+        get_call_metrics().row_started()
+        try:
+            prompts = build_stage_prompts(row_data, prompt_states, edited_prompts)
+        except Exception as exc:
+            finish(index, ["NA"] * (len(STAGES) + 1), exc)
+            return
+        states[index].update(row_data=row_data, responses=[None] * len(prompts), remaining=0)
+        for slot, (prompt, stage) in enumerate(zip(prompts, STAGES)):
+            if prompt is not None:
+                futures[executor.submit(call_claude_api, prompt, api_key, states[index]["failures"], stage, None, settings, states[index]["calls"])] = (index, slot)
+                states[index]["remaining"] += 1
+        if states[index]["remaining"] == 0:
+            submit_final(executor, index)
+
+    if max_workers is None:
+        max_workers = get_concurrency_controller(api_key).max_limit
+    get_http_session(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            while (not exhausted and unfinished < max_rows_in_flight and len(states) < MAX_ROWS_BUFFERED
+                   and not (stop_flag is not None and stop_flag.is_set())):
+                try:
+                    index, row_data = next(rows)
+                except StopIteration:
+                    exhausted = True
+                    break
+                admit(executor, index, row_data)
+
+            while order and states[order[0]]["result"] is not None:
+                index = order.popleft()
+                state = states.pop(index)
+                yield index, state["result"], state["error"], state["failures"], row_usage(state["calls"])
 
-def process_csv(df, api_key, start_row, end_row, progress_bar, stop_flag, download_button, prompt_states, edited_prompts):
-    results = []
-    for index, row in df.iloc[start_row:end_row+1].iterrows():
-        if stop_flag.is_set():
-            break
+            if not futures:
+                stopped = stop_flag is not None and stop_flag.is_set()
+                if not states and (exhausted or stopped):
+                    break
+                continue
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, slot = futures.pop(future)
+                state = states[index]
+                try:
+                    response = future.result()
+                except Exception as exc:
+                    response = f"Error: {exc}"
+                if response is None:
+                    response = "No response received"
+
+                if slot is None:
+                    finish(index, state["responses"] + [response])
+                else:
+                    state["responses"][slot] = response
+                    state["remaining"] -= 1
+                    if state["remaining"] == 0:
+                        submit_final(executor, index)
+
+async def async_process_row(session, row_data, api_key, prompt_states, edited_prompts, semaphore, failures=None, settings=None, calls=None):
+    prompts = build_stage_prompts(row_data, prompt_states, edited_prompts)
+    results = await asyncio.gather(
+        *(async_call_claude_api(session, prompt, api_key, semaphore, failures, stage, settings, calls)
+          for prompt, stage in zip(prompts, STAGES) if prompt is not None),
+        return_exceptions=True,
+    )
+    results = iter(results)
+    responses = []
+    for prompt in prompts:
+        if prompt is None:
+            responses.append(None)
+            continue
+        response = next(results)
+        if isinstance(response, Exception):
+            response = f"Error: {response}"
+        responses.append("No response received" if response is None else response)
+
+    final_response = decided_final(responses, settings)
+    if final_response is None:
+        final_prompt = build_final_prompt(row_data, responses, edited_prompts)
+        final_response = await async_call_claude_api(session, final_prompt, api_key, semaphore, failures, "final_prompt", settings, calls)
+
+    return responses + ["No response received" if final_response is None else final_response]
+
+async def async_evaluate_rows(rows, api_key, prompt_states, edited_prompts, stop_flag=None, max_concurrency=None, max_rows_in_flight=MAX_ROWS_IN_FLIGHT, settings=None):
+    """Async generator with the same contract as evaluate_rows.
+
+    Each admitted row runs as one task on a single event loop; a semaphore and
+    the concurrency controller bound the requests actually in flight.
+    """
+    if max_concurrency is None:
+        max_concurrency = get_concurrency_controller(api_key).max_limit
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0])
+
+    async def run_row(row_data, failures, calls):
+        started = time.monotonic()
+        get_call_metrics().row_started()
         try:
-            row_data = row.tolist()
-            responses = process_row(row_data, api_key, prompt_states, edited_prompts)
-            results.append(responses)
-        except Exception as e:
-            st.error(f"Error processing row {index}: {str(e)}")
-            results.append(["NA"] * 4)  # Add NA for all 4 columns
-        
-        # Update the DataFrame after each row is processed
-        for j, response in enumerate(results[-1][:3]):
-            df.loc[index, f'Evaluation_{j+1}'] = response
-        df.loc[index, 'Final_Evaluation'] = results[-1][3]
-        
-        progress = (index - start_row + 1) / (end_row - start_row + 1)
+            return await async_process_row(session, row_data, api_key, prompt_states, edited_prompts, semaphore, failures, settings, calls), None
+        except Exception as exc:
+            return ["NA"] * (len(STAGES) + 1), exc
+        finally:
+            get_call_metrics().row_finished(time.monotonic() - started)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pending = deque()   # (index, failures, calls, task) in input order, until yielded
+        running = set()     # tasks of rows without a result yet
+        rows = iter(rows)
+        exhausted = False
+        while True:
+            while (not exhausted and len(running) < max_rows_in_flight and len(pending) < MAX_ROWS_BUFFERED
+                   and not (stop_flag is not None and stop_flag.is_set())):
+                try:
+                    index, row_data = next(rows)
+                except StopIteration:
+                    exhausted = True
+                    break
+                failures, calls = [], []
+                task = asyncio.create_task(run_row(row_data, failures, calls))
+                running.add(task)
+                pending.append((index, failures, calls, task))
+            while pending and pending[0][3].done():
+                index, failures, calls, task = pending.popleft()
+                responses, error = task.result()
+                yield index, responses, error, failures, row_usage(calls)
+            if not pending:
+                break
+            # Any finished row frees a place; the head of pending may still be running
+            _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+
+def evaluate_rows_async(rows, api_key, prompt_states, edited_prompts, stop_flag=None, max_workers=None, max_rows_in_flight=MAX_ROWS_IN_FLIGHT, settings=None):
+    # Drive async_evaluate_rows on its own event loop thread and hand results
+    # back through a bounded queue, so callers can swap it in for evaluate_rows.
+    results = queue.Queue(maxsize=max_rows_in_flight)
+    done = object()
+
+    async def produce():
+        async for item in async_evaluate_rows(rows, api_key, prompt_states, edited_prompts, stop_flag, max_workers, max_rows_in_flight, settings):
+            await asyncio.to_thread(results.put, item)
+
+    def run():
+        try:
+            asyncio.run(produce())
+        except Exception as exc:
+            results.put(exc)
+        results.put(done)
+
+    threading.Thread(target=run, daemon=True).start()
+    while (item := results.get()) is not done:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+EVALUATION_BACKENDS = {"thread": evaluate_rows, "async": evaluate_rows_async}
+
+def dataframe_bytes(df, fmt="CSV"):
+    if fmt == "CSV":
+        return df.to_csv(index=False).encode("utf-8")
+    if fmt == "JSONL":
+        return df.to_json(orient="records", lines=True, force_ascii=False).encode("utf-8")
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+def render_download(container, data, fmt, key):
+    extension, mime = EXPORT_FORMATS[fmt]
+    # on_click="ignore" keeps a click from rerunning (and so interrupting) the script
+    container.download_button(f"Download Processed {fmt}", data=data, file_name=f"processed_frqs.{extension}",
+                              mime=mime, key=key, on_click="ignore")
+
+class IncrementalExport:
+    """On-disk export that only ever appends newly finished rows.
+
+    CSV exports are appended to directly. JSONL and Parquet both append JSON
+    lines; Parquet cannot be appended to, so it is converted from those lines
+    when the download is refreshed. The download bytes are cached and rebuilt
+    at most every refresh_seconds or refresh_rows rows, whichever comes first.
+    """
+
+    def __init__(self, path_stem, fmt="CSV", refresh_seconds=EXPORT_REFRESH_SECONDS, refresh_rows=EXPORT_REFRESH_ROWS, truncate=True):
+        self.fmt = fmt
+        self.path = f"{path_stem}.{'csv' if fmt == 'CSV' else 'jsonl'}"
+        self.refresh_seconds = refresh_seconds
+        self.refresh_rows = refresh_rows
+        self.columns = None
+        self.refreshes = 0
+        self._data = b""
+        self._pending_rows = 0
+        self._refreshed_at = time.monotonic()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        open(self.path, "w" if truncate else "a").close()
+
+    def append_frame(self, rows):
+        if rows.empty:
+            return
+        if self.columns is None:
+            self.columns = list(rows.columns)
+        rows = rows.reindex(columns=self.columns)
+        if self.fmt == "CSV":
+            rows.to_csv(self.path, mode="a", header=os.path.getsize(self.path) == 0, index=False)
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(rows.to_json(orient="records", lines=True, force_ascii=False).rstrip("\n") + "\n")
+        self._pending_rows += len(rows)
+
+    def append(self, row):
+        self.append_frame(pd.DataFrame([row]))
+
+    def refresh_due(self):
+        return self._pending_rows > 0 and (
+            self._pending_rows >= self.refresh_rows or time.monotonic() - self._refreshed_at >= self.refresh_seconds
+        )
+
+    def data(self, force=False):
+        if force or self.refresh_due():
+            if self.fmt == "Parquet":
+                rows = pd.read_json(self.path, lines=True) if os.path.getsize(self.path) else pd.DataFrame()
+                self._data = dataframe_bytes(rows, "Parquet")
+            else:
+                with open(self.path, "rb") as f:
+                    self._data = f.read()
+            self._pending_rows = 0
+            self._refreshed_at = time.monotonic()
+            self.refreshes += 1
+        return self._data
+
+def format_budget(used, limit):
+    return "no limit known" if limit is None else f"{used:.0f}/{limit:.0f} per min"
+
+def format_concurrency_stats(stats):
+    latency = f"{stats['latency']:.1f}s" if stats["latency"] is not None else "n/a"
+    return (
+        f"Concurrency: {stats['in_flight']} in flight / limit {stats['limit']} (max {stats['max_limit']}) · "
+        f"Latency: {latency} · Throttled: {stats['throttled']} · "
+        f"Requests: {format_budget(stats['rpm_used'], stats['rpm_limit'])} · "
+        f"Tokens: {format_budget(stats['tpm_used'], stats['tpm_limit'])}"
+    )
+
+def format_seconds(seconds):
+    return "n/a" if seconds is None else f"{seconds:.1f}s"
+
+def format_cost(dollars):
+    if dollars is None:
+        return "n/a"
+    return f"${dollars:.2f}" if dollars >= 1 else f"${dollars:.4f}"
+
+def format_metrics(metrics):
+    # One-line run summary for captions and the CLI
+    return (
+        f"Rows: {metrics['rows']} ({metrics['rows_per_second']:.2f}/s, p50/p95 {format_seconds(metrics['row_latency'][0])}/{format_seconds(metrics['row_latency'][1])}) · "
+        f"API calls: {metrics['calls']} ({metrics['calls_per_minute']:.0f}/min, p50/p95 {format_seconds(metrics['call_latency'][0])}/{format_seconds(metrics['call_latency'][1])}) · "
+        f"Errors: {metrics['failed_attempts']}/{metrics['attempts']} attempts ({metrics['error_rate']:.1%}), {metrics['reasks']} re-asks · "
+        f"Estimated cost: {format_cost(metrics['cost'])} ({format_cost(metrics['cost_per_row'])}/row)"
+    )
+
+def render_metrics(container, metrics, stats):
+    # Live metrics panel; stats are the concurrency controller's
+    with container.container():
+        columns = st.columns(5)
+        columns[0].metric("Throughput", f"{metrics['rows_per_second']:.2f} rows/s",
+                          help=f"{metrics['rows']} rows and {metrics['calls']} API calls in {metrics['elapsed']:.0f}s ({metrics['calls_per_minute']:.0f} calls/min)")
+        columns[1].metric("In flight", f"{stats['in_flight']} calls",
+                          help=f"{metrics['rows_in_flight']} rows in flight; concurrency limit {stats['limit']} (max {stats['max_limit']})")
+        columns[2].metric("Error rate", f"{metrics['error_rate']:.1%}",
+                          help=f"{metrics['failed_attempts']} of {metrics['attempts']} HTTP attempts failed; {metrics['failed_calls']} calls gave no usable reply; {metrics['reasks']} re-asks")
+        columns[3].metric("Estimated cost", format_cost(metrics["cost"]),
+                          help=f"Estimated from token usage and MODEL_PRICES; {format_cost(metrics['cost_per_row'])} per row")
+        columns[4].metric("Row latency p50/p95", f"{format_seconds(metrics['row_latency'][0])} / {format_seconds(metrics['row_latency'][1])}",
+                          help=f"API call latency p50/p95: {format_seconds(metrics['call_latency'][0])} / {format_seconds(metrics['call_latency'][1])}")
+        st.caption(format_concurrency_stats(stats))
+
+def result_columns(responses, failures, usage=None):
+    # usage is the row's row_usage; rows without one (copies of a duplicate, older journals) report nothing spent
+    usage = usage or {}
+    columns = {f'Evaluation_{j+1}': response for j, response in enumerate(responses[:-1])}
+    columns['Final_Evaluation'] = responses[-1]
+    columns['Failed_Attempts'] = len(failures)
+    columns['Last_Error'] = failures[-1] if failures else ""
+    columns['Input_Tokens'] = sum(usage.get(field, 0) for field in ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"))
+    columns['Cache_Read_Tokens'] = usage.get("cache_read_input_tokens", 0)
+    columns['Output_Tokens'] = usage.get("output_tokens", 0)
+    columns['Estimated_Cost'] = round(usage.get("cost", 0.0), 6)
+    return columns
+
+def expand_evaluations(df):
+    """Return a copy of df with each evaluation's JSON fields as typed columns.
+
+    Evaluation_1 gains Evaluation_1_score, Evaluation_1_rationale and so on,
+    per RESULT_SCHEMAS. Each column's replies are parsed once and the fields
+    are added as whole columns; replies that fail validation leave their
+    fields empty and are named in Parse_Errors.
+    """
+    df = df.copy()
+    sources = {f"Evaluation_{slot+1}": key for slot, key in enumerate(STAGES)}
+    sources["Final_Evaluation"] = "final_prompt"
+    parse_errors = [[] for _ in range(len(df))]
+    for column, key in sources.items():
+        if column not in df.columns:
+            continue
+        schema = RESULT_SCHEMAS.get(key)
+        if schema is None:
+            continue
+        parsed = [parse_response(text, schema)[0] if isinstance(text, str) and text else None for text in df[column]]
+        fields = pd.DataFrame.from_records([result or {} for result in parsed], index=df.index, columns=list(schema))
+        for field, (kind, _) in schema.items():
+            if kind is int:
+                values = fields[field].astype("Int64")
+            elif kind is list:
+                values = fields[field].map(lambda items: "; ".join(items) if isinstance(items, list) else None).astype("string")
+            else:
+                values = fields[field].astype("string")
+            df[f"{column}_{field}"] = values
+        for errors, text, result in zip(parse_errors, df[column], parsed):
+            if isinstance(text, str) and text and result is None:
+                errors.append(column)
+    df["Parse_Errors"] = [", ".join(errors) for errors in parse_errors]
+    return df
+
+def store_row_result(df, index, responses, failures, usage=None):
+    for column, value in result_columns(responses, failures, usage).items():
+        df.loc[index, column] = value
+
+def file_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def prompt_set_digest(prompt_states, edited_prompts, settings=None):
+    stages = stage_settings() if settings is None else settings["stages"]
+    blob = json.dumps([MAX_TOKENS, stages, prompt_states, edited_prompts], sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+class ResultsJournal:
+    """Append-only JSONL record of finished rows for one upload and prompt set.
+
+    Each line is flushed and fsynced as soon as its row is done, so completed
+    work survives a dead session. A torn final line from a crash mid-write is
+    ignored on load, and a later record for the same row wins.
+    """
+
+    def __init__(self, upload_digest, prompt_digest, directory=JOURNAL_DIR):
+        self.path = os.path.join(directory, f"{upload_digest}-{prompt_digest[:16]}.jsonl")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Terminate a torn final line so the next record starts on its own line
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def append(self, index, responses, failures, usage=None):
+        record = json.dumps({"index": index, "responses": responses, "failures": failures, "usage": usage, "time": time.time()})
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(record + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self):
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["index"]] = record
+        return records
+
+    def completed(self):
+        return set(self.load())
+
+    def materialize(self, df):
+        return materialize_records(df, self.load())
+
+def materialize_records(df, records):
+    # Build every result column from {index: {"responses", "failures", "usage"}} in one pass and align it on df's index
+    if not records:
+        return df
+    results = pd.DataFrame.from_dict(
+        {index: result_columns(record["responses"], record["failures"], record.get("usage")) for index, record in records.items()},
+        orient="index",
+    )
+    df = df.copy()
+    for column in results.columns:
+        df[column] = results[column]
+    return df
+
+class WorkQueue:
+    """Lease-based SQLite queue of CSV rows shared by worker processes.
+
+    A job holds its prompts and stage settings; each of its rows is a task.
+    Workers claim pending tasks under a lease of lease_seconds, renew the
+    leases of the rows they are still working on, and write results back.
+    A task whose lease expires (its worker died) is claimable again, up to
+    MAX_TASK_ATTEMPTS claims, after which it is marked failed. Any process
+    that can open the database file (one host, or a shared volume with
+    working file locks) can submit, work or monitor. Unlike the response
+    cache, the queue uses the rollback journal rather than WAL: WAL's index
+    lives in shared memory, which hosts sharing a network volume cannot see.
+    """
+
+    def __init__(self, path=QUEUE_PATH, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # IMMEDIATE takes the write lock when a transaction starts, so writers queue on the
+        # busy timeout instead of failing to upgrade a read lock
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level="IMMEDIATE")
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, name TEXT NOT NULL, settings TEXT NOT NULL, copies TEXT NOT NULL, "
+                "status TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "job_id TEXT NOT NULL, row_index INTEGER NOT NULL, row_data TEXT NOT NULL, status TEXT NOT NULL, "
+                "lease_owner TEXT, lease_token TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "responses TEXT, failures TEXT, usage TEXT, error TEXT, updated REAL NOT NULL, PRIMARY KEY (job_id, row_index))"
+            )
+            # Queues created before rows carried their token usage
+            if "usage" not in {column[1] for column in self._conn.execute("PRAGMA table_info(tasks)")}:
+                self._conn.execute("ALTER TABLE tasks ADD COLUMN usage TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_claimable ON tasks (job_id, status, row_index)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_lease_token ON tasks (lease_token)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                "id TEXT PRIMARY KEY, host TEXT NOT NULL, pid INTEGER NOT NULL, started REAL NOT NULL, "
+                "heartbeat REAL NOT NULL, rows_done INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    def submit(self, job_id, name, prompt_states, edited_prompts, rows, copies=None, stages=None):
+        """Add (index, row_data) rows to job_id, creating the job or reactivating it.
+
+        Rows already queued keep their state, so resubmitting the same file
+        and prompts only adds rows that were not queued before. stages
+        defaults to the current stage_settings().
+        """
+        settings = json.dumps({"prompt_states": prompt_states, "edited_prompts": edited_prompts, "stages": stages or stage_settings()})
+        now = time.time()
+        with self._lock, self._conn:
+            existing = self._conn.execute("SELECT copies FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            all_copies = {**(json.loads(existing[0]) if existing else {}), **{str(index): members for index, members in (copies or {}).items()}}
+            self._conn.execute(
+                "INSERT INTO jobs (id, name, settings, copies, status, created) VALUES (?, ?, ?, ?, 'active', ?) "
+                "ON CONFLICT (id) DO UPDATE SET name = excluded.name, settings = excluded.settings, copies = excluded.copies, status = 'active'",
+                (job_id, name, settings, json.dumps(all_copies), now),
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tasks (job_id, row_index, row_data, status, updated) VALUES (?, ?, ?, 'pending', ?)",
+                ((job_id, int(index), json.dumps(row_data), now) for index, row_data in rows),
+            )
+
+    def set_status(self, job_id, status):
+        # "active", "paused" or "cancelled"; leased rows of a paused or cancelled job still finish
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+
+    def _fail_expired(self, now):
+        # Rows whose leases ran out MAX_TASK_ATTEMPTS times keep killing their workers; stop handing them out
+        self._conn.execute(
+            "UPDATE tasks SET status = 'failed', error = 'lease expired ' || attempts || ' times', updated = ? "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, now, MAX_TASK_ATTEMPTS),
+        )
+
+    def next_job(self):
+        # The oldest active job with claimable rows, as (job_id, settings), or None
+        now = time.time()
+        with self._lock, self._conn:
+            self._fail_expired(now)
+            row = self._conn.execute(
+                "SELECT id, settings FROM jobs WHERE status = 'active' AND EXISTS ("
+                "SELECT 1 FROM tasks WHERE job_id = jobs.id AND attempts < ? AND "
+                "(status = 'pending' OR (status = 'leased' AND lease_expires < ?))) ORDER BY created LIMIT 1",
+                (MAX_TASK_ATTEMPTS, now),
+            ).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def unfinished(self):
+        # Rows of active jobs still pending or leased, including leases that may yet expire and be claimed again
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM tasks JOIN jobs ON jobs.id = tasks.job_id "
+                "WHERE jobs.status = 'active' AND tasks.status IN ('pending', 'leased')"
+            ).fetchone()[0]
+
+    def claim(self, job_id, worker_id, limit=1):
+        """Lease up to limit claimable rows of an active job; returns [(index, row_data)].
+
+        The UPDATE picks and leases the rows in one statement, so concurrent
+        workers never claim the same row. Expired leases that used up their
+        attempts are marked failed first.
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._lock, self._conn:
+            self._fail_expired(now)
+            self._conn.execute(
+                "UPDATE tasks SET status = 'leased', lease_owner = ?, lease_token = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated = ? WHERE rowid IN ("
+                "SELECT rowid FROM tasks WHERE job_id = ? AND attempts < ? AND "
+                "(status = 'pending' OR (status = 'leased' AND lease_expires < ?)) ORDER BY row_index LIMIT ?) "
+                "AND EXISTS (SELECT 1 FROM jobs WHERE id = ? AND status = 'active')",
+                (worker_id, token, now + self.lease_seconds, now, job_id, MAX_TASK_ATTEMPTS, now, limit, job_id),
+            )
+            rows = self._conn.execute(
+                "SELECT row_index, row_data FROM tasks WHERE lease_token = ? ORDER BY row_index", (token,)
+            ).fetchall()
+        return [(index, json.loads(row_data)) for index, row_data in rows]
+
+    def complete(self, job_id, index, worker_id, responses, failures, error=None, usage=None):
+        # A late result from a worker whose lease expired is still a valid result; the first one wins
+        now = time.time()
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                "UPDATE tasks SET status = 'done', responses = ?, failures = ?, usage = ?, error = ?, lease_owner = ?, updated = ? "
+                "WHERE job_id = ? AND row_index = ? AND status != 'done'",
+                (json.dumps(responses), json.dumps(failures), json.dumps(usage), None if error is None else str(error), worker_id, now, job_id, int(index)),
+            ).rowcount
+            self._conn.execute("UPDATE workers SET rows_done = rows_done + ? WHERE id = ?", (updated, worker_id))
+
+    def release(self, worker_id):
+        # Hand back rows a stopping worker claimed but did not finish, without spending an attempt
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+            self._conn.execute(
+                "UPDATE tasks SET status = 'pending', lease_owner = NULL, lease_token = NULL, lease_expires = NULL, "
+                "attempts = attempts - 1, updated = ? WHERE lease_owner = ? AND status = 'leased'",
+                (time.time(), worker_id),
+            )
+
+    def heartbeat(self, worker_id, started):
+        # Renew every lease worker_id holds and record that it is alive
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE lease_owner = ? AND status = 'leased'",
+                (now + self.lease_seconds, worker_id),
+            )
+            self._conn.execute(
+                "INSERT INTO workers (id, host, pid, started, heartbeat) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (worker_id, socket.gethostname(), os.getpid(), started, now),
+            )
+
+    def job(self, job_id):
+        # (name, status, {task status: count}) or None
+        with self._lock:
+            job = self._conn.execute("SELECT name, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        return job[0], job[1], counts
+
+    def jobs(self, prefix=""):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT id FROM jobs WHERE substr(id, 1, ?) = ? ORDER BY created", (len(prefix), prefix)
+            ).fetchall()]
+
+    def workers(self):
+        # Workers seen within one lease period: (id, heartbeat age in seconds, rows done)
+        now = time.time()
+        with self._lock:
+            return [(worker_id, now - heartbeat, rows_done) for worker_id, heartbeat, rows_done in self._conn.execute(
+                "SELECT id, heartbeat, rows_done FROM workers WHERE heartbeat >= ? ORDER BY id", (now - self.lease_seconds,)
+            ).fetchall()]
+
+    def records(self, job_id):
+        """Finished rows as {index: {"responses", "failures", "usage"}}, copied to each row's exact duplicates.
+
+        Rows that failed for good are included with "NA" responses and their
+        error. Only the evaluated row carries its usage; its copies cost nothing.
+        """
+        with self._lock:
+            copies = json.loads(self._conn.execute("SELECT copies FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+            rows = self._conn.execute(
+                "SELECT row_index, status, responses, failures, usage, error FROM tasks WHERE job_id = ? AND status IN ('done', 'failed')", (job_id,)
+            ).fetchall()
+        records = {}
+        for index, status, responses, failures, usage, error in rows:
+            if status == "done":
+                record = {"responses": json.loads(responses), "failures": json.loads(failures), "usage": json.loads(usage or "null")}
+            else:
+                record = {"responses": ["NA"] * (len(STAGES) + 1), "failures": [error], "usage": None}
+            records[index] = record
+            for member in copies.get(str(index), ()):
+                records[member] = {**record, "usage": None}
+        return records
+
+def normalize_text(value):
+    # Case, Unicode form and whitespace differences do not make two FRQs different
+    if not isinstance(value, str):
+        return ""
+    return " ".join(unicodedata.normalize("NFKC", value).casefold().split())
+
+_minhash_rng = np.random.default_rng(0x5eed)
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_A = _minhash_rng.integers(1, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.int64)
+MINHASH_B = _minhash_rng.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.int64)
+
+def minhash_signature(text):
+    # MinHash over word shingles, ignoring punctuation; None for text with no words
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.int64, count=len(shingles))
+    return ((MINHASH_A[:, None] * hashes[None, :] + MINHASH_B[:, None]) % MINHASH_PRIME).min(axis=1)
+
+class DuplicateIndex:
+    """Exact and near-duplicate lookup over the rows of an upload.
+
+    Rows whose normalized QUESTION and LESSON_PLAN match are exact duplicates;
+    only the first of each group needs evaluating. Near duplicates are found
+    with MinHash signatures of the questions, bucketed into LSH bands so only
+    candidate pairs are compared, and kept when their estimated Jaccard
+    similarity reaches NEAR_DUPLICATE_THRESHOLD.
+    """
+
+    def __init__(self, rows):
+        # rows: iterable of (index, row_data)
+        self.keys = {}
+        self.groups = {}     # key -> indices with that key, in input order
+        self.questions = {}  # key -> question text of the group's first row
+        for index, row_data in rows:
+            question, lesson_plan = (normalize_text(value) for value in row_data[:2])
+            key = hashlib.sha256(f"{question}\x1f{lesson_plan}".encode("utf-8")).hexdigest()
+            self.keys[index] = key
+            self.groups.setdefault(key, []).append(index)
+            self.questions.setdefault(key, row_data[0] if isinstance(row_data[0], str) else "")
+        self.near = self._find_near_duplicates()
+
+    def _find_near_duplicates(self):
+        keys, signatures = [], []
+        for key, question in self.questions.items():
+            signature = minhash_signature(normalize_text(question))
+            if signature is not None:
+                keys.append(key)
+                signatures.append(signature)
+        near = {}
+        if len(keys) < 2:
+            return near
+        signatures = np.vstack(signatures)
+        width = MINHASH_PERMUTATIONS // LSH_BANDS
+        candidates = set()
+        for band in range(LSH_BANDS):
+            buckets = {}
+            for i, values in enumerate(signatures[:, band * width:(band + 1) * width]):
+                buckets.setdefault(values.tobytes(), []).append(i)
+            for members in buckets.values():
+                # Comparing each member with a few predecessors keeps huge buckets linear
+                for position, i in enumerate(members):
+                    candidates.update((j, i) for j in members[max(0, position - NEAR_DUPLICATE_LIMIT):position])
+        for i, j in candidates:
+            similarity = float(np.mean(signatures[i] == signatures[j]))
+            if similarity >= NEAR_DUPLICATE_THRESHOLD:
+                near.setdefault(keys[i], []).append((keys[j], similarity))
+                near.setdefault(keys[j], []).append((keys[i], similarity))
+        for matches in near.values():
+            matches.sort(key=lambda match: -match[1])
+        return near
+
+    def first(self, index):
+        return self.groups[self.keys[index]][0]
+
+    def near_duplicates(self, index):
+        # [(first row index of the other group, similarity)], most similar first
+        return [(self.groups[key][0], similarity) for key, similarity in self.near.get(self.keys[index], [])]
+
+    def evidence(self, index):
+        # Plain-text summary for the final prompt's uniqueness criterion, or None when the row has no duplicates.
+        # It names no counts or row positions, so adding unrelated rows to a file leaves the prompt (and its cache key) unchanged.
+        lines = []
+        if len(self.groups[self.keys[index]]) > 1:
+            lines.append("Exact duplicate: the same question and lesson plan appear more than once in this upload.")
+        near = sorted((-similarity, self.questions[key]) for key, similarity in self.near.get(self.keys[index], []))
+        for negative_similarity, question in near[:NEAR_DUPLICATE_LIMIT]:
+            lines.append(f"Near duplicate (estimated similarity {-negative_similarity:.2f}): {question[:300]}")
+        return "\n".join(lines) or None
+
+    def annotate(self, df):
+        # Copy of df with Duplicate_Of (first row of an exact-duplicate group) and Near_Duplicates columns
+        df = df.copy()
+        first = pd.Series({index: self.first(index) for index in self.keys}, dtype="Int64")
+        near = pd.Series({
+            index: "; ".join(f"{other} ({similarity:.2f})" for other, similarity in self.near_duplicates(index)[:NEAR_DUPLICATE_LIMIT])
+            for index in self.keys
+        }, dtype="string")
+        first = first.where(first != pd.Series(first.index, index=first.index))
+        df["Duplicate_Of"] = first.reindex(df.index)
+        df["Near_Duplicates"] = near.reindex(df.index)
+        return df
+
+def unique_rows(rows, duplicates):
+    """Split (index, row_data) pairs into the rows to evaluate and their copies.
+
+    Returns (rows, copies): the first row of each exact-duplicate group, with
+    its duplicate evidence appended to row_data, and a dict from that row's
+    index to the indices that reuse its result. Without an index every row
+    is evaluated.
+    """
+    if duplicates is None:
+        return list(rows), {}
+    selected, copies, seen = [], {}, {}
+    for index, row_data in rows:
+        key = duplicates.keys[index]
+        if key in seen:
+            copies[seen[key]].append(index)
+            continue
+        seen[key] = index
+        copies[index] = []
+        selected.append((index, [*row_data[:2], duplicates.evidence(index)]))
+    return selected, copies
+
+def process_csv(df, api_key, start_row, end_row, progress_bar, stop_flag, download_button, prompt_states, edited_prompts, max_workers=None, max_rows_in_flight=MAX_ROWS_IN_FLIGHT, status_placeholder=None, backend="thread", journal=None, skip_rows=(), export=None, duplicates=None, on_message=None, settings=None):
+    # Rows in skip_rows (e.g. already in the journal) are not evaluated again.
+    # With a DuplicateIndex, exact duplicates are evaluated once and share the result.
+    # The metrics panel (in status_placeholder) and METRICS_PATH are refreshed every METRICS_REFRESH_SECONDS.
+    # on_message(level, text) reports row errors and warnings; it defaults to st.error / st.warning.
+    if on_message is None:
+        on_message = lambda level, text: getattr(st, level)(text)
+    results = []
+    skip_rows = set(skip_rows)
+    rows = ((index, row.tolist()[:2]) for index, row in df.iloc[start_row:end_row+1].iterrows() if index not in skip_rows)
+    rows, copies = unique_rows(rows, duplicates)
+    skipped = sum(1 for index in df.index[start_row:end_row+1] if index in skip_rows)
+    done = 0
+    metrics = get_call_metrics()
+    refreshed_at = time.monotonic()
+
+    def refresh_metrics():
+        stats = get_concurrency_controller(api_key).stats()
+        metrics.write_prometheus(stats=stats)
+        if status_placeholder is not None:
+            render_metrics(status_placeholder, metrics.snapshot(), stats)
+
+    evaluate = EVALUATION_BACKENDS[backend]
+    for index, responses, error, failures, usage in evaluate(rows, api_key, prompt_states, edited_prompts, stop_flag, max_workers, max_rows_in_flight, settings):
+        if error is not None:
+            on_message("error", f"Error processing row {index}: {str(error)}")
+        elif "No response received" in responses and failures:
+            on_message("warning", f"Row {index} is missing responses after retries. Last error: {failures[-1]}")
+        results.append(responses)
+
+        # Write each row back as soon as it and every row before it are done; its copies cost nothing
+        for member in [index, *copies.get(index, ())]:
+            member_usage = usage if member == index else None
+            store_row_result(df, member, responses, failures, member_usage)
+            if journal is not None:
+                journal.append(member, responses, failures, member_usage)
+            if export is not None:
+                export.append(df.loc[member].to_dict())
+        done += 1 + len(copies.get(index, ()))
+
+        progress = (skipped + done) / (end_row - start_row + 1)
         progress_bar.progress(progress)
-        
-        # Update the download button after each row
-        download_button.markdown(get_csv_download_link(df), unsafe_allow_html=True)
-    
+        if time.monotonic() - refreshed_at >= METRICS_REFRESH_SECONDS:
+            refresh_metrics()
+            refreshed_at = time.monotonic()
+
+        # Rows were appended to the export above; the download is only rebuilt now and then
+        if export is not None and download_button is not None:
+            if export.refresh_due():
+                render_download(download_button, export.data(), export.fmt, key=f"download-{export.refreshes}")
+
+    refresh_metrics()
     return results
 
+def default_prompts():
+    edited_prompts = {key: stage["template"] for key, stage in STAGES.items()}
+    edited_prompts["final_prompt"] = FINAL_STAGE["template"]
+    prompt_states = {key: True for key in STAGES}
+    return prompt_states, edited_prompts
+
+def evaluate_dataframe(df, api_key, prompt_states=None, edited_prompts=None, backend="thread", max_workers=None, max_rows_in_flight=MAX_ROWS_IN_FLIGHT, stop_flag=None, duplicates=None, settings=None):
+    # Headless entry point: evaluates every row of df in place, without any Streamlit widgets
+    if prompt_states is None or edited_prompts is None:
+        prompt_states, edited_prompts = default_prompts()
+    rows = ((index, row.tolist()[:2]) for index, row in df.iterrows())
+    rows, copies = unique_rows(rows, duplicates)
+    evaluate = EVALUATION_BACKENDS[backend]
+    for index, responses, error, failures, usage in evaluate(rows, api_key, prompt_states, edited_prompts, stop_flag, max_workers, max_rows_in_flight, settings):
+        for member in [index, *copies.get(index, ())]:
+            store_row_result(df, member, responses, failures, usage if member == index else None)
+            if error is not None:
+                # The exception that ended the row explains its NA results better than any failed attempt
+                df.loc[member, "Last_Error"] = f"{type(error).__name__}: {error}"
+    return df
+
+def batch_state_path(upload_digest):
+    return os.path.join(BATCH_STATE_DIR, f"{upload_digest}.json")
+
+def load_state_file(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_state_file(path, state):
+    # Write-then-rename so a crash never leaves a truncated state file behind
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def batch_headers(api_key):
+    headers, _ = build_api_request("", api_key)
+    return headers
+
+def submit_message_batches(requests_list, api_key):
+    # Split into as many batches as the API's count and size limits require
+    batch_ids = []
+    chunk, chunk_bytes = [], 0
+    for request in requests_list + [None]:
+        size = len(json.dumps(request)) if request is not None else 0
+        if chunk and (request is None or len(chunk) >= BATCH_MAX_REQUESTS or chunk_bytes + size > BATCH_MAX_BYTES):
+            response = get_http_session().post(BATCHES_URL, headers=batch_headers(api_key), json={"requests": chunk}, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            batch_ids.append(response.json()["id"])
+            chunk, chunk_bytes = [], 0
+        if request is not None:
+            chunk.append(request)
+            chunk_bytes += size
+    return batch_ids
+
+def get_message_batch(batch_id, api_key):
+    response = get_http_session().get(f"{BATCHES_URL}/{batch_id}", headers=batch_headers(api_key), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def iter_message_batch_results(batch, api_key):
+    # Yields (custom_id, text, error, usage) from an ended batch's JSONL results
+    response = get_http_session().get(batch["results_url"], headers=batch_headers(api_key), stream=True, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    for line in response.iter_lines():
+        if not line:
+            continue
+        item = json.loads(line)
+        result = item["result"]
+        if result["type"] == "succeeded":
+            yield item["custom_id"], result["message"]["content"][0]["text"], None, result["message"].get("usage")
+        else:
+            error = result.get("error", {}).get("error", result.get("error", {}))
+            yield item["custom_id"], None, f"batch {result['type']}: {error}", None
+
+def run_batch_phase(state, state_path, phase, prompts, api_key, on_status, poll_interval, stages=None, settings=None, stop_flag=None):
+    """Submit one phase's prompts as Message Batches and wait for the results.
+
+    prompts maps custom_id to prompt text. Cached prompts are answered locally;
+    the rest are submitted once, with their batch IDs saved to state_path so an
+    interrupted session can resume polling instead of resubmitting. stages maps
+    custom_id to its stage, which sets the model settings and expected reply
+    structure; malformed replies are re-asked individually through the
+    Messages API once the batches have ended. settings is the run_settings
+    snapshot, as for call_claude_api. Setting stop_flag stops polling; the
+    batches keep running server-side and the return value is False.
+    """
+    stages = stages or {}
+    schemas = {custom_id: RESULT_SCHEMAS.get(stage) for custom_id, stage in stages.items()}
+    cache = get_response_cache()
+    responses, errors = state["responses"], state["errors"]
+    calls = state.setdefault("calls", {})   # custom_id -> call records, for each row's usage columns
+
+    def cache_key(custom_id):
+        _, payload = build_stage_request(prompts[custom_id], api_key, stages.get(custom_id), settings=settings)
+        return cache.make_key(payload["model"], payload["temperature"], payload["max_tokens"], prompts[custom_id])
+
+    def batch_record(custom_id, outcome, status=None, usage=None, reask=False):
+        # Batch requests have no meaningful latency; re-asks go through the Messages API at full price
+        record = new_call_record(stages.get(custom_id), stage_config(stages.get(custom_id), settings).get("model", MODEL), batch=not reask)
+        record["outcome"] = outcome
+        if status is not None:
+            note_attempt(record, status, usage)
+        return record
+
+    def note_call(custom_id, record):
+        get_call_metrics().record_call(record)
+        calls.setdefault(custom_id, []).append(record)
+
+    if not state["batch_ids"].get(phase):
+        batch_requests = []
+        for custom_id, prompt in prompts.items():
+            if custom_id in responses:
+                continue
+            _, payload = build_stage_request(prompt, api_key, stages.get(custom_id), settings=settings)
+            cached = cache.get(cache.make_key(payload["model"], payload["temperature"], payload["max_tokens"], prompt), bypass_cache(settings))
+            if cached is not None and is_valid_response(cached, schemas.get(custom_id)):
+                responses[custom_id] = cached
+                note_call(custom_id, batch_record(custom_id, "cached"))
+            else:
+                batch_requests.append({"custom_id": custom_id, "params": payload})
+        state["batch_ids"][phase] = submit_message_batches(batch_requests, api_key) if batch_requests else []
+        save_state_file(state_path, state)
+
+    pending = [batch_id for batch_id in state["batch_ids"][phase] if batch_id not in state["collected"]]
+    while pending:
+        for batch_id in list(pending):
+            batch = get_message_batch(batch_id, api_key)
+            counts = batch.get("request_counts", {})
+            on_status(f"{phase}: batch {batch_id} is {batch['processing_status']} "
+                      f"({counts.get('succeeded', 0)} succeeded, {counts.get('processing', 0)} processing, {counts.get('errored', 0)} errored)")
+            if batch["processing_status"] != "ended":
+                continue
+            for custom_id, text, error, usage in iter_message_batch_results(batch, api_key):
+                if text is None:
+                    errors[custom_id] = error
+                    note_call(custom_id, batch_record(custom_id, "failed", "batch_error"))
+                    continue
+                responses[custom_id] = text
+                outcome = "ok" if is_valid_response(text, schemas.get(custom_id)) else "malformed"
+                note_call(custom_id, batch_record(custom_id, outcome, 200, usage))
+                if is_valid_response(text, schemas.get(custom_id)):
+                    cache.put(cache_key(custom_id), text)
+            state["collected"].append(batch_id)
+            save_state_file(state_path, state)
+            pending.remove(batch_id)
+        if pending and stop_flag is not None and stop_flag.wait(poll_interval):
+            return False
+        if pending and stop_flag is None:
+            time.sleep(poll_interval)
+
+    malformed = [custom_id for custom_id, schema in schemas.items()
+                 if schema is not None and custom_id in responses and not is_valid_response(responses[custom_id], schema)]
+    if malformed:
+        on_status(f"{phase}: re-asking {len(malformed)} malformed response(s)")
+    for custom_id in malformed:
+        failures = []
+        started = time.monotonic()
+        record = batch_record(custom_id, None, reask=True)
+        text = repair_response(prompts[custom_id], responses[custom_id], api_key, stages[custom_id], failures, record=record, settings=settings)
+        finish_call(record, text, schemas[custom_id], started, calls.setdefault(custom_id, []))
+        if failures:
+            errors[custom_id] = "; ".join(failures)
+        if text is not None:
+            responses[custom_id] = text
+            if is_valid_response(text, schemas[custom_id]):
+                cache.put(cache_key(custom_id), text)
+        save_state_file(state_path, state)
+    return True
+
+def run_batch_job(df, api_key, start_row, end_row, prompt_states, edited_prompts, state_path, on_status=print, poll_interval=BATCH_POLL_INTERVAL, journal=None, duplicates=None, settings=None, stop_flag=None, progress_bar=None):
+    """Evaluate rows start_row..end_row of df through the Message Batches API.
+
+    All stage prompts go out as one batch, then all final prompts built from
+    their results as a second one; both are merged into df by custom_id.
+    With a DuplicateIndex, each exact-duplicate group is submitted once.
+    Progress is persisted to state_path after every step, so calling this
+    again with the same arguments resumes where a previous call stopped.
+    Returns None if stop_flag stopped it before the results were merged.
+    progress_bar, if given, gets progress(0.5) after the first phase and
+    progress(1.0) at the end.
+    """
+    prompt_digest = prompt_set_digest(prompt_states, edited_prompts, settings)
+    state = load_state_file(state_path)
+    if state is None or state["rows"] != [start_row, end_row] or state["prompt_digest"] != prompt_digest:
+        state = {"rows": [start_row, end_row], "prompt_digest": prompt_digest, "phase": "stage",
+                 "batch_ids": {}, "collected": [], "responses": {}, "errors": {}, "calls": {}}
+        save_state_file(state_path, state)
+
+    rows = [(index, row.tolist()[:2]) for index, row in df.iloc[start_row:end_row+1].iterrows()]
+    rows, copies = unique_rows(rows, duplicates)
+    stage_prompts = {}
+    stage_keys = {}
+    for index, row_data in rows:
+        prompts = build_stage_prompts(row_data, prompt_states, edited_prompts)
+        for slot, (prompt, stage) in enumerate(zip(prompts, STAGES)):
+            if prompt is not None:
+                stage_prompts[f"row-{index}-stage-{slot}"] = prompt
+                stage_keys[f"row-{index}-stage-{slot}"] = stage
+    if not run_batch_phase(state, state_path, "stage", stage_prompts, api_key, on_status, poll_interval, stage_keys, settings, stop_flag):
+        return None
+    if progress_bar is not None:
+        progress_bar.progress(0.5)
+
+    # Rows whose stage results already decide the final evaluation skip the second batch
+    stage_responses = {}
+    decided = {}
+    final_prompts = {}
+    for index, row_data in rows:
+        responses = [
+            state["responses"].get(f"row-{index}-stage-{slot}", "No response received") if prompt is not None else None
+            for slot, prompt in enumerate(build_stage_prompts(row_data, prompt_states, edited_prompts))
+        ]
+        stage_responses[index] = responses
+        decided[index] = decided_final(responses, settings)
+        if decided[index] is None:
+            final_prompts[f"row-{index}-final"] = build_final_prompt(row_data, responses, edited_prompts)
+    state["phase"] = "final"
+    save_state_file(state_path, state)
+    final_keys = dict.fromkeys(final_prompts, "final_prompt")
+    if not run_batch_phase(state, state_path, "final", final_prompts, api_key, on_status, poll_interval, final_keys, settings, stop_flag):
+        return None
+
+    for index, responses in stage_responses.items():
+        final_response = decided[index] or state["responses"].get(f"row-{index}-final", "No response received")
+        failures = [error for custom_id, error in state["errors"].items() if custom_id.startswith(f"row-{index}-")]
+        usage = row_usage([record for custom_id, records in state["calls"].items() if custom_id.startswith(f"row-{index}-") for record in records])
+        get_call_metrics().row_finished()
+        for member in [index, *copies.get(index, ())]:
+            member_usage = usage if member == index else None
+            store_row_result(df, member, responses + [final_response], failures, member_usage)
+            if journal is not None:
+                journal.append(member, responses + [final_response], failures, member_usage)
+    state["phase"] = "done"
+    save_state_file(state_path, state)
+    if progress_bar is not None:
+        progress_bar.progress(1.0)
+    return df
+
+def results_frame(df, journal, duplicates=None):
+    # What a download holds: journaled results, their typed fields and the duplicate flags
+    df = expand_evaluations(journal.materialize(df))
+    return df if duplicates is None else duplicates.annotate(df)
+
+class CsvJob:
+    """One CSV evaluation running on a background thread, independent of any Streamlit session.
+
+    The job acts as process_csv's progress bar and download container, so it
+    never calls Streamlit itself; the UI polls its status, progress, messages
+    and latest download. pause() and cancel() set stop_flag: no new rows are
+    admitted, rows in flight finish and are journaled. resume() starts a new
+    thread that skips every row already in the journal. settings is the
+    run_settings snapshot taken at submit time, which the journal's prompt
+    digest was computed from.
+    """
+
+    ACTIVE = ("running", "pausing", "cancelling")
+    STOPPING_NOTE = "Finishing the rows in flight; they are saved in the journal."
+
+    def __init__(self, name, df, api_key, start_row, end_row, prompt_states, edited_prompts, journal, export,
+                 backend="thread", max_rows_in_flight=MAX_ROWS_IN_FLIGHT, skip_rows=(), duplicates=None, upload_digest=None, settings=None):
+        self.id = None
+        self.name = name
+        self.df = df
+        self.api_key = api_key
+        self.start_row = start_row
+        self.end_row = end_row
+        self.prompt_states = prompt_states
+        self.edited_prompts = edited_prompts
+        self.journal = journal
+        self.export = export
+        self.export_format = export.fmt if export is not None else None
+        self.backend = backend
+        self.max_rows_in_flight = max_rows_in_flight
+        self.skip_rows = set(skip_rows)
+        self.duplicates = duplicates
+        self.upload_digest = upload_digest
+        self.settings = settings
+        self.status = "queued"
+        self.fraction = 0.0
+        self.messages = deque(maxlen=JOB_MESSAGE_LIMIT)
+        self.download = None
+        self.result = None
+        self.started = None
+        self.finished = None
+        self.stop_flag = threading.Event()
+        self._lock = threading.Lock()
+
+    def progress(self, value):
+        self.fraction = value
+
+    def download_button(self, label, data, file_name, mime, key=None, on_click=None):
+        # render_download hands the job the latest export bytes; the UI renders the actual button
+        self.download = {"label": label, "data": data, "file_name": file_name, "mime": mime}
+
+    def log(self, level, text):
+        self.messages.append((level, text))
+
+    def start(self):
+        with self._lock:
+            if self.status not in ("queued", "paused"):
+                return
+            self.status = "running"
+            self.started = self.started or time.time()
+            self.stop_flag.clear()
+        threading.Thread(target=self._run, name=f"csv-job-{self.id}", daemon=True).start()
+
+    def pause(self):
+        with self._lock:
+            if self.status == "running":
+                self.status = "pausing"
+                self.stop_flag.set()
+
+    def resume(self):
+        with self._lock:
+            if self.status != "paused":
+                return
+            self.skip_rows = self.journal.completed()
+        self.start()
+
+    def cancel(self):
+        with self._lock:
+            if self.status in ("running", "pausing"):
+                self.status = "cancelling"
+                self.stop_flag.set()
+            elif self.status in ("queued", "paused"):
+                self.status = "cancelled"
+                self.finished = time.time()
+
+    def evaluate(self):
+        process_csv(self.df, self.api_key, self.start_row, self.end_row, self, self.stop_flag, self, self.prompt_states, self.edited_prompts,
+                    max_rows_in_flight=self.max_rows_in_flight, backend=self.backend, journal=self.journal, skip_rows=self.skip_rows,
+                    export=self.export, duplicates=self.duplicates, on_message=self.log, settings=self.settings)
+
+    def _run(self):
+        try:
+            self.evaluate()
+            # Skipped and resumed rows only live in the journal, so the final file is built from it
+            self.result = results_frame(self.df, self.journal, self.duplicates)
+            render_download(self, dataframe_bytes(self.result, self.export_format), self.export_format, key=None)
+        except Exception as exc:
+            self.log("error", f"Job failed: {exc}")
+            status = "failed"
+        else:
+            status = {"pausing": "paused", "cancelling": "cancelled"}.get(self.status, "done")
+        with self._lock:
+            self.status = status
+            self.finished = time.time() if status != "paused" else None
+
+class BatchJob(CsvJob):
+    """A Message Batches evaluation (run_batch_job) running in the background like a CsvJob.
+
+    pause() and cancel() stop polling; the batches keep running server-side.
+    The batch state file is the resume point: resume() polls the same
+    batches again, as does a new job for the same rows and prompts.
+    """
+
+    STOPPING_NOTE = "Stopping polling; the batches keep running and their IDs are kept in the batch state file."
+
+    def __init__(self, name, df, api_key, start_row, end_row, prompt_states, edited_prompts, journal, export_format, state_path,
+                 duplicates=None, upload_digest=None, settings=None):
+        super().__init__(name, df, api_key, start_row, end_row, prompt_states, edited_prompts, journal, None,
+                         duplicates=duplicates, upload_digest=upload_digest, settings=settings)
+        self.export_format = export_format
+        self.state_path = state_path
+
+    def note(self, text):
+        # run_batch_job reports on every poll; only changes are worth a message
+        if not self.messages or self.messages[-1] != ("info", text):
+            self.log("info", text)
+
+    def evaluate(self):
+        run_batch_job(self.df, self.api_key, self.start_row, self.end_row, self.prompt_states, self.edited_prompts, self.state_path,
+                      on_status=self.note, journal=self.journal, duplicates=self.duplicates, settings=self.settings,
+                      stop_flag=self.stop_flag, progress_bar=self)
+        get_call_metrics().write_prometheus(stats=get_concurrency_controller(self.api_key).stats())
+
+class JobRegistry:
+    """Process-wide set of CSV jobs, shared by every session of this server (see get_job_registry)."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        reset_run_totals()
+        with self._lock:
+            job.id = str(self._next_id)
+            self._next_id += 1
+            self._jobs[job.id] = job
+        job.start()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self):
+        with self._lock:
+            return any(job.status in CsvJob.ACTIVE for job in self._jobs.values())
+
+    def find(self, journal_path):
+        # The unfinished job writing to journal_path, if any; two jobs must not share a journal and export
+        with self._lock:
+            for job in self._jobs.values():
+                if job.journal.path == journal_path and (job.status in CsvJob.ACTIVE or job.status == "paused"):
+                    return job
+        return None
+
+    def jobs(self, job_ids=(), upload_digest=None):
+        # Jobs by ID, plus every job for upload_digest, in submission order
+        with self._lock:
+            return [job for job in self._jobs.values()
+                    if job.id in job_ids or (upload_digest is not None and job.upload_digest == upload_digest)]
+
+    def remove(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status not in CsvJob.ACTIVE:
+                del self._jobs[job_id]
+
+@st.cache_resource
+def get_job_registry():
+    # Cached for the life of the server process, so jobs outlive the reruns and sessions that started them
+    return JobRegistry()
+
+def reset_run_totals():
+    # Token and call totals are process-wide, so they only start over when no background job is adding to them
+    if not get_job_registry().active():
+        get_call_metrics().reset()
+
+def show_job(job):
+    registry = get_job_registry()
+    with st.container(border=True):
+        st.write(f"**{job.name}** · {job.status}")
+        st.progress(job.fraction)
+        columns = st.columns(4)
+        if job.status == "running":
+            columns[0].button("Pause", key=f"pause-{job.id}", on_click=job.pause)
+        if job.status == "paused":
+            columns[0].button("Resume", key=f"resume-{job.id}", on_click=job.resume)
+        if job.status in ("running", "pausing", "paused"):
+            columns[1].button("Cancel", key=f"cancel-{job.id}", on_click=job.cancel)
+        if job.status not in CsvJob.ACTIVE:
+            columns[2].button("Dismiss", key=f"dismiss-{job.id}", on_click=registry.remove, args=(job.id,))
+        if job.download is not None:
+            columns[3].download_button(**job.download, key=f"download-job-{job.id}", on_click="ignore")
+        if job.status in ("pausing", "cancelling"):
+            st.caption(job.STOPPING_NOTE)
+        for level, text in list(job.messages)[-5:]:
+            getattr(st, level)(text)
+        if job.result is not None:
+            with st.expander("Results"):
+                st.write(job.result)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_jobs(upload_digest=None):
+    # Reruns on its own every JOB_POLL_SECONDS, without rerunning (or interrupting) the rest of the script
+    jobs = get_job_registry().jobs(st.session_state.get("job_ids", ()), upload_digest)
+    if not jobs:
+        return
+    st.header("CSV Jobs")
+    active = [job for job in jobs if job.status in CsvJob.ACTIVE]
+    if active:
+        render_metrics(st.empty(), get_call_metrics().snapshot(), get_concurrency_controller(active[0].api_key).stats())
+    st.caption(get_call_metrics().token_summary())
+    for job in jobs:
+        show_job(job)
+
+@st.cache_resource
+def get_work_queue():
+    return WorkQueue()
+
+def journal_download(journal, df, duplicates, export_format):
+    # (rows in the journal, their download bytes or None), rebuilt only when the journal file or the format changes;
+    # a rerun for any other widget reuses them instead of re-reading the journal
+    try:
+        stat = os.stat(journal.path)
+        version = (journal.path, stat.st_size, stat.st_mtime_ns, export_format)
+    except FileNotFoundError:
+        version = (journal.path, None, None, export_format)
+    cached = st.session_state.get("journal-download")
+    if cached is None or cached["version"] != version:
+        records = journal.load()
+        data = None
+        if records:
+            results = expand_evaluations(materialize_records(df, records))
+            if duplicates is not None:
+                results = duplicates.annotate(results)
+            data = dataframe_bytes(results, export_format)
+        cached = {"version": version, "completed": set(records), "data": data}
+        st.session_state["journal-download"] = cached
+    return cached["completed"], cached["data"]
+
+def queue_download(queue, job_id, df, journal, duplicates, export_format, finished):
+    # Rebuilt at most every EXPORT_REFRESH_SECONDS while workers are adding rows, and once more when the job is finished
+    key = f"queue-download-{job_id}-{export_format}"
+    cached = st.session_state.get(key)
+    if cached is None or (cached["finished"] != finished and time.monotonic() - cached["built"] >= EXPORT_REFRESH_SECONDS):
+        # Rows this server evaluated with the same file and prompts are in the journal rather than the queue
+        local = journal.load() if os.path.basename(journal.path) == f"{job_id}.jsonl" else {}
+        results = expand_evaluations(materialize_records(df, {**local, **queue.records(job_id)}))
+        if duplicates is not None:
+            results = duplicates.annotate(results)
+        cached = {"finished": finished, "built": time.monotonic(), "data": dataframe_bytes(results, export_format)}
+        st.session_state[key] = cached
+    return cached["data"]
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_queue_jobs(upload_digest, df, journal, duplicates, export_format):
+    # Jobs this upload has in the shared work queue, whichever session or server submitted them
+    queue = get_work_queue()
+    job_ids = queue.jobs(upload_digest)
+    if not job_ids:
+        return
+    st.header("Worker Pool")
+    workers = queue.workers()
+    if workers:
+        st.caption(f"{len(workers)} live workers: " + ", ".join(
+            f"{worker_id} ({rows_done} rows, seen {format_seconds(age)} ago)" for worker_id, age, rows_done in workers))
+    else:
+        st.warning("No live workers. Start some with `python st-qc-frqs.py worker` on any machine that can open " + queue.path + ".")
+    for job_id in job_ids:
+        name, status, counts = queue.job(job_id)
+        total = sum(counts.values())
+        finished = counts.get("done", 0) + counts.get("failed", 0)
+        with st.container(border=True):
+            st.write(f"**{name}** · {status if finished < total else 'done'}")
+            st.progress(finished / total if total else 0.0)
+            st.caption(", ".join(f"{counts.get(state, 0)} {state}" for state in ("pending", "leased", "done", "failed")))
+            columns = st.columns(4)
+            if finished < total:
+                if status == "active":
+                    columns[0].button("Pause", key=f"queue-pause-{job_id}", on_click=queue.set_status, args=(job_id, "paused"))
+                if status == "paused":
+                    columns[0].button("Resume", key=f"queue-resume-{job_id}", on_click=queue.set_status, args=(job_id, "active"))
+                if status != "cancelled":
+                    columns[1].button("Cancel", key=f"queue-cancel-{job_id}", on_click=queue.set_status, args=(job_id, "cancelled"))
+            if finished:
+                data = queue_download(queue, job_id, df, journal, duplicates, export_format, finished)
+                render_download(columns[3], data, export_format, key=f"download-queue-{job_id}")
+
+def show_response(response, schema):
+    if schema is None:
+        st.text(response or "")
+        return
+    result, problem = parse_response(response, schema)
+    if result is not None:
+        st.json(result)
+    else:
+        st.warning(f"Could not parse this evaluation ({problem}); showing the raw reply.")
+        st.text(response or "")
+
+def show_caching_note(template, model):
+    # Checked against the template as edited, since edits move the placeholder line that ends the prefix
+    if not prefix_cacheable(template, model):
+        st.caption(f"This prompt's fixed prefix is shorter than the {MIN_CACHEABLE_TOKENS[model]:,} tokens {model} needs for prompt caching, so it is not cached.")
+
 def main():
     st.set_page_config(page_title="AP FRQ Evaluation", page_icon="📝", layout="wide")
 
@@ -363,30 +2925,69 @@ def main():
         st.warning("Please enter your Anthropic API Key to proceed.")
         return
 
+    # Response cache controls
+    cache = get_response_cache()
+    with st.sidebar:
+        st.header("Response Cache")
+        bypass = st.checkbox("Bypass cache", value=False, help="Always call the API; fresh responses still refresh the cache.")
+        if st.button("Clear cache"):
+            cache.clear()
+            st.success("Response cache cleared.")
+        cache_stats = cache.stats()
+        st.write(f"Entries: {cache_stats['entries']}")
+
+        # One controller serves every session and job using this API key, so it is
+        # only reconfigured when someone edits these fields, never on a plain rerun
+        st.header("Rate Limits")
+        st.caption("Shared by every session and job using this API key.")
+        max_limit, rpm, tpm = get_concurrency_controller(api_key).settings
+
+        def apply_rate_limits():
+            configure_concurrency(api_key, st.session_state["max-concurrency"], st.session_state["rpm-limit"], st.session_state["tpm-limit"])
+
+        st.number_input("Max concurrent API calls", min_value=1, max_value=256, value=max_limit, key="max-concurrency", on_change=apply_rate_limits,
+                        help="Ceiling for the adaptive concurrency limit, which starts lower and backs off on 429/529 responses and rising latency.")
+        st.number_input("Requests per minute", min_value=1, value=rpm, key="rpm-limit", on_change=apply_rate_limits, placeholder="Organization limit",
+                        help="Leave empty to use the organization's limit from the API's rate-limit headers; a value caps it lower.")
+        st.number_input("Tokens per minute", min_value=1000, value=tpm, step=1000, key="tpm-limit", on_change=apply_rate_limits, placeholder="Organization limit",
+                        help="Leave empty to use the organization's limit from the API's rate-limit headers; a value caps it lower.")
+
+        st.header("Stage Models")
+        overrides = {}
+        for i, (key, stage) in enumerate([*STAGES.items(), ("final_prompt", FINAL_STAGE)], 1):
+            label = f"Prompt {i}" if key != "final_prompt" else "Final Prompt"
+            with st.expander(label):
+                model = st.selectbox("Model", MODEL_CHOICES, index=MODEL_CHOICES.index(stage["model"]), key=f"{key}-model",
+                                     help=f"{FAST_MODEL} costs less per call, but only caches prompt prefixes of {MIN_CACHEABLE_TOKENS[FAST_MODEL]:,} tokens or more.")
+                temperature = st.number_input("Temperature", min_value=0.0, max_value=1.0, value=stage["temperature"], step=0.1, key=f"{key}-temperature")
+                max_tokens = st.number_input("Max tokens (0 = sized to the reply format)", min_value=0, max_value=MAX_TOKENS, value=stage["max_tokens"] or 0, key=f"{key}-max-tokens")
+                overrides[key] = {"model": model, "temperature": temperature, "max_tokens": max_tokens or None}
+                if key == "final_prompt":
+                    overrides[key]["short_circuit"] = st.checkbox(
+                        "Skip when already decided", value=stage["short_circuit"], key="final-short-circuit",
+                        help="When every scored prompt returns 0 the question cannot pass, so the final result is filled in without calling the model.")
+        # Everything started from this session is evaluated with these settings, whatever other sessions choose
+        settings = run_settings(overrides, bypass)
+
     # Prompt editing and enabling/disabling
     st.header("Prompts Configuration")
+    st.caption("Text above the first line containing a {{PLACEHOLDER}} is identical for every FRQ and is sent as a cached prompt prefix. Keep per-FRQ placeholders near the end to get the most from prompt caching.")
     prompt_states = {}
     edited_prompts = {}
 
-    for i in range(1, 4):
+    for i, (key, stage) in enumerate(STAGES.items(), 1):
         st.subheader(f"Prompt {i}")
-        prompt_states[f"prompt{i}"] = st.checkbox(f"Enable Prompt {i}", value=True)
-        
-        if i == 1:
-            default_prompt = generate_prompt1("{{QUESTION}}")
-        elif i == 2:
-            default_prompt = generate_prompt2("{{QUESTION}}", "{{LESSON_PLAN}}")
-        elif i == 3:
-            default_prompt = generate_prompt3("{{QUESTION}}")
-        
-        edited_prompts[f"prompt{i}"] = st.text_area(f"Edit Prompt {i}", value=default_prompt, height=400)
+        prompt_states[key] = st.checkbox(f"Enable Prompt {i}", value=True)
+        edited_prompts[key] = st.text_area(f"Edit Prompt {i}", value=stage["template"], height=400)
+        show_caching_note(edited_prompts[key], overrides[key]["model"])
 
     st.subheader("Final Prompt")
-    default_final_prompt = generate_final_prompt("{{QUESTION}}", "{{PROMPT_RESULTS}}")
-    edited_prompts["final_prompt"] = st.text_area("Edit Final Prompt", value=default_final_prompt, height=400)
+    edited_prompts["final_prompt"] = st.text_area("Edit Final Prompt", value=FINAL_STAGE["template"], height=400)
+    show_caching_note(edited_prompts["final_prompt"], overrides["final_prompt"]["model"])
 
     # Input method selection
     input_method = st.radio("Choose input method:", ("Text Input", "CSV Upload"))
+    upload_digest = None
 
     if input_method == "Text Input":
         questions = []
@@ -406,33 +3007,75 @@ def main():
         if st.button("Evaluate FRQs"):
             if questions:
                 with st.spinner("Evaluating FRQs..."):
-                    results = []
+                    reset_run_totals()
                     progress_bar = st.progress(0)
-                    for i, q in enumerate(questions):
-                        result = process_row(q, api_key, prompt_states, edited_prompts)
-                        results.append(result)
-                        progress_bar.progress((i + 1) / len(questions))
-
-                    for i, (question, result) in enumerate(zip(questions, results)):
+                    duplicates = DuplicateIndex(enumerate(questions))
+                    for i, question in enumerate(questions):
                         st.subheader(f"Results for FRQ {i+1}")
                         st.write(f"**Question:** {question[0]}")
-                        
-                        for j, response in enumerate(result[:3]):
-                            if prompt_states[f"prompt{j+1}"]:
-                                with st.expander(f"Evaluation {j+1}"):
-                                    st.json(json.loads(response))
-                        
-                        with st.expander("Final Evaluation"):
-                            st.json(json.loads(result[-1]))
+
+                        # One placeholder per evaluation, filled with the reply as it streams in
+                        placeholders = {}
+                        for j, key in enumerate(STAGES):
+                            if prompt_states[key]:
+                                with st.expander(f"Evaluation {j+1}", expanded=True):
+                                    placeholders[j] = st.empty()
+                        with st.expander("Final Evaluation", expanded=True):
+                            placeholders[len(STAGES)] = st.empty()
+
+                        # Worker threads only record partial text and failures; this thread shows them
+                        partial = {}
+                        failures = []
+                        with ThreadPoolExecutor(max_workers=1) as executor:
+                            future = executor.submit(process_row, [*question, duplicates.evidence(i)], api_key, prompt_states, edited_prompts,
+                                                     failures, partial.__setitem__, settings)
+                            shown = {}
+                            while True:
+                                finished = future.done()
+                                for slot, text in list(partial.items()):
+                                    if shown.get(slot) != text:
+                                        placeholders[slot].code(text, language="json")
+                                        shown[slot] = text
+                                if finished:
+                                    break
+                                time.sleep(LIVE_REFRESH_SECONDS)
+                            result = future.result()
+
+                        # st.error calls made off this thread are dropped, so calls that gave up are reported here
+                        if failures and any(result[slot] in (None, "No response received") for slot in placeholders):
+                            st.error(f"API call failed: {failures[-1]}")
+                        stage_keys = [*STAGES, "final_prompt"]
+                        for slot, placeholder in placeholders.items():
+                            with placeholder.container():
+                                show_response(result[slot], RESULT_SCHEMAS.get(stage_keys[slot]))
+                        progress_bar.progress((i + 1) / len(questions))
+
+                    cache_stats = cache.stats()
+                    st.caption(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+                    st.caption(get_call_metrics().token_summary())
+                    stats = get_concurrency_controller(api_key).stats()
+                    get_call_metrics().write_prometheus(stats=stats)
+                    render_metrics(st.empty(), get_call_metrics().snapshot(), stats)
             else:
                 st.warning("Please enter at least one FRQ to evaluate.")
 
     if input_method == "CSV Upload":
         uploaded_file = st.file_uploader("Choose a CSV file", type="csv")
         if uploaded_file is not None:
+            upload_digest = file_digest(uploaded_file.getvalue())
             df = pd.read_csv(uploaded_file)
             st.write(df)
 
+            # Exact duplicates are evaluated once; near duplicates are flagged and shown to the final prompt
+            if st.session_state.get("duplicates_digest") != upload_digest:
+                st.session_state.duplicates = DuplicateIndex((index, row.tolist()[:2]) for index, row in df.iterrows())
+                st.session_state.duplicates_digest = upload_digest
+            duplicates = st.session_state.duplicates
+            exact_copies = len(duplicates.keys) - len(duplicates.groups)
+            if exact_copies or duplicates.near:
+                st.caption(f"{exact_copies} rows repeat an earlier row and will reuse its evaluation; "
+                           f"{sum(len(duplicates.groups[key]) for key in duplicates.near)} rows have near duplicates.")
+
             # Row range selection
             col1, col2 = st.columns(2)
             with col1:
@@ -440,31 +3083,333 @@ def main():
             with col2:
                 end_row = st.number_input("End Row", min_value=start_row, max_value=len(df)-1, value=len(df)-1)
 
-            if st.button("Process CSV"):
-                progress_bar = st.progress(0)
-                stop_flag = threading.Event()
-                
-                # Create placeholders for pause button and download button
-                pause_button = st.empty()
-                download_button = st.empty()
-                
-                def pause_processing():
-                    stop_flag.set()
-                    st.warning("Processing paused. You can download the CSV with processed rows so far.")
-                    # Ensure the download button is visible when paused
-                    download_button.markdown(get_csv_download_link(df), unsafe_allow_html=True)
-
-                pause_button.button("Pause Processing", on_click=pause_processing)
-
-                with st.spinner("Processing CSV..."):
-                    results = process_csv(df, api_key, start_row, end_row, progress_bar, stop_flag, download_button, prompt_states, edited_prompts)
-
-                if stop_flag.is_set():
-                    st.success("Processing paused. You can download the CSV with processed rows above.")
+            col1, col2 = st.columns(2)
+            with col1:
+                max_rows_in_flight = st.number_input("Rows in flight", min_value=1, max_value=1024, value=MAX_ROWS_IN_FLIGHT)
+            with col2:
+                backend = st.radio("Evaluation backend", tuple(EVALUATION_BACKENDS), horizontal=True,
+                                   help="'async' drives every request from one event loop and scales to more calls in flight than threads.")
+            export_format = st.selectbox("Download format", tuple(EXPORT_FORMATS))
+            run_on = st.radio("Run on", ("This server", "Worker pool"), horizontal=True,
+                              help="'Worker pool' queues the rows for `python st-qc-frqs.py worker` processes, on this machine or any other that shares the work queue file.")
+
+            # Rows finished in earlier sessions with the same file and prompts
+            journal = ResultsJournal(upload_digest, prompt_set_digest(prompt_states, edited_prompts, settings))
+            journaled, journal_data = journal_download(journal, df, duplicates, export_format)
+            resume = False
+            if journaled:
+                st.info(f"{len(journaled)} rows of this file were already evaluated with the current prompts.")
+                resume = st.checkbox("Resume: skip rows that were already evaluated", value=True)
+                render_download(st, journal_data, export_format, key="download-journal")
+
+            batch_mode = st.checkbox("Batch mode", help="Submit all prompts through the Message Batches API: lower cost and higher throughput, but results can take up to 24 hours.")
+            batch_path = batch_state_path(upload_digest)
+            batch_state = load_state_file(batch_path)
+            if batch_mode and batch_state is not None and batch_state["phase"] != "done":
+                batch_ids = ", ".join(sum(batch_state["batch_ids"].values(), []))
+                st.info(f"A batch job for rows {batch_state['rows'][0]}-{batch_state['rows'][1]} of this file is still in its {batch_state['phase']} phase ({batch_ids or 'not yet submitted'}). "
+                        "Process the same rows with the same prompts to resume polling.")
+
+            if batch_mode and st.button("Process CSV in Batch Mode"):
+                # Polling can take up to 24 hours, so it runs in the job registry rather than this script run
+                registry = get_job_registry()
+                unfinished = registry.find(journal.path)
+                if unfinished is not None:
+                    st.warning(f"{unfinished.name} is already evaluating this file with the current prompts ({unfinished.status}). Pause, resume or cancel it below.")
                 else:
-                    st.success("Processing completed. You can download the full CSV above.")
-
-                st.write(df)
+                    job = registry.submit(BatchJob(f"{uploaded_file.name}, rows {start_row}-{end_row} (batch)", df.copy(), api_key, start_row, end_row,
+                                                   prompt_states, edited_prompts, journal, export_format, batch_path,
+                                                   duplicates=duplicates, upload_digest=upload_digest, settings=settings))
+                    st.session_state.setdefault("job_ids", []).append(job.id)
+
+            if not batch_mode and run_on == "This server" and st.button("Process CSV"):
+                registry = get_job_registry()
+                unfinished = registry.find(journal.path)
+                if unfinished is not None:
+                    st.warning(f"{unfinished.name} is already evaluating this file with the current prompts ({unfinished.status}). Pause, resume or cancel it below.")
+                else:
+                    # Seed the export with rows finished earlier; the job appends rows as they finish
+                    export = IncrementalExport(os.path.join(EXPORT_DIR, os.path.splitext(os.path.basename(journal.path))[0]), export_format)
+                    if resume and journaled:
+                        export.append_frame(journal.materialize(df).loc[sorted(journaled)])
+                    job = registry.submit(CsvJob(f"{uploaded_file.name}, rows {start_row}-{end_row}", df.copy(), api_key, start_row, end_row,
+                                                 prompt_states, edited_prompts, journal, export, backend, max_rows_in_flight,
+                                                 skip_rows=journaled if resume else (), duplicates=duplicates, upload_digest=upload_digest, settings=settings))
+                    st.session_state.setdefault("job_ids", []).append(job.id)
+
+            if not batch_mode and run_on == "Worker pool" and st.button("Queue CSV for workers"):
+                # Workers use their own API key and rate limits; the queue only holds rows, prompts and stage settings
+                rows, copies = unique_rows(((index, row.tolist()[:2]) for index, row in df.iloc[start_row:end_row+1].iterrows()
+                                            if not (resume and index in journaled)), duplicates)
+                get_work_queue().submit(os.path.splitext(os.path.basename(journal.path))[0], f"{uploaded_file.name}, rows {start_row}-{end_row}",
+                                        prompt_states, edited_prompts, rows, copies, settings["stages"])
+                st.success(f"Queued {len(rows)} rows. Workers pick them up within {QUEUE_POLL_SECONDS} seconds.")
+
+            show_queue_jobs(upload_digest, df, journal, duplicates, export_format)
+
+    # Jobs run in the background across reruns; show this session's and the current upload's
+    show_jobs(upload_digest)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cli(argv=None):
+    """Evaluate a CSV of FRQs from the command line, without the Streamlit UI.
+
+    The input is streamed in chunks and results are appended to the output as
+    rows finish, so memory stays bounded however large the file is. The first
+    Ctrl-C stops admitting rows, finishes the ones in flight and saves a state
+    file; rerun with --resume to continue. A second Ctrl-C aborts immediately.
+    """
+    parser = argparse.ArgumentParser(description="Evaluate AP FRQs from a CSV file (columns: QUESTION, LESSON_PLAN).")
+    parser.add_argument("input", help="input CSV file")
+    parser.add_argument("output", help="output file, .csv or .jsonl")
+    parser.add_argument("--api-key", default=os.environ.get("ANTHROPIC_API_KEY"), help="defaults to $ANTHROPIC_API_KEY")
+    parser.add_argument("--backend", choices=tuple(EVALUATION_BACKENDS), default="thread")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENCY, help="maximum concurrent API calls")
+    parser.add_argument("--rows-in-flight", type=int, default=MAX_ROWS_IN_FLIGHT)
+    parser.add_argument("--rpm", type=int, default=RPM_LIMIT, help="requests per minute cap (default: the organization's limit from response headers)")
+    parser.add_argument("--tpm", type=int, default=TPM_LIMIT, help="tokens per minute cap (default: the organization's limit from response headers)")
+    parser.add_argument("--chunksize", type=int, default=CLI_CHUNK_ROWS, help="input rows read at a time")
+    parser.add_argument("--prompts", help=f"JSON file overriding prompt templates ({', '.join(STAGES)}, final_prompt)")
+    parser.add_argument("--disable", action="append", default=[], metavar="PROMPT", help="disable a stage prompt, e.g. prompt2")
+    parser.add_argument("--stage-model", action="append", default=[], metavar="PROMPT=MODEL", help="model for one prompt, e.g. prompt3=" + FAST_MODEL)
+    parser.add_argument("--no-short-circuit", action="store_true", help="always call the final prompt, even when the stage results decide it")
+    parser.add_argument("--state", help="state file used by --resume (default: OUTPUT.state.json)")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run from its state file")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the response cache")
+    parser.add_argument("--metrics", default=METRICS_PATH, help=f"Prometheus text-format metrics file, rewritten as rows finish (default: {METRICS_PATH})")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or $ANTHROPIC_API_KEY)")
+    fmt = {".csv": "CSV", ".jsonl": "JSONL"}.get(os.path.splitext(args.output)[1].lower())
+    if fmt is None:
+        parser.error("output must be a .csv or .jsonl file")
+
+    prompt_states, edited_prompts = default_prompts()
+    if args.prompts:
+        with open(args.prompts, encoding="utf-8") as f:
+            edited_prompts.update(json.load(f))
+    for key in args.disable:
+        if key not in prompt_states:
+            parser.error(f"unknown prompt {key!r}; choose from {', '.join(prompt_states)}")
+        prompt_states[key] = False
+    overrides = {}
+    for setting in args.stage_model:
+        key, _, model = setting.partition("=")
+        if key not in [*STAGES, "final_prompt"] or not model:
+            parser.error(f"--stage-model expects PROMPT=MODEL with PROMPT one of {', '.join([*STAGES, 'final_prompt'])}")
+        overrides[key] = {"model": model}
+    if args.no_short_circuit:
+        overrides.setdefault("final_prompt", {})["short_circuit"] = False
+    configure_stages(overrides)
+
+    state_path = args.state or f"{args.output}.state.json"
+    state = {"input": os.path.abspath(args.input), "input_digest": file_sha256(args.input),
+             "prompt_digest": prompt_set_digest(prompt_states, edited_prompts), "rows_done": 0}
+    if args.resume:
+        saved = load_state_file(state_path)
+        if saved is None:
+            parser.error(f"no state file at {state_path}")
+        if (saved["input_digest"], saved["prompt_digest"]) != (state["input_digest"], state["prompt_digest"]):
+            parser.error("the input file or prompts changed since the interrupted run; start a fresh run instead")
+        state = saved
+
+    configure_concurrency(args.api_key, args.workers, args.rpm, args.tpm)
+    get_response_cache().bypass = args.no_cache
+    export = IncrementalExport(os.path.splitext(args.output)[0], fmt, truncate=not args.resume)
+
+    stop_flag = threading.Event()
+
+    def interrupt(signum, frame):
+        print("\nStopping: finishing rows in flight. Press Ctrl-C again to abort.", file=sys.stderr)
+        stop_flag.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, interrupt)
+
+    # Original rows wait here until their results are written; bounded by rows in flight plus MAX_ROWS_BUFFERED
+    pending_rows = {}
+
+    def read_rows():
+        index = state["rows_done"]
+        chunks = pd.read_csv(args.input, chunksize=args.chunksize, skiprows=range(1, state["rows_done"] + 1))
+        for chunk in chunks:
+            for _, row in chunk.iterrows():
+                pending_rows[index] = row.to_dict()
+                yield index, row.tolist()[:2]
+                index += 1
+
+    buffer = []
+    flushed_at = time.monotonic()
+    started = time.monotonic()
+    evaluated = 0
+
+    def flush():
+        nonlocal flushed_at
+        if buffer:
+            export.append_frame(expand_evaluations(pd.DataFrame(buffer)))
+            state["rows_done"] += len(buffer)
+            buffer.clear()
+            save_state_file(state_path, state)
+        get_call_metrics().write_prometheus(args.metrics, get_concurrency_controller(args.api_key).stats())
+        flushed_at = time.monotonic()
+
+    evaluate = EVALUATION_BACKENDS[args.backend]
+    for index, responses, error, failures, usage in evaluate(read_rows(), args.api_key, prompt_states, edited_prompts, stop_flag, None, args.rows_in_flight):
+        if error is not None:
+            print(f"Error processing row {index}: {error}", file=sys.stderr)
+        buffer.append({**pending_rows.pop(index), **result_columns(responses, failures, usage)})
+        evaluated += 1
+        if len(buffer) >= CLI_FLUSH_ROWS or time.monotonic() - flushed_at >= CLI_FLUSH_SECONDS:
+            flush()
+            rate = evaluated / (time.monotonic() - started)
+            print(f"{state['rows_done']} rows done ({rate:.1f} rows/s). {format_concurrency_stats(get_concurrency_controller(args.api_key).stats())}", file=sys.stderr)
+    flush()
+
+    print(get_call_metrics().token_summary(), file=sys.stderr)
+    print(format_metrics(get_call_metrics().snapshot()), file=sys.stderr)
+    if stop_flag.is_set():
+        print(f"Interrupted after {state['rows_done']} rows. Resume with --resume (state saved to {state_path}).", file=sys.stderr)
+        return 130
+    print(f"Done: {state['rows_done']} rows written to {export.path}.", file=sys.stderr)
+    return 0
+
+def run_worker(queue, api_key, backend="thread", max_rows_in_flight=MAX_ROWS_IN_FLIGHT, stop_flag=None,
+               poll_interval=QUEUE_POLL_SECONDS, exit_when_idle=False, metrics_path=None, log=print):
+    """Evaluate rows from a WorkQueue until stop_flag is set.
+
+    Rows are claimed QUEUE_CLAIM_ROWS at a time as the backend has room for
+    them, so a worker only holds leases on rows it is about to run. A
+    heartbeat thread renews those leases every third of the lease period and
+    writes this worker's metrics. When stop_flag is set, rows in flight are
+    finished and written back, and claimed rows that never started are
+    released for other workers. Returns the number of rows completed.
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    stop_flag = stop_flag or threading.Event()
+    stopped = threading.Event()
+    started = time.time()
+    completed = 0
+
+    def write_metrics():
+        if metrics_path:
+            get_call_metrics().write_prometheus(metrics_path, get_concurrency_controller(api_key).stats())
+
+    def heartbeat():
+        while not stopped.wait(queue.lease_seconds / 3):
+            queue.heartbeat(worker_id, started)
+            write_metrics()
+
+    queue.heartbeat(worker_id, started)
+    threading.Thread(target=heartbeat, name=f"heartbeat-{worker_id}", daemon=True).start()
+    log(f"Worker {worker_id} polling {queue.path}")
+    try:
+        while not stop_flag.is_set():
+            job = queue.next_job()
+            if job is None:
+                if exit_when_idle and not queue.unfinished():
+                    break
+                stop_flag.wait(poll_interval)
+                continue
+            job_id, job_settings = job
+            settings = run_settings(job_settings["stages"])
+
+            def claimed_rows():
+                # Ends when the job has nothing left to claim, or is paused or cancelled
+                while not stop_flag.is_set():
+                    rows = queue.claim(job_id, worker_id, QUEUE_CLAIM_ROWS)
+                    if not rows:
+                        return
+                    yield from rows
+
+            evaluate = EVALUATION_BACKENDS[backend]
+            for index, responses, error, failures, usage in evaluate(claimed_rows(), api_key, job_settings["prompt_states"], job_settings["edited_prompts"],
+                                                                      stop_flag, None, max_rows_in_flight, settings):
+                if error is not None:
+                    log(f"Error processing row {index} of {job_id}: {error}")
+                queue.complete(job_id, index, worker_id, responses, failures, error, usage)
+                completed += 1
+            write_metrics()
+    finally:
+        stopped.set()
+        queue.release(worker_id)
+        write_metrics()
+    log(f"Worker {worker_id} stopped after {completed} rows")
+    return completed
+
+def worker_process(args):
+    # One worker, in this process or a child started by worker_cli --processes
+    configure_concurrency(args.api_key, args.workers, args.rpm, args.tpm)
+    get_response_cache().bypass = args.no_cache
+    stop_flag = threading.Event()
+
+    def interrupt(signum, frame):
+        stop_flag.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+    metrics_path = args.metrics or os.path.join(STATE_DIR, f"metrics-worker-{os.getpid()}.prom")
+    log = lambda text: print(text, file=sys.stderr)
+    run_worker(WorkQueue(args.queue, args.lease), args.api_key, args.backend, args.rows_in_flight, stop_flag,
+               args.poll, args.exit_when_idle, metrics_path, log)
+    return 130 if stop_flag.is_set() else 0
+
+def worker_cli(argv=None):
+    """Evaluate rows queued by the UI (Run on: Worker pool), as one or more worker processes.
+
+    Start workers on as many machines as needed; they only share the queue
+    file. Each worker process uses its own API key, rate budgets and response
+    cache. Ctrl-C finishes the rows in flight and hands back unstarted ones;
+    a worker that dies instead loses its leases after --lease seconds.
+    """
+    parser = argparse.ArgumentParser(prog="st-qc-frqs.py worker", description="Evaluate AP FRQs from the shared work queue.")
+    parser.add_argument("--queue", default=QUEUE_PATH, help=f"work queue database (default: $FRQ_QUEUE_PATH or {QUEUE_PATH})")
+    parser.add_argument("--api-key", default=os.environ.get("ANTHROPIC_API_KEY"), help="defaults to $ANTHROPIC_API_KEY")
+    parser.add_argument("--backend", choices=tuple(EVALUATION_BACKENDS), default="thread")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to start on this machine")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENCY, help="maximum concurrent API calls per process")
+    parser.add_argument("--rows-in-flight", type=int, default=MAX_ROWS_IN_FLIGHT)
+    parser.add_argument("--rpm", type=int, default=RPM_LIMIT, help="requests per minute cap per process (default: the organization's limit from response headers)")
+    parser.add_argument("--tpm", type=int, default=TPM_LIMIT, help="tokens per minute cap per process (default: the organization's limit from response headers)")
+    parser.add_argument("--lease", type=float, default=LEASE_SECONDS, help="seconds before an unrenewed row is handed to another worker")
+    parser.add_argument("--poll", type=float, default=QUEUE_POLL_SECONDS, help="seconds between checks of an idle queue")
+    parser.add_argument("--exit-when-idle", action="store_true", help="stop once every active job's rows are done or failed")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the response cache")
+    parser.add_argument("--metrics", help="Prometheus text-format metrics file (default: one per process in " + STATE_DIR + ")")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or $ANTHROPIC_API_KEY)")
+    if args.processes < 2:
+        return worker_process(args)
+    if args.metrics:
+        parser.error("--metrics names one file; with --processes each worker writes its own")
+
+    # Children get the same Ctrl-C and shut down on their own; this process only waits for them
+    processes = [multiprocessing.get_context("spawn").Process(target=worker_process, args=(args,)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+    for process in processes:
+        process.join()
+    return max(process.exitcode or 0 for process in processes)
 
 if __name__ == "__main__":
-    main()
+    from streamlit import runtime
+
+    # `streamlit run` serves the UI; `python st-qc-frqs.py worker ...` serves the work queue;
+    # any other plain `python st-qc-frqs.py ...` runs the headless CLI
+    if runtime.exists():
+        main()
+    elif sys.argv[1:2] == ["worker"]:
+        sys.exit(worker_cli(sys.argv[2:]))
+    else:
+        sys.exit(cli())
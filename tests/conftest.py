@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mock_anthropic import start_mock_server  # noqa: E402
+
+@pytest.fixture(scope="session")
+def mock_server():
+    server = start_mock_server(batch_latency=0.1)
+    yield server
+    server.shutdown()
+
+@pytest.fixture(scope="session")
+def app(mock_server, tmp_path_factory):
+    # The app reads its API base URL and state directory at import, so both are set before loading it
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("ANTHROPIC_BASE_URL", f"http://127.0.0.1:{mock_server.server_address[1]}")
+        patch.setenv("FRQ_STATE_DIR", str(tmp_path_factory.mktemp("frq_state")))
+        patch.delenv("FRQ_QUEUE_PATH", raising=False)
+        spec = importlib.util.spec_from_file_location("st_qc_frqs", os.path.join(ROOT, "st-qc-frqs.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,60 @@
+import signal
+import threading
+
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def paths(tmp_path):
+    source = tmp_path / "input.csv"
+    pd.DataFrame({"QUESTION": [f"CLI question {i}?" for i in range(12)], "LESSON_PLAN": ["Unit 3"] * 12}).to_csv(source, index=False)
+    return source, tmp_path / "output.csv", tmp_path / "metrics.prom"
+
+class Evaluated(list):
+    interrupt_after = None
+
+@pytest.fixture
+def evaluated(app, monkeypatch):
+    # Questions that reached call_claude_api; once interrupt_after calls are made, Ctrl-C is pressed once
+    seen = Evaluated()
+    lock = threading.Lock()
+    call = app.call_claude_api
+
+    def note_call(prompt, *args, **kwargs):
+        with lock:
+            seen.extend(question for question in (f"CLI question {i}?" for i in range(12)) if question in str(prompt))
+            if seen.interrupt_after is not None and len(seen) >= seen.interrupt_after:
+                seen.interrupt_after = None
+                signal.raise_signal(signal.SIGINT)
+        return call(prompt, *args, **kwargs)
+
+    monkeypatch.setattr(app, "call_claude_api", note_call)
+    handler = signal.getsignal(signal.SIGINT)
+    yield seen
+    signal.signal(signal.SIGINT, handler)
+
+def run(app, paths, *options):
+    source, output, metrics = paths
+    return app.cli([str(source), str(output), "--api-key", "test-key", "--no-cache", "--metrics", str(metrics), *options])
+
+def test_resume_continues_after_an_interrupt(app, paths, evaluated, capsys):
+    evaluated.interrupt_after = 1
+    assert run(app, paths, "--rows-in-flight", "1") == 130
+    assert "Resume with --resume" in capsys.readouterr().err
+    done = len(pd.read_csv(paths[1]))
+    assert 0 < done < 12
+
+    evaluated.clear()
+    assert run(app, paths, "--resume") == 0
+    # Only rows the interrupted run did not write are evaluated again
+    assert set(evaluated) == {f"CLI question {i}?" for i in range(done, 12)}
+    result = pd.read_csv(paths[1])
+    assert result["QUESTION"].tolist() == [f"CLI question {i}?" for i in range(12)]
+    assert result["Final_Evaluation"].notna().all()
+
+def test_resume_refuses_a_changed_input(app, paths, evaluated):
+    evaluated.interrupt_after = 1
+    assert run(app, paths, "--rows-in-flight", "1") == 130
+    pd.DataFrame({"QUESTION": ["Another question?"], "LESSON_PLAN": ["Unit 3"]}).to_csv(paths[0], index=False)
+    with pytest.raises(SystemExit):
+        run(app, paths, "--resume")
@@ -0,0 +1,157 @@
+import asyncio
+import http.server
+import math
+import random
+import threading
+import time
+
+import aiohttp
+import pytest
+
+def test_controller_grows_additively_and_halves_on_throttling(app):
+    controller = app.ConcurrencyController(max_limit=8, initial=2)
+    for _ in range(2):
+        controller.acquire(0)
+        controller.release(200, 0.1)
+    assert controller.limit == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+    controller.acquire(0)
+    controller.release(429, 0.1)
+    assert controller.limit == pytest.approx((2 + 1 / 2 + 1 / 2.5) / 2)
+    assert controller.stats()["throttled"] == 1
+    # At most one decrease per round trip
+    controller.acquire(0)
+    controller.release(529, 0.1)
+    assert controller.limit == pytest.approx((2 + 1 / 2 + 1 / 2.5) / 2)
+
+def release(controller, latencies, latency_key=None):
+    for latency in latencies:
+        controller.acquire(0)
+        controller.release(200, latency, latency_key=latency_key)
+
+def test_controller_backs_off_when_latency_drifts(app):
+    controller = app.ConcurrencyController(max_limit=8, initial=4)
+    release(controller, [0.01] * 50)
+    grown = controller.limit
+    release(controller, [0.01 * app.LATENCY_TOLERANCE * 10] * 10)
+    assert controller.limit < grown
+
+@pytest.mark.parametrize("spread", [0.5, 1.0])
+def test_controller_keeps_growing_under_noisy_latency(app, spread):
+    # Lognormal latency around a steady median is noise, not drift
+    rng = random.Random(1)
+    controller = app.ConcurrencyController(max_limit=32, initial=4)
+    release(controller, [rng.lognormvariate(math.log(0.05), spread) for _ in range(2000)])
+    assert controller.limit == 32
+
+def test_controller_compares_latency_per_stage(app):
+    # A stage that is always slower than another is not drift
+    controller = app.ConcurrencyController(max_limit=32, initial=4)
+    for _ in range(300):
+        release(controller, [0.01], ("prompt1", "model"))
+        release(controller, [0.01 * app.LATENCY_TOLERANCE * 10], ("final_prompt", "model"))
+    assert controller.limit == 32
+
+def test_controller_baseline_follows_lasting_changes(app):
+    controller = app.ConcurrencyController(max_limit=32, initial=4)
+    release(controller, [0.01] * 50)
+    release(controller, [0.05] * 300)
+    lowered = controller.limit
+    release(controller, [0.05] * 500)
+    assert controller.limit > lowered
+
+def test_controller_stays_within_its_bounds(app):
+    controller = app.ConcurrencyController(max_limit=3, initial=3)
+    for _ in range(20):
+        controller.acquire(0)
+        controller.release(200, 0.1)
+    assert controller.limit == 3
+    controller.acquire(0)
+    assert controller.try_acquire(0) == 0
+    assert controller.try_acquire(0) == 0
+    assert controller.try_acquire(0) > 0
+    assert controller.stats()["in_flight"] == 3
+
+def test_controller_budgets_follow_the_limit_headers(app):
+    controller = app.ConcurrencyController(max_limit=8, initial=8, rpm=None, tpm=1000)
+    assert controller.stats()["rpm_limit"] is None
+    controller.acquire(0)
+    controller.release(200, 0.1, {"anthropic-ratelimit-requests-limit": "50", "anthropic-ratelimit-tokens-limit": "40000"})
+    stats = controller.stats()
+    # The server's request limit applies as is; the configured token cap is tighter than the server's
+    assert (stats["rpm_limit"], stats["tpm_limit"]) == (50, 1000)
+    controller.acquire(0)
+    controller.release(200, 0.1, {"anthropic-ratelimit-requests-remaining": "2"})
+    assert controller.limit == 2
+
+def test_each_api_key_has_its_own_controller(app):
+    controller = app.get_concurrency_controller("key-a")
+    assert app.get_concurrency_controller("key-a") is controller
+    assert app.get_concurrency_controller("key-b") is not controller
+    app.configure_concurrency("key-a", max_limit=4)
+    assert controller.max_limit == 4
+    assert app.get_concurrency_controller("key-b").max_limit == app.MAX_CONCURRENCY
+
+class BrokenReplyHandler(http.server.BaseHTTPRequestHandler):
+    # 200s that decode neither as an event stream nor as JSON; with hang set, they come late
+    hang = False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        if self.hang:
+            time.sleep(2)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        self.wfile.write(b"event: message_start\ndata: {not json\n\n")
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def broken_server(app, monkeypatch):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BrokenReplyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(app, "API_URL", f"http://127.0.0.1:{server.server_address[1]}/v1/messages")
+    monkeypatch.setattr(app, "retry_delay", lambda headers, attempt: 0.0)
+    yield server
+    server.shutdown()
+    BrokenReplyHandler.hang = False
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_undecodable_replies_are_retried_and_release_their_slot(app, broken_server, stream):
+    controller = app.get_concurrency_controller("test-key")
+    headers, payload = app.build_stage_request("Evaluate this question.", "test-key", "prompt1", stream=stream)
+    record = app.new_call_record("prompt1", payload["model"])
+    failures = []
+    assert app.post_with_retries(headers, payload, 100, failures, record=record) is None
+    assert record["statuses"] == ["error"] * (app.MAX_RETRIES + 1)
+    assert len(failures) == app.MAX_RETRIES + 1
+    assert controller.stats()["in_flight"] == 0
+
+def test_async_undecodable_replies_release_their_slot(app, broken_server):
+    controller = app.get_concurrency_controller("test-key")
+    headers, payload = app.build_stage_request("Evaluate this question.", "test-key", "prompt1", stream=True)
+
+    async def post():
+        async with aiohttp.ClientSession() as session:
+            return await app.async_post_with_retries(session, headers, payload, 100, asyncio.Semaphore(1))
+
+    assert asyncio.run(post()) is None
+    assert controller.stats()["in_flight"] == 0
+
+def test_cancelled_request_releases_its_slot(app, broken_server):
+    BrokenReplyHandler.hang = True
+    controller = app.get_concurrency_controller("test-key")
+    headers, payload = app.build_stage_request("Evaluate this question.", "test-key", "prompt1", stream=True)
+
+    async def cancel():
+        async with aiohttp.ClientSession() as session:
+            task = asyncio.create_task(app.async_post_with_retries(session, headers, payload, 100, asyncio.Semaphore(1)))
+            while controller.stats()["in_flight"] == 0:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(cancel())
+    assert controller.stats()["in_flight"] == 0
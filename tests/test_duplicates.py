@@ -0,0 +1,42 @@
+import pandas as pd
+
+QUESTION = ("Explain how the Silk Road trade network contributed to the spread of Buddhism, Islam and Christianity "
+            "across Central and East Asia between 200 BCE and 1450 CE, using two specific examples.")
+
+def test_duplicate_index_groups_normalized_rows(app):
+    rows = [[QUESTION, "Unit 2"], ["Describe photosynthesis.", "Biology"], ["  " + QUESTION.upper(), "unit   2"], [QUESTION, "Unit 3"]]
+    duplicates = app.DuplicateIndex(enumerate(rows))
+    assert [duplicates.first(index) for index in range(4)] == [0, 1, 0, 3]
+    selected, copies = app.unique_rows(enumerate(rows), duplicates)
+    assert [index for index, _ in selected] == [0, 1, 3]
+    assert copies == {0: [2], 1: [], 3: []}
+    annotated = duplicates.annotate(pd.DataFrame({"QUESTION": [row[0] for row in rows]}))
+    assert annotated["Duplicate_Of"].tolist() == [pd.NA, pd.NA, 0, pd.NA]
+
+def test_duplicate_index_finds_near_duplicates(app):
+    rows = [[QUESTION, "u"], [QUESTION.replace("two specific", "two concrete"), "u"], ["Describe photosynthesis in plants.", "b"]]
+    duplicates = app.DuplicateIndex(enumerate(rows))
+    (other, similarity), = duplicates.near_duplicates(0)
+    assert other == 1 and similarity >= app.NEAR_DUPLICATE_THRESHOLD
+    assert duplicates.near_duplicates(2) == []
+
+def test_duplicate_evidence_does_not_depend_on_the_rest_of_the_upload(app):
+    rows = [[QUESTION, "u"], [QUESTION.replace("two specific", "two concrete"), "u"], ["What is 2+2?", "m"], ["what is  2+2?", "M"],
+            ["Describe photosynthesis in plants.", "b"]]
+    duplicates = app.DuplicateIndex(enumerate(rows))
+    grown = app.DuplicateIndex(enumerate([["Name three volcanoes.", "g"], *rows]))
+    assert [duplicates.evidence(index) for index in range(5)] == [grown.evidence(index + 1) for index in range(5)]
+    assert duplicates.evidence(4) is None
+    assert duplicates.evidence(2).startswith("Exact duplicate")
+    assert QUESTION.replace("two specific", "two concrete") in duplicates.evidence(0)
+
+def test_duplicates_are_evaluated_once(app):
+    df = pd.DataFrame({"QUESTION": ["Explain tariffs.", "Explain inflation.", "explain  TARIFFS."], "LESSON_PLAN": ["Econ", "Econ", "econ"]})
+    duplicates = app.DuplicateIndex((index, row.tolist()[:2]) for index, row in df.iterrows())
+    app.get_call_metrics().reset()
+    result = app.evaluate_dataframe(df, "test-key", duplicates=duplicates, settings=app.run_settings(bypass=True))
+    calls_per_row = len(app.STAGES) + 1
+    assert app.get_call_metrics().snapshot()["calls"] == 2 * calls_per_row
+    assert result.loc[2, "Final_Evaluation"] == result.loc[0, "Final_Evaluation"]
+    assert result.loc[0, "Estimated_Cost"] > 0
+    assert result.loc[2, "Estimated_Cost"] == 0
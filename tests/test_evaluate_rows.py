@@ -0,0 +1,73 @@
+import asyncio
+import json
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+REPLY = json.dumps({"score": 1, "rationale": "Clear.", "feedback": "None.", "difficulty": "Moderate", "question_type": "Explain",
+                    "grade_level": "11-12", "sum_score": 2, "final_score": 1, "key_strengths": [], "key_weaknesses": []})
+
+def question(prompt):
+    # The row a prompt belongs to, from the "Row <n>" question text
+    text = json.dumps(prompt)
+    return next(index for index in range(10) if f"Row {index} question" in text)
+
+@pytest.fixture
+def slow_first_row(app, monkeypatch):
+    """Answer every call at once, except row 0's, which waits until every other row has started."""
+    others_started = threading.Event()
+    started = set()
+    waited = []
+
+    def note(prompt):
+        index = question(prompt)
+        if index:
+            started.add(index)
+            if len(started) == 9:
+                others_started.set()
+        return index
+
+    def fake_call(prompt, *args, **kwargs):
+        if note(prompt) == 0:
+            waited.append(others_started.wait(5))
+        return REPLY
+
+    async def fake_async_call(session, prompt, *args, **kwargs):
+        if note(prompt) == 0:
+            deadline = time.monotonic() + 5
+            while not others_started.is_set() and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            waited.append(others_started.is_set())
+        return REPLY
+
+    monkeypatch.setattr(app, "call_claude_api", fake_call)
+    monkeypatch.setattr(app, "async_call_claude_api", fake_async_call)
+    return waited
+
+@pytest.mark.parametrize("backend", ["thread", "async"])
+def test_slow_row_does_not_stop_admission(app, slow_first_row, backend):
+    prompt_states, edited_prompts = app.default_prompts()
+    rows = [(index, [f"Row {index} question about trade?", "Unit 1"]) for index in range(10)]
+    evaluate = app.EVALUATION_BACKENDS[backend]
+    results = list(evaluate(rows, "test-key", prompt_states, edited_prompts, None, 4, 2))
+    # Rows 1-9 were admitted and evaluated while row 0 was still running, and results keep input order
+    assert slow_first_row and all(slow_first_row)
+    assert [index for index, *_ in results] == list(range(10))
+    assert all(error is None for _, _, error, _, _ in results)
+
+def test_evaluate_dataframe_reports_the_error_that_ended_a_row(app, monkeypatch):
+    build_stage_prompts = app.build_stage_prompts
+
+    def fail_on_second_row(row_data, *args):
+        if row_data[0] == "Row 1 question?":
+            raise KeyError("LESSON_PLAN")
+        return build_stage_prompts(row_data, *args)
+
+    monkeypatch.setattr(app, "build_stage_prompts", fail_on_second_row)
+    df = pd.DataFrame({"QUESTION": ["Row 0 question?", "Row 1 question?"], "LESSON_PLAN": ["Unit 1", "Unit 1"]})
+    app.evaluate_dataframe(df, "test-key", settings=app.run_settings(bypass=True))
+    assert df.loc[0, "Last_Error"] == ""
+    assert df.loc[1, "Last_Error"] == "KeyError: 'LESSON_PLAN'"
+    assert df.loc[1, "Final_Evaluation"] == "NA"
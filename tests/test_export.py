@@ -0,0 +1,68 @@
+import io
+import json
+import types
+
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    # IncrementalExport reads the time through the app module
+    now = [1000.0]
+    monkeypatch.setattr(app, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+def row(index):
+    return {"QUESTION": f"q{index}", "Final_Evaluation": f"final {index}"}
+
+def test_download_is_rebuilt_every_refresh_rows(app, tmp_path, clock):
+    export = app.IncrementalExport(str(tmp_path / "export"), refresh_seconds=60, refresh_rows=3)
+    assert not export.refresh_due()
+    for index in range(2):
+        export.append(row(index))
+    assert not export.refresh_due()
+    assert export.data() == b""
+    export.append(row(2))
+    assert export.refresh_due()
+    assert pd.read_csv(io.BytesIO(export.data()))["QUESTION"].tolist() == ["q0", "q1", "q2"]
+    assert export.refreshes == 1 and not export.refresh_due()
+
+def test_download_is_rebuilt_every_refresh_seconds(app, tmp_path, clock):
+    export = app.IncrementalExport(str(tmp_path / "export"), refresh_seconds=10, refresh_rows=100)
+    export.append(row(0))
+    clock[0] += 9
+    assert not export.refresh_due()
+    clock[0] += 1
+    assert export.refresh_due()
+    export.data()
+    # Nothing new since the last refresh: the cached bytes are kept however long it has been
+    clock[0] += 60
+    assert not export.refresh_due()
+    assert export.refreshes == 1
+
+def test_forced_refresh_includes_every_row(app, tmp_path, clock):
+    export = app.IncrementalExport(str(tmp_path / "export"), refresh_seconds=60, refresh_rows=100)
+    export.append(row(0))
+    export.append({"Final_Evaluation": "final 1", "QUESTION": "q1", "Extra": "dropped"})
+    frame = pd.read_csv(io.BytesIO(export.data(force=True)))
+    # The header is written once, in the first row's column order
+    assert frame.columns.tolist() == ["QUESTION", "Final_Evaluation"]
+    assert frame["Final_Evaluation"].tolist() == ["final 0", "final 1"]
+
+@pytest.mark.parametrize("fmt", ["JSONL", "Parquet"])
+def test_line_based_formats(app, tmp_path, clock, fmt):
+    export = app.IncrementalExport(str(tmp_path / "export"), fmt, refresh_rows=1)
+    export.append(row(0))
+    export.append(row(1))
+    data = export.data()
+    if fmt == "JSONL":
+        assert [json.loads(line) for line in data.decode("utf-8").splitlines()] == [row(0), row(1)]
+    else:
+        assert pd.read_parquet(io.BytesIO(data)).to_dict("records") == [row(0), row(1)]
+
+def test_reopened_export_appends_without_a_second_header(app, tmp_path, clock):
+    export = app.IncrementalExport(str(tmp_path / "export"))
+    export.append(row(0))
+    reopened = app.IncrementalExport(str(tmp_path / "export"), truncate=False)
+    reopened.append(row(1))
+    assert pd.read_csv(io.BytesIO(reopened.data(force=True)))["QUESTION"].tolist() == ["q0", "q1"]
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+REPLY = json.dumps({"score": 1, "rationale": "Clear.", "feedback": "None."})
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+@pytest.fixture
+def gated_calls(app, monkeypatch):
+    # Stage calls per question; calls wait while the gate is closed
+    calls = Counter()
+    calls.gate = threading.Event()
+    calls.gate.set()
+    lock = threading.Lock()
+
+    def fake_call(prompt, api_key, failures=None, stage=None, *args, **kwargs):
+        if stage == "prompt1":
+            with lock:
+                calls[app.prompt_parts(prompt)[1].split("\n")[0]] += 1
+        calls.gate.wait(10)
+        return REPLY
+
+    monkeypatch.setattr(app, "call_claude_api", fake_call)
+    return calls
+
+@pytest.fixture
+def make_job(app, tmp_path):
+    def make_job(rows=6):
+        df = pd.DataFrame({"QUESTION": [f"Job question {i}?" for i in range(rows)], "LESSON_PLAN": ["Unit 5"] * rows})
+        prompt_states, edited_prompts = app.default_prompts()
+        edited_prompts["prompt1"] = "{{QUESTION}}\nScore it."
+        journal = app.ResultsJournal("upload", "prompts" * 4, directory=str(tmp_path))
+        export = app.IncrementalExport(str(tmp_path / "export"))
+        return app.CsvJob("job", df, "test-key", 0, rows - 1, prompt_states, edited_prompts, journal, export,
+                          max_rows_in_flight=2, settings=app.run_settings(bypass=True))
+    return make_job
+
+def test_job_runs_to_completion(app, make_job, gated_calls):
+    job = make_job()
+    job.start()
+    wait_for(lambda: job.status not in job.ACTIVE)
+    assert job.status == "done" and job.fraction == 1.0
+    assert job.result["Final_Evaluation"].notna().all()
+    assert job.download is not None and job.download["file_name"].endswith(".csv")
+
+def test_paused_job_resumes_where_it_stopped(app, make_job, gated_calls):
+    job = make_job()
+    gated_calls.gate.clear()
+    job.start()
+    wait_for(lambda: gated_calls)
+    job.pause()
+    assert job.status == "pausing"
+    gated_calls.gate.set()
+    wait_for(lambda: job.status == "paused")
+    done = job.journal.completed()
+    assert 0 < len(done) < 6 and job.finished is None
+
+    job.resume()
+    wait_for(lambda: job.status not in job.ACTIVE)
+    assert job.status == "done"
+    assert job.result["Final_Evaluation"].notna().all()
+    # Rows journaled before the pause were not evaluated again
+    assert set(gated_calls) == {f"Job question {i}?" for i in range(6)}
+    assert set(gated_calls.values()) == {1}
+
+def test_cancelled_job_finishes_its_rows_in_flight(app, make_job, gated_calls):
+    job = make_job()
+    gated_calls.gate.clear()
+    job.start()
+    wait_for(lambda: gated_calls)
+    job.cancel()
+    assert job.status == "cancelling"
+    gated_calls.gate.set()
+    wait_for(lambda: job.status not in job.ACTIVE)
+    assert job.status == "cancelled" and job.finished is not None
+    assert 0 < len(job.journal.completed()) < 6
+    # A cancelled job cannot be resumed
+    job.resume()
+    assert job.status == "cancelled"
+
+def test_paused_job_is_cancelled_at_once(app, make_job, gated_calls):
+    job = make_job()
+    gated_calls.gate.clear()
+    job.start()
+    wait_for(lambda: gated_calls)
+    job.pause()
+    gated_calls.gate.set()
+    wait_for(lambda: job.status == "paused")
+    job.cancel()
+    assert job.status == "cancelled" and job.finished is not None
@@ -0,0 +1,69 @@
+import threading
+
+import pandas as pd
+import pytest
+
+class StopAfterFirstRow:
+    # A progress bar that interrupts the run once the first row is written back
+    def __init__(self, stop_flag):
+        self.stop_flag = stop_flag
+
+    def progress(self, value):
+        self.stop_flag.set()
+
+@pytest.fixture
+def journal(app, tmp_path):
+    return app.ResultsJournal("upload", "prompts" * 4, directory=str(tmp_path))
+
+def test_later_records_for_a_row_win(app, journal):
+    journal.append(0, ["a", "b"], ["attempt 1: HTTP 529"])
+    journal.append(1, ["c", "d"], [])
+    journal.append(0, ["e", "f"], [])
+    records = journal.load()
+    assert sorted(records) == [0, 1]
+    assert records[0]["responses"] == ["e", "f"]
+
+def test_torn_final_line_is_ignored_and_terminated(app, journal, tmp_path):
+    journal.append(0, ["a", "b"], [])
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "responses": ["c"')
+    reopened = app.ResultsJournal("upload", "prompts" * 4, directory=str(tmp_path))
+    assert reopened.completed() == {0}
+    reopened.append(2, ["g", "h"], [])
+    assert reopened.completed() == {0, 2}
+
+def test_materialize_fills_only_journaled_rows(app, journal):
+    df = pd.DataFrame({"QUESTION": ["q0", "q1"], "LESSON_PLAN": ["l0", "l1"]})
+    journal.append(1, ["a", "b", "c", "d", "final"], [], {"input_tokens": 10, "output_tokens": 5, "cost": 0.01})
+    result = journal.materialize(df)
+    assert pd.isna(result.loc[0, "Final_Evaluation"])
+    assert result.loc[1, "Final_Evaluation"] == "final"
+    assert result.loc[1, "Input_Tokens"] == 10
+    assert "Final_Evaluation" not in df.columns
+
+def test_resumed_run_evaluates_only_unfinished_rows(app, journal, tmp_path, monkeypatch):
+    df = pd.DataFrame({"QUESTION": [f"Journal question {i}?" for i in range(4)], "LESSON_PLAN": ["Unit 1"] * 4})
+    prompt_states, edited_prompts = app.default_prompts()
+    settings = app.run_settings(bypass=True)
+    evaluated = set()
+    call = app.call_claude_api
+
+    def note_row(prompt, *args, **kwargs):
+        evaluated.update(question for question in df["QUESTION"] if question in str(prompt))
+        return call(prompt, *args, **kwargs)
+
+    monkeypatch.setattr(app, "call_claude_api", note_row)
+    stop_flag = threading.Event()
+    app.process_csv(df.copy(), "test-key", 0, 3, StopAfterFirstRow(stop_flag), stop_flag, None, prompt_states, edited_prompts,
+                    max_rows_in_flight=1, journal=journal, on_message=lambda level, text: None, settings=settings)
+    done = journal.completed()
+    assert 0 in done and len(done) < len(df)
+
+    # A new session finds the same journal and skips what it already holds
+    evaluated.clear()
+    resumed = app.ResultsJournal("upload", "prompts" * 4, directory=str(tmp_path))
+    app.process_csv(df.copy(), "test-key", 0, 3, StopAfterFirstRow(threading.Event()), None, None, prompt_states, edited_prompts,
+                    journal=resumed, skip_rows=resumed.completed(), on_message=lambda level, text: None, settings=settings)
+    assert evaluated == {question for index, question in df["QUESTION"].items() if index not in done}
+    result = resumed.materialize(df)
+    assert result["Final_Evaluation"].notna().all()
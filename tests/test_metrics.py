@@ -0,0 +1,70 @@
+import os
+
+def samples(text):
+    # {"name{labels}": value} for every sample line, checking each metric is declared before its samples
+    declared, values = set(), {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            declared.add(line.split()[2])
+        elif not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            name = sample.split("{")[0]
+            assert name in declared or name.rsplit("_", 1)[0] in declared, line
+            values[sample] = float(value)
+    return values
+
+def call(app, stage, statuses, latency, outcome="ok", reasks=0, input_tokens=100, output_tokens=20):
+    record = app.new_call_record(stage, app.MODEL)
+    record.update(statuses=statuses, latency=latency, outcome=outcome, reasks=reasks, input_tokens=input_tokens, output_tokens=output_tokens)
+    return record
+
+def test_prometheus_text_counts_calls_attempts_and_tokens(app):
+    metrics = app.CallMetrics()
+    metrics.record_call(call(app, "prompt1", [529, 200], 0.4, reasks=1))
+    metrics.record_call(call(app, "prompt1", [200], 0.1))
+    metrics.record_call(call(app, "final_prompt", ["error"] * 3, 3.0, outcome="failed", input_tokens=0, output_tokens=0))
+    metrics.row_started()
+    metrics.row_started()
+    metrics.row_finished(1.5)
+    values = samples(metrics.prometheus_text())
+    model = app.MODEL
+    assert values[f'frq_api_calls_total{{stage="prompt1",model="{model}",outcome="ok"}}'] == 2
+    assert values[f'frq_api_calls_total{{stage="final_prompt",model="{model}",outcome="failed"}}'] == 1
+    assert values['frq_api_attempts_total{stage="prompt1",status="529"}'] == 1
+    assert values['frq_api_attempts_total{stage="prompt1",status="200"}'] == 2
+    assert values['frq_api_attempts_total{stage="final_prompt",status="error"}'] == 3
+    assert values['frq_api_reasks_total{stage="prompt1"}'] == 1
+    assert values[f'frq_api_tokens_total{{stage="prompt1",model="{model}",kind="input"}}'] == 200
+    assert values[f'frq_api_tokens_total{{stage="prompt1",model="{model}",kind="output"}}'] == 40
+    assert values["frq_rows_total"] == 1
+    assert values["frq_rows_in_flight"] == 1
+    assert values["frq_estimated_cost_dollars_total"] > 0
+
+def test_latency_histograms_are_cumulative(app):
+    metrics = app.CallMetrics()
+    for latency in (0.1, 0.4, 3.0, 400.0):
+        metrics.record_call(call(app, "prompt2", [200], latency))
+    # Cached calls made no request, so they stay out of the latency histogram
+    metrics.record_call(call(app, "prompt2", [], 0.0, outcome="cached"))
+    values = samples(metrics.prometheus_text())
+    bucket = 'frq_api_call_duration_seconds_bucket{{stage="prompt2",le="{}"}}'.format
+    assert [values[bucket(bound)] for bound in (0.25, 0.5, 5, 300, "+Inf")] == [1, 2, 3, 3, 4]
+    assert values['frq_api_call_duration_seconds_count{stage="prompt2"}'] == 4
+    assert values['frq_api_call_duration_seconds_sum{stage="prompt2"}'] == 403.5
+
+def test_controller_gauges_and_label_escaping(app):
+    metrics = app.CallMetrics()
+    metrics.record_call(call(app, 'odd "stage"\n', [200], 0.1))
+    text = metrics.prometheus_text(app.ConcurrencyController(max_limit=8, initial=3).stats())
+    values = samples(text)
+    assert 'stage="odd \\"stage\\"\\n"' in text
+    assert (values["frq_api_in_flight"], values["frq_api_concurrency_limit"], values["frq_api_throttled_total"]) == (0, 3, 0)
+
+def test_write_prometheus_replaces_the_file_whole(app, tmp_path):
+    metrics = app.CallMetrics()
+    path = tmp_path / "metrics" / "frq.prom"
+    metrics.write_prometheus(str(path))
+    metrics.row_finished(0.5)
+    metrics.write_prometheus(str(path))
+    assert path.read_text(encoding="utf-8") == metrics.prometheus_text()
+    assert os.listdir(path.parent) == ["frq.prom"]
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+STAGE_REPLY = {"score": 1, "rationale": "Clear and answerable.", "feedback": "None."}
+
+@pytest.mark.parametrize("text", [
+    json.dumps(STAGE_REPLY),
+    "Here is my evaluation:\n" + json.dumps(STAGE_REPLY) + "\nLet me know if you need more.",
+    "```json\n" + json.dumps(STAGE_REPLY, indent=2) + "\n```",
+    "[1, 2] {not json} " + json.dumps(STAGE_REPLY),
+])
+def test_extract_json_object_skips_surrounding_text(app, text):
+    assert app.extract_json_object(text) == STAGE_REPLY
+
+def test_extract_json_object_ignores_braces_in_strings(app):
+    reply = {"score": 0, "rationale": "Uses a set {1, 2} and a closing } brace.", "feedback": "Quote \"{\" less."}
+    assert app.extract_json_object(json.dumps(reply) + " trailing }") == reply
+    assert app.extract_json_object("no object here") is None
+
+def test_parse_response_coerces_to_the_schema(app):
+    schema = app.RESULT_SCHEMAS["prompt3"]
+    text = json.dumps({"difficulty": "moderate", "question_type": " Explain ", "grade_level": "11-12", "bloom_level": "Analyze"})
+    result, problem = app.parse_response(text, {"difficulty": schema["difficulty"], "question_type": schema["question_type"]})
+    assert problem is None
+    assert result == {"difficulty": "Moderate", "question_type": "Explain"}
+    assert app.parse_response('{"score": "1.0", "rationale": "r", "feedback": "f"}', app.RESULT_SCHEMAS["prompt1"])[0]["score"] == 1
+
+@pytest.mark.parametrize("text, problem", [
+    ("", "empty response"),
+    ("I cannot answer that.", "no JSON object found"),
+    ('{"score": 1, "rationale": "r"}', "missing field 'feedback'"),
+    ('{"score": true, "rationale": "r", "feedback": "f"}', "'score' is not an integer"),
+    ('{"score": 3, "rationale": "r", "feedback": "f"}', "'score' must be one of 0, 1"),
+])
+def test_parse_response_names_the_problem(app, text, problem):
+    assert app.parse_response(text, app.RESULT_SCHEMAS["prompt1"]) == (None, problem)
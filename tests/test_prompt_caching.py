@@ -0,0 +1,51 @@
+import pytest
+
+TEMPLATE = "You are an AP exam reviewer.\nScore strictly.\n<question>\n{{QUESTION}}\n</question>\nLesson: {{LESSON_PLAN}}"
+
+def test_split_prompt_template_cuts_before_the_first_placeholder_line(app):
+    system, user = app.split_prompt_template(TEMPLATE)
+    assert system == "You are an AP exam reviewer.\nScore strictly.\n<question>"
+    assert user == "{{QUESTION}}\n</question>\nLesson: {{LESSON_PLAN}}"
+
+@pytest.mark.parametrize("template", ["No placeholders at all.", "Question: {{QUESTION}}\nThen the rest."])
+def test_split_prompt_template_without_a_static_prefix(app, template):
+    system, user = app.split_prompt_template(template)
+    assert system == ""
+    assert user == template
+
+def test_format_prompt_fills_only_the_user_message(app):
+    system, user = app.format_prompt(TEMPLATE, QUESTION="Why did Rome fall?", LESSON_PLAN="Unit 2")
+    assert system == app.split_prompt_template(TEMPLATE)[0]
+    assert user == "Why did Rome fall?\n</question>\nLesson: Unit 2"
+    assert app.format_prompt("Question: {{QUESTION}}", QUESTION="Why?") == "Question: Why?"
+
+def test_stage_prefixes_are_the_same_for_every_row(app):
+    prompt_states, edited_prompts = app.default_prompts()
+    first = app.build_stage_prompts(["Why did Rome fall?", "Unit 2"], prompt_states, edited_prompts)
+    second = app.build_stage_prompts(["Explain tariffs.", "Econ"], prompt_states, edited_prompts)
+    for a, b in zip(first, second):
+        assert app.prompt_parts(a)[0] == app.prompt_parts(b)[0]
+        assert app.prompt_parts(a)[1] != app.prompt_parts(b)[1]
+
+def test_static_prefix_is_sent_as_a_cached_system_block(app):
+    _, payload = app.build_api_request(("Static instructions.", "Row question."), "test-key")
+    assert payload["system"] == [{"type": "text", "text": "Static instructions.", "cache_control": {"type": "ephemeral"}}]
+    assert payload["messages"] == [{"role": "user", "content": "Row question."}]
+    _, payload = app.build_api_request("Row question only.", "test-key")
+    assert "system" not in payload
+
+def test_prefix_cacheable_follows_the_model_minimum(app):
+    minimum = app.MIN_CACHEABLE_TOKENS[app.MODEL] * app.CHARS_PER_TOKEN
+    assert app.prefix_cacheable("x" * minimum + "\n{{QUESTION}}", app.MODEL)
+    assert not app.prefix_cacheable("x" * (minimum - app.CHARS_PER_TOKEN) + "\n{{QUESTION}}", app.MODEL)
+
+def test_later_rows_read_the_prefix_from_the_cache(app):
+    system = "Cached instructions for this test only. " * 300
+    calls = []
+    for question in ("First row question?", "Second row question?"):
+        headers, payload = app.build_api_request((system, question), "test-key")
+        record = app.new_call_record(None, payload["model"])
+        assert app.post_with_retries(headers, payload, 100, record=record) is not None
+        calls.append(record)
+    assert calls[0]["cache_creation_input_tokens"] > 0 and calls[0]["cache_read_input_tokens"] == 0
+    assert calls[1]["cache_read_input_tokens"] == calls[0]["cache_creation_input_tokens"]
@@ -0,0 +1,67 @@
+import json
+import types
+
+import pytest
+
+STAGE_REPLY = {"score": 1, "rationale": "Clear and answerable.", "feedback": "None."}
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    # ResponseCache reads the time through the app module, so entries get distinct, controllable timestamps
+    now = [1_000_000.0]
+    monkeypatch.setattr(app, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+def test_cache_misses_then_hits(app, tmp_path):
+    cache = app.ResponseCache(str(tmp_path / "cache.sqlite3"))
+    key = cache.make_key("model", 0.0, 100, "Evaluate this question.")
+    assert cache.get(key) is None
+    cache.put(key, "reply")
+    assert cache.get(key) == "reply"
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
+
+def test_cache_key_covers_the_whole_request(app):
+    key = app.ResponseCache.make_key("model", 0.0, 100, "Evaluate this question.")
+    assert key == app.ResponseCache.make_key("model", 0.0, 100, "Evaluate this question.")
+    assert key != app.ResponseCache.make_key("other-model", 0.0, 100, "Evaluate this question.")
+    assert key != app.ResponseCache.make_key("model", 0.5, 100, "Evaluate this question.")
+    assert key != app.ResponseCache.make_key("model", 0.0, 100, "Evaluate that question.")
+
+def test_bypass_misses_but_still_stores(app, tmp_path):
+    cache = app.ResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("key", "old reply")
+    cache.bypass = True
+    assert cache.get("key") is None
+    cache.put("key", "new reply")
+    # A per-call choice wins over the shared flag
+    assert cache.get("key", bypass=False) == "new reply"
+
+def test_stale_entries_miss_and_are_evicted(app, tmp_path, clock):
+    cache = app.ResponseCache(str(tmp_path / "cache.sqlite3"), max_age_days=1)
+    cache.put("key", "reply")
+    clock[0] += 86400 + 1
+    assert cache.get("key") is None
+    cache.evict()
+    assert cache.stats()["entries"] == 0
+
+def test_least_recently_used_entries_are_evicted(app, tmp_path, clock):
+    cache = app.ResponseCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.put(key, f"reply {key}")
+        clock[0] += 1
+    assert cache.get("a") == "reply a"
+    cache.evict()
+    assert cache.stats()["entries"] == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == "reply a" and cache.get("c") == "reply c"
+
+def test_cached_calls_skip_the_api(app, mock_server):
+    prompt = "Explain how the cache avoids a second request for this question."
+    settings = app.run_settings(bypass=False)
+    first, second = [], []
+    reply = app.call_claude_api(prompt, "test-key", stage="prompt1", settings=settings, calls=first)
+    served = mock_server.requests_served
+    assert app.call_claude_api(prompt, "test-key", stage="prompt1", settings=settings, calls=second) == reply
+    assert mock_server.requests_served == served
+    assert [record["outcome"] for record in first + second] == ["ok", "cached"]
+    assert json.loads(reply).keys() >= STAGE_REPLY.keys()
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from mock_anthropic import start_mock_server
+
+@pytest.fixture
+def throttling_server(app, monkeypatch):
+    # A server of its own, so injected errors do not reach other tests, and
+    # retry delays recorded instead of slept
+    server = start_mock_server()
+    monkeypatch.setattr(app, "API_URL", f"http://127.0.0.1:{server.server_address[1]}/v1/messages")
+    delays = []
+    retry_delay = app.retry_delay
+
+    def record_delay(headers, attempt):
+        delays.append(retry_delay(headers, attempt))
+        # With recovers set, only the first attempt fails
+        if server.recovers:
+            server.rate_limit_rate = server.overload_rate = 0.0
+        return 0.0
+
+    monkeypatch.setattr(app, "retry_delay", record_delay)
+    server.delays = delays
+    server.recovers = False
+    yield server
+    server.shutdown()
+    # Throttled attempts halved the shared adaptive limit
+    app.configure_concurrency("test-key", initial=app.MAX_WORKERS)
+
+def post(app, failures=None):
+    headers, payload = app.build_stage_request("Evaluate this question.", "test-key")
+    record = app.new_call_record(None, payload["model"])
+    return app.post_with_retries(headers, payload, 100, failures, record=record), record
+
+def test_retry_delay_honors_retry_after(app):
+    assert app.retry_delay({"retry-after": "3"}, 0) == 3.0
+    assert app.retry_delay({"retry-after": "600"}, 0) == app.RETRY_MAX_DELAY
+
+def test_retry_delay_waits_for_exhausted_limits_to_reset(app):
+    reset = (datetime.now(timezone.utc) + timedelta(seconds=10)).isoformat().replace("+00:00", "Z")
+    headers = {"anthropic-ratelimit-tokens-remaining": "0", "anthropic-ratelimit-tokens-reset": reset,
+               "anthropic-ratelimit-requests-remaining": "12"}
+    assert 9.0 < app.retry_delay(headers, 0) <= 10.0 + app.RETRY_BASE_DELAY
+
+def test_retry_delay_backs_off_exponentially_with_jitter(app):
+    for attempt in range(8):
+        assert 0.0 <= app.retry_delay({}, attempt) <= min(app.RETRY_MAX_DELAY, app.RETRY_BASE_DELAY * 2 ** attempt)
+
+def test_rate_limited_request_is_retried_after_retry_after(app, throttling_server):
+    throttling_server.rate_limit_rate = 1.0
+    throttling_server.retry_after = 2.5
+    throttling_server.recovers = True
+    text, record = post(app)
+    assert text is not None
+    assert record["statuses"] == [429, 200]
+    assert throttling_server.delays == [2.5]
+
+def test_overloaded_requests_back_off_then_give_up(app, throttling_server):
+    throttling_server.overload_rate = 1.0
+    failures = []
+    text, record = post(app, failures)
+    assert text is None
+    assert record["statuses"] == [529] * (app.MAX_RETRIES + 1)
+    assert len(failures) == app.MAX_RETRIES + 1 and "HTTP 529" in failures[-1]
+    # No retry-after on 529s: full-jitter exponential backoff between attempts
+    assert len(throttling_server.delays) == app.MAX_RETRIES
+    for attempt, delay in enumerate(throttling_server.delays):
+        assert 0.0 <= delay <= app.RETRY_BASE_DELAY * 2 ** attempt
+
+def test_client_errors_are_not_retried(app, throttling_server, monkeypatch):
+    failures = []
+    headers, payload = app.build_stage_request("Evaluate this question.", "test-key")
+    monkeypatch.setattr(app, "API_URL", app.API_URL.replace("/v1/messages", "/v1/unknown"))
+    assert app.post_with_retries(headers, payload, 100, failures) is None
+    assert len(failures) == 1 and "HTTP 404" in failures[0]
+    assert throttling_server.delays == []
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+ZERO = json.dumps({"score": 0, "rationale": "Not answerable from the lesson.", "feedback": "Name the lesson's sources."})
+ONE = json.dumps({"score": 1, "rationale": "Clear and answerable.", "feedback": "None."})
+PROMPT3 = json.dumps({"difficulty": "Moderate", "question_type": "Explain", "grade_level": "11-12"})
+
+def test_every_stage_defaults_to_the_main_model(app):
+    assert {stage["model"] for stage in app.STAGES.values()} == {app.MODEL}
+    settings = app.run_settings({"prompt3": {"model": app.FAST_MODEL}}, bypass=True)
+    assert app.stage_config("prompt3", settings)["model"] == app.FAST_MODEL
+    assert app.stage_config("prompt1", settings)["model"] == app.MODEL
+
+def test_all_zero_scores_decide_the_final_result(app):
+    decided = app.decided_final([ZERO, ZERO, PROMPT3])
+    assert app.is_valid_response(decided, app.RESULT_SCHEMAS["final_prompt"])
+    final = json.loads(decided)
+    assert (final["sum_score"], final["final_score"]) == (0, 0)
+    assert final["key_weaknesses"] == ["Not answerable from the lesson."] * 2
+
+@pytest.mark.parametrize("responses", [
+    [ZERO, ONE, PROMPT3],
+    [ZERO, "I cannot evaluate this question.", PROMPT3],
+    [None, None, PROMPT3],
+])
+def test_undecided_results_go_to_the_final_prompt(app, responses):
+    assert app.decided_final(responses) is None
+
+def test_short_circuit_can_be_turned_off(app):
+    settings = app.run_settings({"final_prompt": {"short_circuit": False}}, bypass=True)
+    assert app.decided_final([ZERO, ZERO, PROMPT3], settings) is None
+
+def test_decided_rows_make_no_final_call(app, monkeypatch):
+    stages = []
+
+    def fake_call(prompt, api_key, failures=None, stage=None, *args, **kwargs):
+        stages.append(stage)
+        return PROMPT3 if stage == "prompt3" else ZERO
+
+    monkeypatch.setattr(app, "call_claude_api", fake_call)
+    prompt_states, edited_prompts = app.default_prompts()
+    responses = app.process_row(["Explain tariffs.", "Econ"], "test-key", prompt_states, edited_prompts, settings=app.run_settings(bypass=True))
+    assert sorted(stages) == sorted(app.STAGES)
+    assert json.loads(responses[-1])["final_score"] == 0
+    results = list(app.evaluate_rows([(0, ["Explain tariffs.", "Econ"])], "test-key", prompt_states, edited_prompts))
+    assert "final_prompt" not in stages
+    assert json.loads(results[0][1][-1])["final_score"] == 0
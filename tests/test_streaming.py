@@ -0,0 +1,51 @@
+import json
+
+from mock_anthropic import start_mock_server
+
+STAGE_REPLY = {"score": 1, "rationale": "Clear and answerable.", "feedback": "None."}
+
+def events(*events):
+    return [f"data: {json.dumps(event)}" for event in events]
+
+def delta(text):
+    return {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}}
+
+def test_message_stream_stops_after_the_object(app):
+    reply = app.MessageStream(stop_at_object=True)
+    lines = events(
+        {"type": "message_start", "message": {"usage": {"input_tokens": 12, "output_tokens": 1}}},
+        delta('{"rationale": "a } inside'), delta(' a string", "score": 1}'), delta("\n"), delta("Hope this helps!"),
+    )
+    assert [reply.feed(line) for line in ["event: message_start", *lines]] == [False, False, False, False, False, True]
+    assert json.loads(reply.text) == {"rationale": "a } inside a string", "score": 1}
+    # The closing usage event was never read, so output tokens are estimated from the text
+    assert reply.usage["input_tokens"] == 12
+    assert reply.usage["output_tokens"] == len(reply.text) // app.CHARS_PER_TOKEN
+
+def test_message_stream_reads_to_the_end_without_stop_at_object(app):
+    reply = app.MessageStream()
+    lines = events(delta('{"score": 1}'), delta(" and more"), {"type": "message_delta", "usage": {"output_tokens": 7}})
+    assert not any(reply.feed(line) for line in lines)
+    assert reply.text == '{"score": 1} and more'
+    assert reply.usage["output_tokens"] == 7
+
+def test_message_stream_reports_errors(app):
+    reply = app.MessageStream()
+    assert reply.feed(events({"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})[0])
+    assert reply.failure() == (529, "stream error: overloaded_error: Overloaded")
+
+def test_streamed_reply_stops_after_the_object(app, monkeypatch):
+    text = json.dumps(STAGE_REPLY) + "\n\nLet me know if you would like me to evaluate another question for you."
+    server = start_mock_server(responses={"stage": text})
+    try:
+        monkeypatch.setattr(app, "API_URL", f"http://127.0.0.1:{server.server_address[1]}/v1/messages")
+        headers, payload = app.build_stage_request("Evaluate this question.", "test-key", "prompt1", stream=True)
+        record = app.new_call_record("prompt1", payload["model"])
+        reply = app.post_with_retries(headers, payload, 100, stop_at_object=True, record=record)
+        # Reading stops at the first delta after the one that closed the object
+        assert app.extract_json_object(reply) == STAGE_REPLY
+        assert len(reply) < len(text)
+        assert record["statuses"] == [200]
+        assert app.post_with_retries(headers, payload, 100) == text
+    finally:
+        server.shutdown()
@@ -0,0 +1,76 @@
+import pytest
+
+def expire_leases(queue):
+    # Make every lease look like its worker died, without waiting for it to run out
+    with queue._conn:
+        queue._conn.execute("UPDATE tasks SET lease_expires = 0 WHERE status = 'leased'")
+
+def task(queue, job_id, index):
+    return queue._conn.execute(
+        "SELECT status, attempts, error FROM tasks WHERE job_id = ? AND row_index = ?", (job_id, index)
+    ).fetchone()
+
+@pytest.fixture
+def queue(app, tmp_path):
+    queue = app.WorkQueue(str(tmp_path / "queue.sqlite3"), lease_seconds=60)
+    prompt_states, edited_prompts = app.default_prompts()
+    queue.submit("job", "job.csv", prompt_states, edited_prompts, [(index, [f"Question {index}", "Plan"]) for index in range(5)])
+    return queue
+
+def test_claim_hands_each_row_to_one_worker(queue):
+    first = queue.claim("job", "worker-1", 3)
+    second = queue.claim("job", "worker-2", 3)
+    assert [index for index, _ in first] == [0, 1, 2]
+    assert [index for index, _ in second] == [3, 4]
+    assert second[0][1] == ["Question 3", "Plan"]
+    assert queue.claim("job", "worker-3", 3) == []
+
+def test_expired_lease_is_reclaimed_once_per_attempt(app, queue):
+    for attempt in range(1, app.MAX_TASK_ATTEMPTS + 1):
+        assert [index for index, _ in queue.claim("job", f"worker-{attempt}", 1)] == [0]
+        # Still leased: nobody else gets the row until the lease runs out
+        assert [index for index, _ in queue.claim("job", "other", 1)] == [1]
+        queue.release("other")
+        assert task(queue, "job", 0)[:2] == ("leased", attempt)
+        expire_leases(queue)
+    # The last lease expired too: the row is failed instead of handed out again
+    assert [index for index, _ in queue.claim("job", "late", 1)] == [1]
+    status, attempts, error = task(queue, "job", 0)
+    assert (status, attempts) == ("failed", app.MAX_TASK_ATTEMPTS)
+    assert error == f"lease expired {app.MAX_TASK_ATTEMPTS} times"
+    assert queue.records("job")[0] == {"responses": ["NA"] * (len(app.STAGES) + 1), "failures": [error], "usage": None}
+
+def test_heartbeat_renews_leases(queue):
+    queue.claim("job", "worker-1", 1)
+    expire_leases(queue)
+    queue.heartbeat("worker-1", 0.0)
+    assert [index for index, _ in queue.claim("job", "worker-2", 1)] == [1]
+
+def test_release_returns_rows_without_spending_an_attempt(queue):
+    queue.claim("job", "worker-1", 2)
+    queue.release("worker-1")
+    assert task(queue, "job", 0)[:2] == ("pending", 0)
+    assert [index for index, _ in queue.claim("job", "worker-2", 2)] == [0, 1]
+    assert task(queue, "job", 0)[:2] == ("leased", 1)
+
+def test_complete_keeps_the_first_result(app, queue):
+    prompt_states, edited_prompts = app.default_prompts()
+    queue.submit("job", "job.csv", prompt_states, edited_prompts, [(5, ["Question 0", "Plan"])], {0: [5]})
+    queue.claim("job", "worker-1", 1)
+    expire_leases(queue)
+    queue.claim("job", "worker-2", 1)
+    usage = {"input_tokens": 10, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0, "output_tokens": 2, "cost": 0.5}
+    queue.complete("job", 0, "worker-2", ["a", "b", "c", "d"], [], usage=usage)
+    # The first worker's lease expired, but its late result must not overwrite the row
+    queue.complete("job", 0, "worker-1", ["w", "x", "y", "z"], ["attempt 1: HTTP 529"])
+    records = queue.records("job")
+    assert records[0] == {"responses": ["a", "b", "c", "d"], "failures": [], "usage": usage}
+    # The exact duplicate shares the result but not the cost
+    assert records[5] == {"responses": ["a", "b", "c", "d"], "failures": [], "usage": None}
+
+def test_paused_job_hands_out_no_rows(queue):
+    queue.set_status("job", "paused")
+    assert queue.claim("job", "worker-1", 5) == []
+    assert queue.next_job() is None
+    queue.set_status("job", "active")
+    assert queue.next_job()[0] == "job"